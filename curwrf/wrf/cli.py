@@ -0,0 +1,94 @@
+#!/bin/python
+import argparse
+import datetime as dt
+import logging
+
+from curwrf.wrf import utils
+
+# each command imports only the modules it uses, see import_benchmark.py
+COMMANDS = [('download', 'Download the GFS data of the dates'),
+            ('wps', 'Run WPS for the dates, using the downloaded GFS data'),
+            ('wrf', 'Run real.exe and wrf.exe for the dates, using the met_em files of WPS'),
+            ('extract', 'Extract the rainfall from the WRF outputs of the dates'),
+            ('all', 'Download, run WPS and WRF, and extract the dates')]
+
+
+def get_wrf_config(wrf_home, wrf_config_file, args_dict):
+    from curwrf.wrf.execution import executor
+    return executor.get_wrf_config(wrf_home, config_file=wrf_config_file, **args_dict)
+
+
+def get_run_config(wrf_conf, date):
+    """
+    :return: the wrf_conf, or the run dirs of the date with isolated_runs. -run_id should be the same for the
+    commands of a run
+    """
+    from curwrf.wrf.execution import executor
+    if wrf_conf.get('isolated_runs'):
+        return executor.create_run_config(wrf_conf, date)
+    return wrf_conf
+
+
+def download(wrf_conf, start_date, end_date):
+    from curwrf.wrf.execution import executor
+    for date in utils.get_dates(start_date, end_date):
+        executor.download_gfs_data(date, wrf_conf)
+
+
+def wps(wrf_conf, start_date, end_date):
+    from curwrf.wrf.execution import executor
+    for date in utils.get_dates(start_date, end_date):
+        executor.run_wps_for_date(date, get_run_config(wrf_conf, date))
+
+
+def wrf(wrf_conf, start_date, end_date):
+    from curwrf.wrf.execution import executor
+    for date in utils.get_dates(start_date, end_date):
+        executor.run_wrf_model(date, get_run_config(wrf_conf, date))
+
+
+def extract(wrf_home, start_date, end_date, chunk_size=None):
+    from curwrf.wrf.extraction import extractor
+    extractor.extract_all(wrf_home, start_date, end_date, chunk_size)
+
+
+def main():
+    parent = utils.get_arg_parser(add_help=False)
+    parser = argparse.ArgumentParser(description='Running WRF')
+    subparsers = parser.add_subparsers(dest='command')
+    for name, help_str in COMMANDS:
+        subparsers.add_parser(name, parents=[parent], help=help_str)
+    args_dict = utils.get_args_dict(parser.parse_args())
+
+    command = args_dict.pop('command')
+    wrf_home = args_dict.pop('wrf_home')
+    start_date = dt.datetime.strptime(args_dict.pop('start'), '%Y-%m-%d_%H:%M')
+    end_date = dt.datetime.strptime(args_dict.pop('end'), '%Y-%m-%d_%H:%M')
+    wrf_config_file = args_dict.pop('wrf_config')
+
+    utils.set_logging_config(utils.get_logs_dir(wrf_home))
+    logging.info('Running %s from %s to %s' % (command, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
+
+    if command == 'extract':
+        extract(wrf_home, start_date, end_date, args_dict.get('extract_chunk_size'))
+        return
+
+    wrf_conf = get_wrf_config(wrf_home, wrf_config_file, args_dict)
+    if command == 'download':
+        download(wrf_conf, start_date, end_date)
+    elif command == 'wps':
+        wps(wrf_conf, start_date, end_date)
+    elif command == 'wrf':
+        wrf(wrf_conf, start_date, end_date)
+    elif wrf_conf.get('stage_scheduler'):
+        from curwrf.wrf.execution import executor
+        # the extraction of each date runs as a stage, as soon as its wrf.exe is done. same as run_all.py
+        executor.run_all_scheduled(wrf_conf, start_date, end_date, extract_fn=lambda date: extract(
+            wrf_home, date, date + dt.timedelta(days=1), wrf_conf.get('extract_chunk_size')))
+    else:
+        from curwrf.wrf.execution import executor
+        executor.run_all(wrf_conf, start_date, end_date)
+        extract(wrf_home, start_date, end_date, wrf_conf.get('extract_chunk_size'))
+
+if __name__ == "__main__":
+    main()
@@ -4,21 +4,54 @@ DEFAULT_WRF_HOME = '/mnt/disks/wrf-mod/'
 ## GFS configs
 # DEFAULT_GFS_DATA_URL = 'ftp://ftpprd.ncep.noaa.gov/pub/data/nccf/com/gfs/prod/gfs.YYYYMMDDCC/'
 DEFAULT_GFS_DATA_URL = 'http://www.ftp.ncep.noaa.gov/data/nccf/com/gfs/prod/gfs.YYYYMMDDCC/'
+# gfs_url can also be a list of the above mirrors, in the order of preference
 DEFAULT_GFS_DATA_INV = 'gfs.tCCz.pgrb2.RRRR.fFFF'
 DEFAULT_THREAD_COUNT = 8
 DEFAULT_RETRIES = 5
 DEFAULT_DELAY_S = 60
+DEFAULT_HEDGE_DELAY_S = 120
+DEFAULT_GFS_TIMEOUT_S = 600
+DEFAULT_GFS_MIN_SPEED_KBPS = 10
+DEFAULT_STALL_WINDOW_S = 30
+DEFAULT_POLL_INTERVAL_S = 30
+DEFAULT_MAX_POLL_INTERVAL_S = 300
+DEFAULT_WATCH_TIMEOUT_S = 3 * 60 * 60
 DEFAULT_CYCLE = '00'
 DEFAULT_RES = '0p50'
 DEFAULT_PERIOD = 3
 DEFAULT_STEP = 3
+DEFAULT_GFS_CACHE_SIZE_GB = 20
+# GRIB2 records (VAR:level regex) used by ungrib with Vtable.NAM, downloaded when gfs_subset is enabled
+DEFAULT_GFS_FIELDS = [r'HGT:\d+ mb', r'TMP:\d+ mb', r'RH:\d+ mb', r'UGRD:\d+ mb', r'VGRD:\d+ mb',
+                      'HGT:surface', 'PRES:surface', 'TMP:surface', 'LAND:surface', 'ICEC:surface', 'WEASD:surface',
+                      'SNOD:surface', 'PRMSL:mean sea level', 'MSLET:mean sea level', 'TMP:2 m above ground',
+                      'RH:2 m above ground', 'SPFH:2 m above ground', 'UGRD:10 m above ground',
+                      'VGRD:10 m above ground', r'TSOIL:[\d.]+-[\d.]+ m below ground',
+                      r'SOILW:[\d.]+-[\d.]+ m below ground']
+# variables which should be present in every GFS inventory, checked by the validation before WPS
+DEFAULT_GFS_REQUIRED_VARS = ['HGT', 'TMP', 'RH', 'UGRD', 'VGRD', 'PRMSL']
+
+
+# variables kept in the wrfout files when wrfout_slim is enabled, the ones read by the extraction
+DEFAULT_WRFOUT_VARS = ['Times', 'XLAT', 'XLONG', 'RAINC', 'RAINNC', 'SNOWNC', 'GRAUPELNC']
+DEFAULT_WRFOUT_COMPLEVEL = 4
+# time steps of the wrfout files read at once by the extraction
+DEFAULT_EXTRACT_CHUNK_SIZE = 24
 
 
 DEFAULT_EM_REAL_PATH = 'WRFV3/test/em_real/'
 DEFAULT_WPS_PATH = 'WPS/'
 DEFAULT_PROCS = 4
+DEFAULT_GEOGRID_CACHE_SIZE = 5
 DEFAULT_NAMELIST_INPUT_TEMPLATE = 'namelist.input'
 DEFAULT_NAMELIST_WPS_TEMPLATE = 'namelist.wps'
+# files written by each run, which are not linked from the shared dirs into the run dirs
+WPS_RUN_FILES = ['namelist.wps', 'namelist.wps.*', 'FILE:*', 'PFILE:*', 'GRIBFILE.*', 'met_em*', 'geo_em*', '*.log']
+EM_REAL_RUN_FILES = ['namelist.input', 'namelist.output', 'met_em*', 'rsl.*', 'wrfout*', 'wrfinput*', 'wrfbdy*',
+                     'wrfrst*', 'wrflowinp*']
+# intermediate files of an isolated run, removed from its run dirs once the outputs are collected with run_cleanup
+WPS_INTERMEDIATE_FILES = ['FILE:*', 'PFILE:*', 'GRIBFILE.*', 'met_em*', 'geo_em*']
+EM_REAL_INTERMEDIATE_FILES = ['met_em*', 'wrfinput*', 'wrfbdy*', 'wrfrst*', 'wrflowinp*']
 
 
 LOGGING_ENV_VAR = 'LOG_YAML'
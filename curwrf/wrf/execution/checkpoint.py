@@ -0,0 +1,97 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# files smaller than this are hashed by their content, larger ones (GRIB, met_em, wrfinput) by their size and mtime
+CONTENT_HASH_MAX_SIZE = 1024 * 1024
+
+
+def get_files_hash(patterns, values=None):
+    """
+    :param patterns: list of file paths or glob patterns
+    :param values: optional json serializable values, ex: config values affecting the stage
+    :return: hash of the matching files and the values. missing files are part of the hash
+    """
+    h = hashlib.md5()
+    h.update(json.dumps(values, sort_keys=True))
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern))
+        if len(paths) == 0:
+            h.update('missing:%s\n' % pattern)
+        for path in paths:
+            size = os.path.getsize(path)
+            if size <= CONTENT_HASH_MAX_SIZE:
+                with open(path, 'rb') as f:
+                    h.update('%s:%s\n' % (os.path.basename(path), hashlib.md5(f.read()).hexdigest()))
+            else:
+                h.update('%s:%d:%f\n' % (os.path.basename(path), size, os.path.getmtime(path)))
+    return h.hexdigest()
+
+
+class StageCheckpoints:
+    """
+    Completion markers of the stages of a run. A stage is skipped if it completed with the same hash of its inputs
+    and its outputs are unchanged since. Since the outputs of a stage are the inputs of the next, re-running a stage
+    makes the following stages stale as well.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: json file of the markers
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                logging.warning('Unable to read the checkpoints %s. Running all the stages' % self.path)
+                return {}
+
+    def _save(self, markers):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(markers, f, indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+    def is_complete(self, stage, inputs, outputs=(), values=None):
+        with self.lock:
+            marker = self._load().get(stage)
+        return marker is not None and marker['inputs'] == get_files_hash(inputs, values) and \
+            marker['outputs'] == get_files_hash(outputs)
+
+    def run(self, stage, fn, inputs, outputs=(), values=None):
+        """
+        runs the fn() of the stage, unless it is complete
+        :param inputs: list of input file paths or glob patterns
+        :param outputs: list of output file paths or glob patterns
+        :param values: optional json serializable values affecting the stage
+        :return: True if the stage was run, False if it was skipped
+        """
+        inputs_hash = get_files_hash(inputs, values)
+        if self.is_complete(stage, inputs, outputs, values):
+            logging.info('Stage %s is complete. Skipping' % stage)
+            return False
+
+        logging.info('Running stage %s' % stage)
+        with self.lock:
+            markers = self._load()
+            markers.pop(stage, None)
+            self._save(markers)
+
+        start_time = time.time()
+        fn()
+
+        with self.lock:
+            markers = self._load()
+            markers[stage] = {'inputs': inputs_hash, 'outputs': get_files_hash(outputs), 'time': time.time(),
+                              'elapsed': time.time() - start_time}
+            self._save(markers)
+        return True
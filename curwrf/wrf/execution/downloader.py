@@ -0,0 +1,1053 @@
+import BaseHTTPServer
+import Queue
+import SocketServer
+import ftplib
+import hashlib
+import httplib
+import logging
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+CHUNK_SIZE = 64 * 1024
+PART_SUFFIX = '.part'
+MAX_IDLE_CONNECTIONS_PER_HOST = 8
+MAX_REDIRECTS = 5
+SOCKET_TIMEOUT_S = 60
+DEFAULT_HEDGE_DELAY_S = 120
+HEDGE_FACTOR = 2
+DEFAULT_STALL_WINDOW_S = 30
+STALL_RETRIES = 3
+WATCHDOG_INTERVAL_S = 1
+
+
+class DownloadResult:
+    def __init__(self, url, dest):
+        self.url = url
+        self.dest = dest
+        self.size = 0
+        self.elapsed = 0.0
+        self.error = None
+        self.stalls = 0
+        self.aborts = 0
+
+    def is_success(self):
+        return self.error is None
+
+    def get_throughput(self):
+        """
+        :return: throughput of the download in bytes/s
+        """
+        return self.size / self.elapsed if self.elapsed > 0 else 0.0
+
+    def to_string(self):
+        stalls = ', %d stalls, %d aborts' % (self.stalls, self.aborts) if self.stalls + self.aborts > 0 else ''
+        if self.is_success():
+            return '%s : %d bytes in %f s (%f KB/s)%s' % (self.url, self.size, self.elapsed,
+                                                          self.get_throughput() / 1024, stalls)
+        return '%s : FAILED %s%s' % (self.url, str(self.error), stalls)
+
+
+_context = threading.local()
+_context_lock = threading.Lock()
+
+
+def get_current_result():
+    """
+    :return: DownloadResult of the download running in the current thread, if any
+    """
+    return getattr(_context, 'result', None)
+
+
+def set_current_result(result):
+    _context.result = result
+
+
+def _record_stall(deadline_exceeded):
+    result = get_current_result()
+    if result is not None:
+        with _context_lock:
+            if deadline_exceeded:
+                result.aborts += 1
+            else:
+                result.stalls += 1
+
+
+class DownloadWorkerThread(threading.Thread):
+    def __init__(self, thread_id, download_fn, tasks, results):
+        threading.Thread.__init__(self, name='download-%d' % thread_id)
+        self.thread_id = thread_id
+        self.download_fn = download_fn
+        self.tasks = tasks
+        self.results = results
+
+    def run(self):
+        while True:
+            try:
+                result = self.tasks.get_nowait()
+            except Queue.Empty:
+                return
+
+            logging.debug('Downloading %s from thread %d: START' % (result.url, self.thread_id))
+            start_time = time.time()
+            set_current_result(result)
+            try:
+                self.download_fn(result.url, result.dest)
+                result.size = os.path.getsize(result.dest) if os.path.exists(result.dest) else 0
+            except Exception as e:
+                result.error = e
+            set_current_result(None)
+            result.elapsed = time.time() - start_time
+            logging.debug('Downloading %s from thread %d: END' % (result.url, self.thread_id))
+
+            self.results.append(result)
+            self.tasks.task_done()
+
+
+class DownloadPool:
+    """
+    A bounded pool of download threads fed from a single work queue. Each thread picks the next (url, dest) pair as
+    soon as its current download finishes, hence a slow download does not hold up the rest of the list.
+    """
+
+    def __init__(self, download_fn, threads):
+        """
+        :param download_fn: callable(url, dest) which downloads a single file and raises an exception on failure
+        :param threads: max num. of parallel downloads
+        """
+        self.download_fn = download_fn
+        self.threads = threads
+
+    def download(self, url_dest_list):
+        """
+        :param url_dest_list: list of (url, dest) tuples
+        :return: DownloadStats of all the downloads
+        """
+        tasks = Queue.Queue()
+        for url, dest in url_dest_list:
+            tasks.put(DownloadResult(url, dest))
+
+        results = []
+        workers = [DownloadWorkerThread(i, self.download_fn, tasks, results) for i in
+                   range(0, min(self.threads, len(url_dest_list)))]
+
+        start_time = time.time()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        return DownloadStats(results, time.time() - start_time)
+
+
+class DownloadStats:
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    def get_failures(self):
+        return [r for r in self.results if not r.is_success()]
+
+    def get_total_size(self):
+        return sum(r.size for r in self.results if r.is_success())
+
+    def get_throughput(self):
+        """
+        :return: aggregate throughput of all the downloads in bytes/s
+        """
+        return self.get_total_size() / self.elapsed if self.elapsed > 0 else 0.0
+
+    def get_stalls(self):
+        return sum(r.stalls for r in self.results)
+
+    def get_aborts(self):
+        return sum(r.aborts for r in self.results)
+
+    def to_string(self):
+        return '%d files, %d failed, %d bytes in %f s (%f KB/s), %d stalls, %d aborts\n%s' % (
+            len(self.results), len(self.get_failures()), self.get_total_size(), self.elapsed,
+            self.get_throughput() / 1024, self.get_stalls(), self.get_aborts(),
+            '\n'.join(r.to_string() for r in self.results))
+
+
+class HttpResponse:
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+
+    def getcode(self):
+        return self.response.status
+
+    def getheader(self, name):
+        return self.response.getheader(name)
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def abort(self):
+        """
+        shuts down the socket, so that a read blocked in another thread returns. the connection is not reused
+        """
+        if self.conn is not None and self.conn.sock is not None:
+            try:
+                self.conn.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def close(self):
+        """
+        returns the connection to the pool if the response was fully read and the server keeps the connection alive
+        """
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+
+
+class FtpResponse:
+    """
+    mimics an HTTP response for an FTP RETR, so that the callers can use Range/Content-Range semantics. the transfer
+    is restarted from the requested offset with REST
+    """
+
+    def __init__(self, pool, key, ftp, sock, offset, total):
+        self.pool = pool
+        self.key = key
+        self.ftp = ftp
+        self.sock = sock
+        self.fp = sock.makefile('rb')
+        self.offset = offset
+        self.total = total
+        self.eof = False
+
+    def getcode(self):
+        return 206 if self.offset > 0 else 200
+
+    def getheader(self, name):
+        name = name.lower()
+        if name == 'content-length' and self.total is not None:
+            return str(self.total - self.offset)
+        if name == 'content-range' and self.offset > 0:
+            return 'bytes %d-%s/%s' % (self.offset, '*' if self.total is None else str(self.total - 1),
+                                       '*' if self.total is None else str(self.total))
+        return None
+
+    def read(self, amt=None):
+        data = self.fp.read() if amt is None else self.fp.read(amt)
+        if not data or amt is None:
+            self.eof = True
+        return data
+
+    def abort(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self):
+        """
+        returns the logged in FTP session to the pool if the transfer completed
+        """
+        if self.ftp is None:
+            return
+        self.fp.close()
+        self.sock.close()
+        try:
+            if not self.eof:
+                raise ftplib.Error('transfer aborted')
+            self.ftp.voidresp()
+            self.pool.release(self.key, self.ftp)
+        except (ftplib.Error, socket.error, EOFError):
+            self.ftp.close()
+        self.ftp = None
+
+
+class ConnectionPool:
+    """
+    Keeps idle keep-alive HTTP connections and logged in FTP sessions per host, so that consecutive downloads from the
+    same host do not pay for a new TCP connection, handshake or login. Thread safe.
+    """
+
+    def __init__(self, max_idle_per_host=MAX_IDLE_CONNECTIONS_PER_HOST, timeout=SOCKET_TIMEOUT_S):
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _acquire(self, key, create_fn, fresh=False):
+        """
+        :param fresh: if True, a new connection is created even if there are idle connections
+        :return: (connection, True if it was reused from the pool)
+        """
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns and not fresh:
+                self.reused += 1
+                return conns.pop(), True
+            self.created += 1
+        return create_fn(), False
+
+    def release(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self.lock:
+            conns = [c for cs in self.idle.values() for c in cs]
+            self.idle = {}
+        for c in conns:
+            c.close()
+
+    def open(self, url, headers=None, fresh=False):
+        """
+        sends a GET request for the url using a pooled connection
+        :param headers: request headers. for ftp urls, only 'Range: bytes=N-' is supported
+        :param fresh: if True, a new connection is used, ex: to retry a transfer stalled on a pooled connection
+        :return: HttpResponse or FtpResponse. the caller should close it to return the connection to the pool
+        """
+        scheme = urlparse.urlsplit(url).scheme
+        if scheme in ('http', 'https'):
+            return self._open_http(url, headers or {}, MAX_REDIRECTS, fresh)
+        elif scheme == 'ftp':
+            return self._open_ftp(url, headers or {}, fresh)
+        raise ValueError('Unsupported url %s' % url)
+
+    def _open_http(self, url, headers, redirects, fresh=False):
+        u = urlparse.urlsplit(url)
+        key = (u.scheme, u.hostname, u.port)
+        path = (u.path or '/') + ('?' + u.query if u.query else '')
+        conn_class = httplib.HTTPSConnection if u.scheme == 'https' else httplib.HTTPConnection
+
+        while True:
+            conn, reused = self._acquire(key, lambda: conn_class(u.hostname, u.port, timeout=self.timeout), fresh)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = HttpResponse(self, key, conn, conn.getresponse())
+                break
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # an idle connection could have been closed by the server. retry with a fresh connection
+                if not reused:
+                    raise
+
+        code = response.getcode()
+        if code in (301, 302, 303, 307, 308) and redirects > 0:
+            location = urlparse.urljoin(url, response.getheader('Location'))
+            response.read()
+            response.close()
+            return self._open_http(location, headers, redirects - 1, fresh)
+        if code >= 400:
+            error = HttpError(url, code, dict(response.response.getheaders()))
+            response.read()
+            response.close()
+            raise error
+        return response
+
+    def _open_ftp(self, url, headers, fresh=False):
+        u = urlparse.urlsplit(url)
+        key = (u.hostname, u.port, u.username, u.password)
+
+        def login():
+            ftp = ftplib.FTP(timeout=self.timeout)
+            ftp.connect(u.hostname, u.port or ftplib.FTP_PORT)
+            ftp.login(u.username or 'anonymous', u.password or '')
+            return ftp
+
+        m = re.match(r'bytes=(\d+)-$', headers.get('Range', 'bytes=0-'))
+        offset = int(m.group(1)) if m else 0
+
+        while True:
+            ftp, reused = self._acquire(key, login, fresh)
+            try:
+                ftp.voidcmd('TYPE I')
+                try:
+                    total = ftp.size(u.path)
+                except ftplib.error_perm:
+                    total = None
+                if total is not None and offset >= total > 0:
+                    self.release(key, ftp)
+                    raise HttpError(url, 416, {'content-range': 'bytes */%d' % total})
+                sock = ftp.transfercmd('RETR ' + u.path, rest=offset if offset > 0 else None)
+                return FtpResponse(self, key, ftp, sock, offset, total)
+            except ftplib.error_perm:
+                # ex: 550 for a missing file. the session is still logged in
+                self.release(key, ftp)
+                raise
+            except (ftplib.error_temp, ftplib.error_reply, socket.error, EOFError):
+                ftp.close()
+                if not reused:
+                    raise
+
+    def to_string(self):
+        return '%d connections created, %d reused' % (self.created, self.reused)
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+
+class TransferMonitor:
+    """
+    Tracks the progress of a single transfer against a deadline and a throughput floor. The watchdog aborts the
+    response of a transfer which breaks either limit, so that a read blocked in a worker thread returns.
+    """
+
+    def __init__(self, url, deadline=None, min_speed=None, window=DEFAULT_STALL_WINDOW_S, start_time=None):
+        """
+        :param deadline: max seconds for the transfer. None for no deadline
+        :param min_speed: min bytes/s averaged over the window. None for no floor
+        :param window: seconds over which the throughput is averaged
+        :param start_time: start of the deadline, ex: the first attempt of a resumed transfer
+        """
+        self.url = url
+        self.deadline = deadline
+        self.min_speed = min_speed
+        self.window = window
+        self.start_time = start_time if start_time is not None else time.time()
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.response = None
+        self.reason = None
+        self.lock = threading.Lock()
+
+    def is_enabled(self):
+        return self.deadline is not None or self.min_speed is not None
+
+    def set_response(self, response):
+        with self.lock:
+            self.response = response
+            self.window_start = time.time()
+            self.window_bytes = 0
+
+    def update(self, size):
+        with self.lock:
+            self.window_bytes += size
+
+    def check(self, now):
+        """
+        aborts the response if the transfer has exceeded the deadline or stalled below the throughput floor
+        :return: the reason, if the transfer was aborted
+        """
+        with self.lock:
+            if self.reason is not None or self.response is None:
+                return self.reason
+            if self.deadline is not None and now - self.start_time > self.deadline:
+                self.reason = 'deadline of %d s exceeded' % self.deadline
+            elif self.min_speed is not None and now - self.window_start >= self.window:
+                speed = self.window_bytes / (now - self.window_start)
+                if speed < self.min_speed:
+                    self.reason = 'stalled at %f KB/s' % (speed / 1024)
+                else:
+                    self.window_start = now
+                    self.window_bytes = 0
+            if self.reason is not None:
+                self.response.abort()
+            return self.reason
+
+    def is_deadline_exceeded(self):
+        return self.deadline is not None and time.time() - self.start_time > self.deadline
+
+
+class TransferWatchdog(threading.Thread):
+    """
+    A daemon thread checking the registered TransferMonitors every WATCHDOG_INTERVAL_S. Unlike signal based timeouts,
+    this works for the transfers running in worker threads
+    """
+
+    def __init__(self, interval=WATCHDOG_INTERVAL_S):
+        threading.Thread.__init__(self, name='download-watchdog')
+        self.daemon = True
+        self.interval = interval
+        self.monitors = set()
+        self.lock = threading.Lock()
+
+    def register(self, monitor):
+        with self.lock:
+            self.monitors.add(monitor)
+
+    def unregister(self, monitor):
+        with self.lock:
+            self.monitors.discard(monitor)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                monitors = list(self.monitors)
+            now = time.time()
+            for monitor in monitors:
+                reason = monitor.check(now)
+                if reason is not None:
+                    self.unregister(monitor)
+                    logging.warning('Aborting the transfer of %s : %s' % (monitor.url, reason))
+
+
+_watchdog = None
+_watchdog_lock = threading.Lock()
+
+
+def get_watchdog():
+    global _watchdog
+    with _watchdog_lock:
+        if _watchdog is None:
+            _watchdog = TransferWatchdog()
+            _watchdog.start()
+        return _watchdog
+
+
+def read_monitored(response, monitor, write_fn, cancel_event=None):
+    """
+    reads the response in chunks, passing each to the write_fn. the transfer is watched by the watchdog if the monitor
+    has limits
+    :raise DownloadStalled: if the watchdog aborted the transfer
+    """
+    if monitor is None or not monitor.is_enabled():
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            write_fn(chunk)
+        return
+
+    monitor.set_response(response)
+    watchdog = get_watchdog()
+    watchdog.register(monitor)
+    try:
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            write_fn(chunk)
+            monitor.update(len(chunk))
+    except (socket.error, httplib.HTTPException, EOFError):
+        if monitor.reason is None:
+            raise
+    finally:
+        watchdog.unregister(monitor)
+
+    if monitor.reason is not None:
+        stalled = DownloadStalled(monitor.url, monitor.reason, monitor.is_deadline_exceeded())
+        _record_stall(stalled.deadline_exceeded)
+        raise stalled
+
+
+def get_part_file(dest):
+    return dest + PART_SUFFIX
+
+
+def get_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def parse_content_range(content_range):
+    """
+    :param content_range: Content-Range header value, ex: 'bytes 100-199/1000' or 'bytes */1000'
+    :return: (start, total) where either could be None if it is unknown
+    """
+    m = re.match(r'bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)', content_range or '')
+    if m is None:
+        return None, None
+    start = int(m.group(1)) if m.group(1) is not None else None
+    total = int(m.group(2)) if m.group(2) != '*' else None
+    return start, total
+
+
+def _open_from_offset(pool, url, offset, fresh=False):
+    """
+    opens the url to read from the byte offset. the server is asked for the remaining bytes with a Range request
+    :param fresh: if True, a new connection is used
+    :return: (response, offset the response starts from, expected total size or None)
+    """
+    if offset > 0:
+        try:
+            response = pool.open(url, {'Range': 'bytes=%d-' % offset}, fresh)
+        except HttpError as e:
+            if e.code != 416:
+                raise
+            # range not satisfiable: the part file is either already complete or larger than the remote file
+            _, total = parse_content_range(e.getheader('Content-Range'))
+            return None, offset, total
+
+        if response.getcode() == 206:
+            start, total = parse_content_range(response.getheader('Content-Range'))
+            if start == offset:
+                return response, offset, total
+            logging.warning('Server returned an unexpected range for %s. Restarting the download' % url)
+            response.close()
+        else:
+            logging.info('Server does not support ranges for %s. Restarting the download' % url)
+            length = response.getheader('Content-Length')
+            return response, 0, int(length) if length is not None else None
+
+    response = pool.open(url, fresh=fresh)
+    length = response.getheader('Content-Length')
+    return response, 0, int(length) if length is not None else None
+
+
+def download_resumable(url, dest, md5=None, validate_fn=None, pool=None, part=None, cancel_event=None,
+                       deadline=None, min_speed=None, stall_window=DEFAULT_STALL_WINDOW_S):
+    """
+    downloads the url to a .part file next to the dest and renames it to dest only after the download is confirmed to
+    be complete. If a .part file is already available (from a previous failed attempt), the download is resumed from
+    its end.
+    :param url: source url
+    :param dest: destination file path
+    :param md5: expected md5 hex digest of the file, if known
+    :param validate_fn: optional callable(path) -> bool to validate the content of the .part file before renaming
+    :param pool: ConnectionPool to use. default pool is used if None
+    :param part: path of the part file. <dest>.part if None
+    :param cancel_event: optional threading.Event. the download is cancelled and the part file is removed once it is set
+    :param deadline: max seconds for the download, including the retries of stalled transfers. None for no deadline
+    :param min_speed: min bytes/s over the stall_window. a stalled transfer is resumed on a fresh connection, up to
+    STALL_RETRIES times. None for no floor
+    :param stall_window: seconds over which the throughput is averaged
+    :return: size of the downloaded file in bytes
+    """
+    pool = pool if pool is not None else get_default_pool()
+    part = part if part is not None else get_part_file(dest)
+    start_time = time.time()
+    for attempt in range(STALL_RETRIES + 1):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset > 0:
+            logging.info('Resuming %s from byte %d' % (url, offset))
+
+        monitor = TransferMonitor(url, deadline, min_speed, stall_window, start_time)
+        response, offset, total = _open_from_offset(pool, url, offset, fresh=attempt > 0)
+        if response is None:
+            break
+        try:
+            with open(part, 'ab' if offset > 0 else 'wb') as f:
+                f.truncate(offset)
+                read_monitored(response, monitor, f.write, cancel_event)
+            break
+        except DownloadStalled as e:
+            if e.deadline_exceeded or attempt == STALL_RETRIES:
+                raise
+            logging.info('Retrying %s on a fresh connection' % url)
+        finally:
+            response.close()
+
+    if cancel_event is not None and cancel_event.is_set():
+        os.remove(part)
+        raise DownloadCancelled(url)
+
+    size = os.path.getsize(part)
+    if total is not None and size != total:
+        if size > total:
+            os.remove(part)
+        raise IncompleteDownload(url, size, total)
+
+    if md5 is not None and get_md5(part) != md5:
+        os.remove(part)
+        raise CorruptedDownload(url, 'md5 mismatch')
+
+    if validate_fn is not None and not validate_fn(part):
+        os.remove(part)
+        raise CorruptedDownload(url, 'validation failed')
+
+    os.rename(part, dest)
+    return size
+
+
+def fetch_all(url_dest_list, threads, pool=None, overwrite=False):
+    """
+    synchronous entry point of the download engine. downloads all the (url, dest) pairs with at most `threads`
+    concurrent transfers, sharing the pooled connections of each host
+    :param overwrite: if False, files already available at the dest are not downloaded again
+    :return: DownloadStats
+    """
+    pool = pool if pool is not None else get_default_pool()
+
+    def fetch(url, dest):
+        if not overwrite and os.path.exists(dest):
+            logging.info('File %s already exists' % dest)
+            return
+        download_resumable(url, dest, pool=pool)
+
+    stats = DownloadPool(fetch, threads).download(url_dest_list)
+    logging.info('Fetched %d files: %s' % (len(url_dest_list), pool.to_string()))
+    return stats
+
+
+class MirrorSet:
+    """
+    An ordered list of mirrors serving the same files, with the observed throughput of each. New downloads are spread
+    across the mirrors in proportion to their throughput, preferring the earlier mirrors on ties.
+    """
+
+    def __init__(self, mirrors, hedge_delay=DEFAULT_HEDGE_DELAY_S):
+        """
+        :param mirrors: list of mirror base urls
+        :param hedge_delay: seconds to wait before hedging a download on another mirror, until the typical download
+        time of the mirror is known
+        """
+        self.mirrors = mirrors
+        self.hedge_delay = hedge_delay
+        self.throughput = [None] * len(mirrors)
+        self.elapsed = [None] * len(mirrors)
+        self.active = [0] * len(mirrors)
+        self.failures = [0] * len(mirrors)
+        self.lock = threading.Lock()
+
+    def choose(self, exclude=()):
+        """
+        :return: index of the mirror which is expected to finish a new download first, or None if all are excluded
+        """
+        with self.lock:
+            known = [t for t in self.throughput if t is not None]
+            default = max(known) if len(known) > 0 else 1.0
+            candidates = [i for i in range(len(self.mirrors)) if i not in exclude]
+            if len(candidates) == 0:
+                return None
+            mirror = min(candidates, key=lambda i: ((self.active[i] + 1) / (self.throughput[i] or default), i))
+            self.active[mirror] += 1
+            return mirror
+
+    def release(self, mirror, size=None, elapsed=None, failed=False):
+        """
+        records the end of a download from the mirror. throughput is tracked as an exponentially weighted average
+        """
+        with self.lock:
+            self.active[mirror] -= 1
+            if failed:
+                self.failures[mirror] += 1
+                if self.throughput[mirror] is not None:
+                    self.throughput[mirror] /= 2
+            elif size is not None and elapsed > 0:
+                t = size / elapsed
+                self.throughput[mirror] = t if self.throughput[mirror] is None else (self.throughput[mirror] + t) / 2
+                self.elapsed[mirror] = elapsed if self.elapsed[mirror] is None else (self.elapsed[mirror] + elapsed) / 2
+
+    def get_hedge_delay(self, mirror):
+        with self.lock:
+            if self.elapsed[mirror] is None:
+                return self.hedge_delay
+            return HEDGE_FACTOR * self.elapsed[mirror]
+
+    def to_string(self):
+        with self.lock:
+            return '\n'.join('%s : %s KB/s, %d failures' % (
+                m, 'unknown' if self.throughput[i] is None else '%f' % (self.throughput[i] / 1024), self.failures[i])
+                              for i, m in enumerate(self.mirrors))
+
+
+def download_hedged(urls, dest, mirror_set, download_fn):
+    """
+    downloads the file from the mirror expected to be the fastest. if the download does not finish within the
+    hedge delay of that mirror, the same file is requested from the next best mirror as well, and so on. the first
+    download to finish wins and the rest are cancelled. a failed download is failed over to an untried mirror. once
+    there is a winner, the part files of the other mirrors are removed
+    :param urls: url of the file at each mirror of the mirror_set
+    :param dest: destination file path
+    :param mirror_set: MirrorSet
+    :param download_fn: callable(url, dest, part, cancel_event) -> size, ex: download_resumable
+    :return: size of the downloaded file in bytes
+    """
+    cancel_event = threading.Event()
+    cond = threading.Condition()
+    state = {'winner': None, 'size': None, 'running': 0}
+    errors = []
+    tried = []
+    finished = []
+
+    result = get_current_result()
+
+    def get_part(mirror):
+        return '%s.%d' % (get_part_file(dest), mirror)
+
+    def remove_part(mirror):
+        # a failed download leaves its part file, to be resumed. not needed once another mirror has won
+        if os.path.exists(get_part(mirror)):
+            os.remove(get_part(mirror))
+
+    def race(mirror):
+        set_current_result(result)
+        start_time = time.time()
+        try:
+            size = download_fn(urls[mirror], dest, get_part(mirror), cancel_event)
+            mirror_set.release(mirror, size, time.time() - start_time)
+            with cond:
+                if state['winner'] is None:
+                    state['winner'] = mirror
+                    state['size'] = size
+                    cancel_event.set()
+        except DownloadCancelled:
+            mirror_set.release(mirror)
+        except Exception as e:
+            logging.warning('Download from mirror %s failed: %s' % (mirror_set.mirrors[mirror], str(e)))
+            mirror_set.release(mirror, failed=True)
+            errors.append(e)
+        finally:
+            with cond:
+                state['running'] -= 1
+                finished.append(mirror)
+                if state['winner'] not in (None, mirror):
+                    remove_part(mirror)
+                cond.notify_all()
+
+    def start(exclude):
+        mirror = mirror_set.choose(exclude)
+        if mirror is None:
+            return None
+        tried.append(mirror)
+        with cond:
+            state['running'] += 1
+        t = threading.Thread(target=race, args=(mirror,), name='%s-mirror-%d' % (threading.current_thread().name,
+                                                                                     mirror))
+        # cancelled downloads are left to stop on their own once the winner is found
+        t.daemon = True
+        t.start()
+        return t
+
+    start(())
+    last_start = time.time()
+    with cond:
+        while state['winner'] is None:
+            if state['running'] == 0 or time.time() - last_start >= mirror_set.get_hedge_delay(tried[-1]):
+                running = state['running']
+                if start(tried) is not None:
+                    logging.info('Download of %s %s on another mirror' % (
+                        dest, 'slow. Hedging' if running > 0 else 'failed. Retrying'))
+                elif running == 0:
+                    break
+                last_start = time.time()
+            cond.wait(1)
+
+        if state['winner'] is not None:
+            # the running downloads remove their part files as they are cancelled, or on failure
+            for mirror in finished:
+                if mirror != state['winner']:
+                    remove_part(mirror)
+
+    if state['winner'] is None:
+        raise errors[-1]
+    logging.info('Downloaded %s from mirror %s' % (dest, mirror_set.mirrors[state['winner']]))
+    return state['size']
+
+
+class HttpError(Exception):
+    def __init__(self, url, code, headers):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        Exception.__init__(self, 'HTTP Error %d : %s' % (code, url))
+
+    def getheader(self, name):
+        return self.headers.get(name.lower())
+
+
+class DownloadCancelled(Exception):
+    def __init__(self, url):
+        self.url = url
+        Exception.__init__(self, 'Download cancelled %s' % url)
+
+
+class DownloadStalled(Exception):
+    def __init__(self, url, reason, deadline_exceeded=False):
+        self.url = url
+        self.reason = reason
+        self.deadline_exceeded = deadline_exceeded
+        Exception.__init__(self, 'Download aborted %s : %s' % (url, reason))
+
+
+class IncompleteDownload(Exception):
+    def __init__(self, url, size, expected_size):
+        self.url = url
+        self.size = size
+        self.expected_size = expected_size
+        Exception.__init__(self, 'Incomplete download %s : %d of %d bytes' % (url, size, expected_size))
+
+
+class CorruptedDownload(Exception):
+    def __init__(self, url, msg):
+        self.url = url
+        self.msg = msg
+        Exception.__init__(self, 'Corrupted download %s : %s' % (url, msg))
+
+
+class _FileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    serves the files of a LocalHttpServer, with single and multiple byte ranges
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+
+        m = re.match(r'bytes=(.+)$', self.headers.get('Range') or '')
+        if m is None:
+            self._send(200, data, {'Content-Type': 'application/octet-stream'})
+            return
+        ranges = []
+        for spec in m.group(1).split(','):
+            start, end = spec.strip().split('-')
+            ranges.append((int(start), min(int(end), len(data) - 1) if end else len(data) - 1))
+        if any(start >= len(data) for start, _ in ranges):
+            self._send(416, '', {'Content-Range': 'bytes */%d' % len(data)})
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self._send(206, data[start:end + 1], {'Content-Type': 'application/octet-stream',
+                                                  'Content-Range': 'bytes %d-%d/%d' % (start, end, len(data))})
+        else:
+            self._send_multipart(data, ranges)
+
+    def _send_multipart(self, data, ranges):
+        boundary = 'local-http-server-boundary'
+        part = '--%s\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes %d-%d/%d\r\n\r\n%s\r\n'
+        body = ''.join(part % (boundary, start, end, len(data), data[start:end + 1]) for start, end in ranges) + \
+            '--%s--\r\n' % boundary
+        self._send(206, body, {'Content-Type': 'multipart/byteranges; boundary=%s' % boundary})
+
+    def _send(self, code, body, headers):
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            for i in range(0, len(body), self.server.chunk_size):
+                if self.server.chunk_delay > 0:
+                    time.sleep(self.server.chunk_delay)
+                self.wfile.write(body[i:i + self.server.chunk_size])
+            self.wfile.flush()
+        except socket.error:
+            # the client went away, ex: a cancelled download
+            self.close_connection = 1
+
+    def log_message(self, fmt, *args):
+        logging.debug('%s %s' % (self.server.get_url(''), fmt % args))
+
+
+class LocalHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local HTTP stand-in for a GFS or JAXA server, serving in-memory files, optionally throttled. Used by the tests
+    """
+    daemon_threads = True
+
+    def __init__(self, files, chunk_size=CHUNK_SIZE, chunk_delay=0):
+        """
+        :param files: dict of path -> content, ex: {'/gfs.t00z.pgrb2.0p50.f000': '...'}
+        :param chunk_delay: seconds to wait before sending each chunk_size bytes of a response
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _FileRequestHandler)
+        self.files = files
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.requests = []
+        self.thread = None
+
+    def get_url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='local-http-%d' % self.server_address[1])
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # ex: a broken pipe of a cancelled download
+        logging.debug('Error serving %s' % str(client_address))
+
+
+class TestDownloadHedged(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(1024 * 1024)
+        # ~13 s for the slow mirror, against well under a second for the fast one
+        self.slow = LocalHttpServer({'/gfs.f000': self.data}, chunk_size=16 * 1024, chunk_delay=0.2).start()
+        self.fast = LocalHttpServer({'/gfs.f000': self.data}).start()
+        self.urls = [self.slow.get_url('/gfs.f000'), self.fast.get_url('/gfs.f000')]
+        self.mirror_set = MirrorSet([self.slow.get_url(''), self.fast.get_url('')], hedge_delay=1)
+        self.pool = ConnectionPool()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp_dir, '20170610.gfs.f000')
+
+    def tearDown(self):
+        self.slow.stop()
+        self.fast.stop()
+        self.pool.close_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def wait_for_mirror(self, mirror, timeout=10):
+        end = time.time() + timeout
+        while self.mirror_set.active[mirror] > 0 and time.time() < end:
+            time.sleep(0.1)
+        self.assertEqual(self.mirror_set.active[mirror], 0)
+
+    def test_hedge_to_the_fast_mirror(self):
+        def download_fn(url, dest, part, cancel_event):
+            return download_resumable(url, dest, pool=self.pool, part=part, cancel_event=cancel_event)
+
+        size = download_hedged(self.urls, self.dest, self.mirror_set, download_fn)
+
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(size, len(self.data))
+        # the slow mirror is tried first, and the download is hedged on the fast one
+        self.assertEqual(len(self.slow.requests), 1)
+        self.assertEqual(len(self.fast.requests), 1)
+        self.assertIsNotNone(self.mirror_set.throughput[1])
+
+        # the slow download is cancelled, rather than failed, and its part file removed
+        self.wait_for_mirror(0)
+        self.assertIsNone(self.mirror_set.throughput[0])
+        self.assertEqual(self.mirror_set.failures, [0, 0])
+        self.assertFalse(os.path.exists(get_part_file(self.dest) + '.0'))
+        self.assertFalse(os.path.exists(get_part_file(self.dest) + '.1'))
+
+    def test_failed_mirror_part_removed(self):
+        def download_fn(url, dest, part, cancel_event):
+            if url == self.urls[0]:
+                with open(part, 'wb') as f:
+                    f.write(self.data[0:1024])
+                raise IncompleteDownload(url, 1024, len(self.data))
+            return download_resumable(url, dest, pool=self.pool, part=part, cancel_event=cancel_event)
+
+        download_hedged(self.urls, self.dest, self.mirror_set, download_fn)
+
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(self.mirror_set.failures, [1, 0])
+        self.assertEqual(os.listdir(self.tmp_dir), [os.path.basename(self.dest)])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(module)s %(levelname)s %(message)s')
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestDownloadHedged)
+    unittest.TextTestRunner(verbosity=2).run(suite)
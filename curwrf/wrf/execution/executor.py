@@ -1,40 +1,63 @@
 import datetime as dt
+import functools
+import glob
 import logging
+import multiprocessing
 import os
+import re
+import shutil
 import sys
+import tempfile
 import threading
 import time
-import numpy as np
-import wget
-import yaml
 
 from curwrf.wrf.resources import manager as res_mgr
 from curwrf.wrf import constants, utils
+from curwrf.wrf.execution import checkpoint, downloader, geogrid_cache, gfs_cache, gfs_poller, grib_check
+from curwrf.wrf.execution import grib_subset, mpi_tuner, rsl_monitor, scheduler
 
 
-def download_single_inventory(url, dest, retries=constants.DEFAULT_RETRIES, delay=constants.DEFAULT_DELAY_S):
-    # @utils.timeout(seconds=600)
-    def wget_download(url0, dest0):
+def download_single_inventory(url, dest, retries=constants.DEFAULT_RETRIES, delay=constants.DEFAULT_DELAY_S,
+                              fields=None, mirror_set=None, timeout=None, min_speed=None,
+                              stall_window=constants.DEFAULT_STALL_WINDOW_S):
+    """
+    :param url: inventory url, or a list of its urls at each mirror of the mirror_set
+    :param fields: if given, only the GRIB2 records matching these 'VAR:level' fields are downloaded using the .idx
+    :param mirror_set: downloader.MirrorSet to race the download across the mirrors
+    :param timeout: max seconds for each attempt. None for no deadline
+    :param min_speed: min bytes/s over the stall_window, below which the transfer is retried on a fresh connection
+    """
+
+    def fetch(url0, dest0, part=None, cancel_event=None):
+        if fields:
+            return grib_subset.download_subset(url0, dest0, fields, validate_fn=utils.is_grib2_file_complete,
+                                               part=part, cancel_event=cancel_event, deadline=timeout,
+                                               min_speed=min_speed, stall_window=stall_window)
+        return downloader.download_resumable(url0, dest0, validate_fn=utils.is_grib2_file_complete, part=part,
+                                             cancel_event=cancel_event, deadline=timeout, min_speed=min_speed,
+                                             stall_window=stall_window)
+
+    def resumable_download(url0, dest0):
         try:
-            wget.download(url0, out=dest0)
+            if mirror_set is not None:
+                downloader.download_hedged(url0, dest0, mirror_set, fetch)
+            else:
+                fetch(url0, dest0)
         except:
-            raise UnableToDownloadGfsData(sys.exc_info()[0])
+            raise UnableToDownloadGfsData(sys.exc_info()[1])
+        if not fields:
+            # for the record count check of validate_gfs_inventory. a subset download writes its own
+            grib_subset.download_idx(url0, dest0)
 
     logging.info('Downloading %s : START' % url)
     try_count = 1
     start_time = time.time()
     while try_count <= retries:
         try:
-            wget_download(url, dest)
+            resumable_download(url, dest)
             end_time = time.time()
             logging.info('Downloading %s : END Elapsed time: %f' % (url, end_time - start_time))
             return True
-        # except utils.TimeoutError as e:
-        #     logging.error('Download timer exceeded %d!' % e.timeout_s)
-        #     dl = url.split('/')[-1] + '*'
-        #     logging.error('Deleting the files %s' + dl)
-        #     utils.delete_files_with_prefix(dest, dl)
-        #     try_count = 1
         except UnableToDownloadGfsData as e:
             logging.error(
                 'Error in downloading %s Attempt %d : %s . Retrying in %d seconds' % (url, try_count, e.message, delay))
@@ -44,60 +67,96 @@ def download_single_inventory(url, dest, retries=constants.DEFAULT_RETRIES, dela
     raise UnableToDownloadGfsData(url)
 
 
-class InventoryDownloadThread(threading.Thread):
-    def __init__(self, thread_id, url, dest, retries, delay):
-        threading.Thread.__init__(self)
-        self.thread_id = thread_id
-        self.url = url
-        self.dest = dest
-        self.retries = retries
-        self.delay = delay
+def get_gfs_mirrors(gfs_url):
+    """
+    :param gfs_url: GFS url, a comma separated list of urls or a list of urls, in the order of preference
+    """
+    if isinstance(gfs_url, (list, tuple)):
+        return list(gfs_url)
+    return [u.strip() for u in gfs_url.split(',') if u.strip()]
 
-    def run(self):
-        try:
-            logging.debug('Downloading from thread %d: START' % self.thread_id)
-            download_single_inventory(self.url, self.dest, self.retries, self.delay)
-            logging.debug('Downloading from thread %d: END' % self.thread_id)
-        except UnableToDownloadGfsData:
-            logging.error('Error in downloading from thread %d' % self.thread_id)
 
+def get_gfs_cache(wrf_conf):
+    return gfs_cache.GfsCache(wrf_conf.get('gfs_dir'), int(wrf_conf.get('gfs_cache_size') * 1024 ** 3))
 
-def download_gfs_data(date, wrf_conf):
+
+def get_gfs_inventory_keys(date, wrf_conf):
+    fields = wrf_conf.get('gfs_fields') if wrf_conf.get('gfs_subset') else None
+    return [gfs_cache.get_key(date.strftime('%Y%m%d'), wrf_conf.get('gfs_cycle'), wrf_conf.get('gfs_res'), i, fields)
+            for i in utils.get_gfs_fcst_ids(wrf_conf.get('period'), wrf_conf.get('gfs_step'))]
+
+
+def download_gfs_data(date, wrf_conf, on_ready=None):
+    """
+    :param on_ready: optional callable(dest) called as soon as each inventory is available in the gfs_dir
+    """
     logging.info('Downloading GFS data: START')
 
     if wrf_conf.get('gfs_clean'):
         logging.info('Cleaning the GFS dir: %s' % wrf_conf.get('gfs_dir'))
         utils.cleanup_dir(wrf_conf.get('gfs_dir'))
 
-    inventories = utils.get_gfs_inventory_url_dest_list(date, wrf_conf.get('period'), wrf_conf.get('gfs_url'),
-                                                        wrf_conf.get('gfs_inv'), wrf_conf.get('gfs_step'),
-                                                        wrf_conf.get('gfs_cycle'), wrf_conf.get('gfs_res'),
-                                                        wrf_conf.get('gfs_dir'))
+    mirrors = get_gfs_mirrors(wrf_conf.get('gfs_url'))
+    mirror_inventories = [utils.get_gfs_inventory_url_dest_list(date, wrf_conf.get('period'), m,
+                                                                wrf_conf.get('gfs_inv'), wrf_conf.get('gfs_step'),
+                                                                wrf_conf.get('gfs_cycle'), wrf_conf.get('gfs_res'),
+                                                                wrf_conf.get('gfs_dir')) for m in mirrors]
+    inventories = mirror_inventories[0]
+    mirror_urls = dict((inv[1], [m[i][0] for m in mirror_inventories]) for i, inv in enumerate(inventories))
+    mirror_set = downloader.MirrorSet(mirrors, wrf_conf.get('gfs_hedge_delay')) if len(mirrors) > 1 else None
+
+    cache = get_gfs_cache(wrf_conf)
+    keys = get_gfs_inventory_keys(date, wrf_conf)
+    dest_keys = dict((inv[1], key) for inv, key in zip(inventories, keys))
+
+    cached = [inv for inv, key in zip(inventories, keys) if cache.get(key, inv[1]) is not None]
+    inventories = [inv for inv in inventories if inv not in cached]
+    logging.info('%d inventories found in the GFS cache' % len(cached))
+    if on_ready is not None:
+        for inv in cached:
+            on_ready(inv[1])
+
     gfs_threads = wrf_conf.get('gfs_threads')
     logging.info(
         'Following data will be downloaded in %d parallel threads\n%s' % (gfs_threads, '\n'.join(
             ' '.join(map(str, i)) for i in inventories)))
 
-    start_time = time.time()
-    inv_count = len(inventories)
-    logging.debug('Initializing threads')
-    for k in range(0, inv_count, gfs_threads):
-        threads = []
-        for j in range(0, gfs_threads):
-            i = k + j
-            if i < inv_count:
-                url0 = inventories[i][0]
-                dest0 = inventories[i][1]
-                thread = InventoryDownloadThread(i, url0, dest0, wrf_conf.get('gfs_retries'), wrf_conf.get('gfs_delay'))
-                thread.start()
-                threads.append(thread)
-
-        logging.debug('Joining threads')
-        for t in threads:
-            t.join()
-
-    elapsed_time = time.time() - start_time
-    logging.info('Downloading GFS data: END Elapsed time: %f' % elapsed_time)
+    fields = wrf_conf.get('gfs_fields') if wrf_conf.get('gfs_subset') else None
+    min_speed = wrf_conf.get('gfs_min_speed') * 1024 if wrf_conf.get('gfs_min_speed') else None
+
+    poller = None
+    if wrf_conf.get('gfs_watch'):
+        logging.info('Watching the GFS cycle for the inventories to be published')
+        poller = gfs_poller.GfsCyclePoller([inv[0] for inv in inventories], wrf_conf.get('gfs_poll_interval'),
+                                           wrf_conf.get('gfs_max_poll_interval'), wrf_conf.get('gfs_watch_timeout'))
+        poller.start()
+
+    def download_fn(url, dest):
+        if poller is not None and not poller.wait_for(url):
+            raise GfsDataUnavailable('Inventory not published', [url])
+        download_single_inventory(mirror_urls[dest] if mirror_set is not None else url, dest,
+                                  wrf_conf.get('gfs_retries'), wrf_conf.get('gfs_delay'), fields, mirror_set,
+                                  wrf_conf.get('gfs_timeout'), min_speed, wrf_conf.get('gfs_stall_window'))
+        cache.put(dest_keys[dest], dest)
+        if on_ready is not None:
+            on_ready(dest)
+
+    pool = downloader.DownloadPool(download_fn, gfs_threads)
+    stats = pool.download(inventories)
+
+    logging.info('Downloading GFS data: END %s\nConnections: %s' % (stats.to_string(),
+                                                                     downloader.get_default_pool().to_string()))
+    if mirror_set is not None:
+        logging.info('GFS mirrors\n%s' % mirror_set.to_string())
+
+    cache.evict(pinned=keys)
+
+    failures = stats.get_failures()
+    if len(failures) > 0:
+        logging.error('Unable to download %d inventories' % len(failures))
+        raise UnableToDownloadGfsData(', '.join(r.url for r in failures))
+
+    return stats
 
 
 def check_gfs_data_availability(date, wrf_config):
@@ -105,9 +164,11 @@ def check_gfs_data_availability(date, wrf_config):
     inventories = utils.get_gfs_inventory_dest_list(date, wrf_config.get('period'), wrf_config.get('gfs_inv'),
                                                     wrf_config.get('gfs_step'), wrf_config.get('gfs_cycle'),
                                                     wrf_config.get('gfs_res'), wrf_config.get('gfs_dir'))
+    cache = get_gfs_cache(wrf_config)
     missing_inv = []
-    for inv in inventories:
-        if not os.path.exists(inv):
+    for inv, key in zip(inventories, get_gfs_inventory_keys(date, wrf_config)):
+        if cache.get(key, inv) is None:
+            logging.error('Inventory %s is missing or truncated' % inv)
             missing_inv.append(inv)
 
     if len(missing_inv) > 0:
@@ -117,6 +178,53 @@ def check_gfs_data_availability(date, wrf_config):
     logging.info('GFS data available')
 
 
+def get_gfs_valid_times(date, wrf_config):
+    cycle_time = dt.datetime.strptime(date.strftime('%Y%m%d') + wrf_config.get('gfs_cycle'), '%Y%m%d%H')
+    return [cycle_time + dt.timedelta(hours=int(i)) for i in
+            utils.get_gfs_fcst_ids(wrf_config.get('period'), wrf_config.get('gfs_step'))]
+
+
+def validate_gfs_inventory(inv, valid_time, wrf_config):
+    """
+    scans the GRIB2 section headers of the inventory, and checks the num. of records against the .idx inventory
+    downloaded with it, if any. an invalid inventory is deleted, so that it is downloaded again
+    :return: True if the inventory is valid
+    """
+    try:
+        records = grib_check.validate_grib2(inv, valid_time, wrf_config.get('gfs_required_vars'),
+                                            grib_subset.count_idx_records(inv))
+        logging.debug('Inventory %s is valid with %d records' % (inv, len(records)))
+        return True
+    except grib_check.InvalidGribFile as e:
+        logging.error('%s. Deleting it' % str(e))
+        os.remove(inv)
+        return False
+
+
+def validate_gfs_data(date, wrf_config):
+    """
+    validates the downloaded inventories before any WPS compute is spent on them. invalid inventories are downloaded
+    again and validated once more
+    """
+    logging.info('Validating gfs data...')
+    inventories = utils.get_gfs_inventory_dest_list(date, wrf_config.get('period'), wrf_config.get('gfs_inv'),
+                                                    wrf_config.get('gfs_step'), wrf_config.get('gfs_cycle'),
+                                                    wrf_config.get('gfs_res'), wrf_config.get('gfs_dir'))
+    valid_times = get_gfs_valid_times(date, wrf_config)
+    invalid = [inv for inv, t in zip(inventories, valid_times) if not validate_gfs_inventory(inv, t, wrf_config)]
+    if len(invalid) == 0:
+        logging.info('GFS data valid')
+        return
+
+    logging.info('Downloading %d invalid inventories again' % len(invalid))
+    download_gfs_data(date, wrf_config)
+    invalid = [inv for inv, t in zip(inventories, valid_times) if
+               inv in invalid and not validate_gfs_inventory(inv, t, wrf_config)]
+    if len(invalid) > 0:
+        raise GfsDataUnavailable('Invalid data', invalid)
+    logging.info('GFS data valid')
+
+
 def check_geogrid_output(wps_dir):
     for i in range(1, 4):
         if not os.path.exists(os.path.join(wps_dir, 'geo_em.d%02d.nc' % i)):
@@ -124,10 +232,103 @@ def check_geogrid_output(wps_dir):
     return True
 
 
-def run_wps(wrf_home, start_date):
-    logging.info('Running WPS...')
-    wps_dir = utils.get_wps_dir(wrf_home)
+def get_wps_dir(wrf_config):
+    return wrf_config.get('wps_dir') or utils.get_wps_dir(wrf_config.get('wrf_home'))
+
+
+def get_em_real_dir(wrf_config):
+    return wrf_config.get('em_real_dir') or utils.get_em_real_dir(wrf_config.get('wrf_home'))
+
+
+def get_output_dir(wrf_config):
+    return wrf_config.get('output_dir') or utils.get_output_dir(wrf_config.get('wrf_home'))
+
 
+def get_logs_dir(wrf_config):
+    return wrf_config.get('logs_dir') or utils.get_logs_dir(wrf_config.get('wrf_home'))
+
+
+def get_run_dir(wrf_config, date):
+    """
+    :return: run dir of the date in wrf_home/runs, named by the run_id, or the process id if there is none
+    :raise ValueError: if isolated runs are resumed without a run_id, as a restarted process would not find the
+    checkpoints and the restart files of the earlier attempt in a run dir of its own
+    """
+    if wrf_config.get('isolated_runs') and wrf_config.get('resume_runs') and not wrf_config.get('run_id'):
+        raise ValueError('run_id is needed to resume isolated runs')
+    return os.path.join(utils.get_runs_dir(wrf_config.get('wrf_home')), '%s_%s_%s' % (
+        wrf_config.get('run_id') or os.getpid(), date.strftime('%Y%m%d'), wrf_config.get('gfs_cycle')))
+
+
+def create_run_config(wrf_config, date):
+    """
+    creates a scratch dir for a run of the date, with its own WPS and em_real dirs which link the executables, tables
+    and static data of the shared dirs. namelists, intermediate files, logs and outputs of the run stay in the scratch
+    dir, hence runs of overlapping dates, cycles or configurations do not interfere with each other. the wrfout files
+    stay in the OUTPUT dir of the run dir as well, and the shared OUTPUT dir links to them (see collect_outputs), hence
+    a run dir should not be removed while its outputs are in use. the intermediate files are removed by cleanup_run
+    :return: copy of the wrf_config pointing to the scratch dirs
+    """
+    wrf_home = wrf_config.get('wrf_home')
+    run_dir = get_run_dir(wrf_config, date)
+    logging.info('Creating the run dir %s' % run_dir)
+
+    run_config = WrfConfig(wrf_config.get_all())
+    run_config.set('run_dir', run_dir)
+    run_config.set('wps_dir', utils.create_linked_dir(utils.get_wps_dir(wrf_home), os.path.join(run_dir, 'WPS'),
+                                                      constants.WPS_RUN_FILES))
+    run_config.set('em_real_dir', utils.create_linked_dir(utils.get_em_real_dir(wrf_home),
+                                                          os.path.join(run_dir, 'em_real'),
+                                                          constants.EM_REAL_RUN_FILES))
+    run_config.set('output_dir', utils.create_dir_if_not_exists(os.path.join(run_dir, 'OUTPUT')))
+    run_config.set('logs_dir', utils.create_dir_if_not_exists(os.path.join(run_dir, 'logs')))
+    return run_config
+
+
+def cleanup_run(wrf_config, wps=True):
+    """
+    removes the intermediate files of an isolated run once its outputs are collected, if run_cleanup is set. the run
+    dir keeps the namelists, the logs and the wrfout files linked from the shared OUTPUT dir. runs in the shared dirs
+    are not cleaned, as their files are cleaned up by the next run
+    :param wps: if False, only the em_real dir is cleaned, ex: for an ensemble member reading the shared met_em files
+    """
+    if not wrf_config.get('run_dir') or not wrf_config.get('run_cleanup'):
+        return
+    dirs = [(get_em_real_dir(wrf_config), constants.EM_REAL_INTERMEDIATE_FILES)]
+    if wps:
+        dirs.append((get_wps_dir(wrf_config), constants.WPS_INTERMEDIATE_FILES))
+    for d, patterns in dirs:
+        logging.info('Removing the intermediate files of %s' % d)
+        for pattern in patterns:
+            utils.delete_files_with_prefix(d, pattern)
+
+
+def create_member_config(wrf_config, date, member):
+    """
+    creates the scratch dir of an ensemble member, with its own em_real dir. the member reads the met_em files of the
+    WPS dir of the wrf_config, which are shared by all the members
+    :param member: dict of the name, the namelist overrides (group -> key -> value) and optionally the procs
+    :return: copy of the wrf_config for the member
+    """
+    wrf_home = wrf_config.get('wrf_home')
+    member_dir = os.path.join(get_run_dir(wrf_config, date), 'members', member['name'])
+    logging.info('Creating the ensemble member dir %s' % member_dir)
+
+    member_config = WrfConfig(wrf_config.get_all())
+    member_config.set('ensemble_member', member['name'])
+    member_config.set('namelist_overrides', member.get('namelist'))
+    if member.get('procs'):
+        member_config.set('procs', member['procs'])
+    member_config.set('wps_dir', get_wps_dir(wrf_config))
+    member_config.set('em_real_dir', utils.create_linked_dir(utils.get_em_real_dir(wrf_home),
+                                                             os.path.join(member_dir, 'em_real'),
+                                                             constants.EM_REAL_RUN_FILES))
+    member_config.set('output_dir', utils.create_dir_if_not_exists(os.path.join(member_dir, 'OUTPUT')))
+    member_config.set('logs_dir', utils.create_dir_if_not_exists(os.path.join(member_dir, 'logs')))
+    return member_config
+
+
+def prepare_wps(wps_dir):
     logging.info('Cleaning up files')
     utils.delete_files_with_prefix(wps_dir, 'FILE:*')
     utils.delete_files_with_prefix(wps_dir, 'PFILE:*')
@@ -138,20 +339,192 @@ def run_wps(wrf_home, start_date):
         logging.info('Creating Vtable symlink')
         os.symlink(os.path.join(wps_dir, 'ungrib/Variable_Tables/Vtable.NAM'), os.path.join(wps_dir, 'Vtable'))
 
-    # Running link_grib.csh
-    utils.run_subprocess(
-        'csh link_grib.csh %s/%s' % (utils.get_gfs_dir(wrf_home), start_date.strftime('%Y%m%d')), cwd=wps_dir)
 
-    # Starting ungrib.exe
-    utils.run_subprocess('./ungrib.exe', cwd=wps_dir)
+def get_geogrid_cache(wrf_config):
+    return geogrid_cache.GeogridCache(utils.get_geogrid_cache_dir(wrf_config.get('wrf_home')),
+                                      wrf_config.get('geogrid_cache_size'))
 
-    # Starting geogrid.exe'
-    if not check_geogrid_output(wps_dir):
-        logging.info('Geogrid output not available')
+
+def run_geogrid(wps_dir, cache=None):
+    """
+    reuses the cached geogrid output of the domain settings in the namelist.wps, or runs geogrid.exe and caches its
+    output
+    :param cache: geogrid_cache.GeogridCache. if None, geogrid.exe runs only if the geo_em files are not available
+    :return: key of the cached geogrid output linked into the wps_dir, pinned till cache.unpin. None if cache is None
+    """
+    if cache is None:
+        if not check_geogrid_output(wps_dir):
+            logging.info('Geogrid output not available')
+            utils.run_subprocess('./geogrid.exe', cwd=wps_dir)
+        return None
+
+    key = geogrid_cache.get_key(os.path.join(wps_dir, 'namelist.wps'))
+    if cache.restore(key, wps_dir, pin=True):
+        logging.info('Reusing the cached geogrid output %s' % key)
+    else:
+        logging.info('Geogrid output of %s not available' % key)
+        utils.delete_files_with_prefix(wps_dir, geogrid_cache.GEO_EM_PREFIX)
         utils.run_subprocess('./geogrid.exe', cwd=wps_dir)
+        cache.put(key, wps_dir, pin=True)
+    cache.evict()
+    return key
+
+
+def run_geogrid_metgrid(wps_dir, cache=None):
+    # Starting geogrid.exe'
+    key = run_geogrid(wps_dir, cache)
 
     # Starting metgrid.exe'
-    utils.run_subprocess('./metgrid.exe', cwd=wps_dir)
+    try:
+        utils.run_subprocess('./metgrid.exe', cwd=wps_dir)
+    finally:
+        if key is not None:
+            # metgrid.exe was the last reader of the geo_em files
+            cache.unpin(key)
+
+
+def run_wps(wrf_config, start_date, wps_dir=None, cache=None):
+    logging.info('Running WPS...')
+    wps_dir = wps_dir if wps_dir is not None else get_wps_dir(wrf_config)
+
+    run_ungrib(wrf_config, start_date, wps_dir)
+    run_geogrid_metgrid(wps_dir, cache)
+
+
+def get_grib_file_name(i):
+    """
+    :return: name of the i th GRIB file link, as link_grib.csh names them. ex: GRIBFILE.AAA, GRIBFILE.AAB
+    """
+    return 'GRIBFILE.' + ''.join(chr(ord('A') + i // 26 ** p % 26) for p in range(2, -1, -1))
+
+
+def link_gribs(wps_dir, inventories):
+    """
+    links the GRIB files as GRIBFILE.AAA, GRIBFILE.AAB, ... for ungrib.exe. unlike link_grib.csh with a prefix, only
+    the given files are linked, and not the other cycles, resolutions or .part files of the date in the gfs_dir
+    """
+    utils.delete_files_with_prefix(wps_dir, 'GRIBFILE.*')
+    for i, inv in enumerate(inventories):
+        os.symlink(inv, os.path.join(wps_dir, get_grib_file_name(i)))
+
+
+def run_ungrib(wrf_config, start_date, wps_dir):
+    prepare_wps(wps_dir)
+
+    link_gribs(wps_dir, utils.get_gfs_inventory_dest_list(start_date, wrf_config.get('period'),
+                                                          wrf_config.get('gfs_inv'), wrf_config.get('gfs_step'),
+                                                          wrf_config.get('gfs_cycle'), wrf_config.get('gfs_res'),
+                                                          wrf_config.get('gfs_dir')))
+
+    # Starting ungrib.exe
+    utils.run_subprocess('./ungrib.exe', cwd=wps_dir)
+
+
+def ungrib_single_inventory(wps_dir, inv, valid_time):
+    """
+    runs ungrib.exe for a single GRIB file, by linking it as GRIBFILE.AAA and limiting the namelist.wps period to its
+    valid time. produces the FILE:<valid time> intermediate file
+    """
+    logging.info('Ungrib %s valid at %s' % (inv, valid_time.strftime('%Y-%m-%d_%H:%M:%S')))
+    link_gribs(wps_dir, [inv])
+
+    namelist_wps = os.path.join(wps_dir, 'namelist.wps')
+    ts = ["'%s'" % valid_time.strftime('%Y-%m-%d_%H:%M:%S')] * len(
+        utils.read_namelist(namelist_wps)['share']['start_date'])
+    utils.update_namelist(namelist_wps, 'share', {'start_date': ts, 'end_date': ts})
+
+    utils.run_subprocess('./ungrib.exe', cwd=wps_dir)
+
+
+def run_wps_pipelined(date, end, wrf_config, metgrid=True):
+    """
+    downloads the GFS data in the background and ungribs each forecast hour, in order, as soon as its inventory is
+    available, so that metgrid can start right after the last inventory arrives
+    :param metgrid: if False, stops after ungrib
+    :return: dict of timings of the download, ungrib and the critical path until metgrid
+    """
+    logging.info('Running WPS with pipelined GFS download and ungrib...')
+    wps_dir = get_wps_dir(wrf_config)
+
+    replace_namelist_wps(wrf_config, date, end)
+    prepare_wps(wps_dir)
+
+    timings = {'download': 0.0, 'ungrib': 0.0}
+    errors = []
+    ready = set()
+    ready_cond = threading.Condition()
+    start_time = time.time()
+
+    def on_ready(inv):
+        with ready_cond:
+            ready.add(inv)
+            ready_cond.notify_all()
+
+    def download():
+        try:
+            download_gfs_data(date, wrf_config, on_ready)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            timings['download'] = time.time() - start_time
+            with ready_cond:
+                ready_cond.notify_all()
+
+    def wait_for_inventory(inv):
+        """
+        :return: True if the inventory is available, False if the download ended without it
+        """
+        with ready_cond:
+            while inv not in ready and download_thread.is_alive():
+                ready_cond.wait(1)
+            return inv in ready
+
+    download_thread = threading.Thread(target=download, name='gfs-download')
+    download_thread.start()
+
+    inventories = utils.get_gfs_inventory_dest_list(date, wrf_config.get('period'), wrf_config.get('gfs_inv'),
+                                                    wrf_config.get('gfs_step'), wrf_config.get('gfs_cycle'),
+                                                    wrf_config.get('gfs_res'), wrf_config.get('gfs_dir'))
+    valid_times = get_gfs_valid_times(date, wrf_config)
+
+    try:
+        for inv, valid_time in zip(inventories, valid_times):
+            if not wait_for_inventory(inv):
+                download_thread.join()
+                if len(errors) > 0:
+                    raise errors[0]
+                raise GfsDataUnavailable('Inventory not downloaded', [inv])
+
+            if wrf_config.get('gfs_validate') and not validate_gfs_inventory(inv, valid_time, wrf_config):
+                # rare, hence the rest of the download is let to finish before the invalid inventory is fetched again
+                download_thread.join()
+                download_gfs_data(date, wrf_config)
+                if not validate_gfs_inventory(inv, valid_time, wrf_config):
+                    raise GfsDataUnavailable('Invalid data', [inv])
+
+            ungrib_start = time.time()
+            ungrib_single_inventory(wps_dir, inv, valid_time)
+            timings['ungrib'] += time.time() - ungrib_start
+    finally:
+        download_thread.join()
+        utils.delete_files_with_prefix(wps_dir, 'GRIBFILE.*')
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    timings['critical_path'] = time.time() - start_time
+    timings['sequential'] = timings['download'] + timings['ungrib']
+    logging.info('Pipelined download and ungrib: download %f s, ungrib %f s, critical path till metgrid %f s. '
+                 'Sequential path would take %f s (%f s saved)' % (
+                     timings['download'], timings['ungrib'], timings['critical_path'], timings['sequential'],
+                     timings['sequential'] - timings['critical_path']))
+
+    # restore the full period for metgrid
+    replace_namelist_wps(wrf_config, date, end)
+    if metgrid:
+        run_geogrid_metgrid(wps_dir, get_geogrid_cache(wrf_config))
+
+    return timings
 
 
 def replace_namelist_wps(wrf_config, start_date, end_date):
@@ -169,10 +542,14 @@ def replace_namelist_wps(wrf_config, start_date, end_date):
         'DD2': end_date.strftime('%d'),
         'GEOG': utils.get_geog_dir(wrf_config.get('wrf_home'))
     }
-    utils.replace_file_with_values(wps, os.path.join(utils.get_wps_dir(wrf_config.get('wrf_home')), 'namelist.wps'), d)
+    utils.replace_file_with_values(wps, os.path.join(get_wps_dir(wrf_config), 'namelist.wps'), d)
 
 
-def replace_namelist_input(wrf_config, start_date, end_date):
+def replace_namelist_input(wrf_config, start_date, end_date, mpi=None, dest=None):
+    """
+    :param mpi: MPI settings of get_mpi_settings applied to the namelist. looked up for the rendered namelist if None
+    :param dest: path of the namelist.input. the namelist.input of the em_real dir if None
+    """
     logging.info('Replacing namelist.input ...')
     if os.path.exists(wrf_config.get('namelist_input')):
         f = wrf_config.get('namelist_input')
@@ -186,13 +563,102 @@ def replace_namelist_input(wrf_config, start_date, end_date):
         'MM2': end_date.strftime('%m'),
         'DD2': end_date.strftime('%d'),
     }
-    utils.replace_file_with_values(f, os.path.join(utils.get_em_real_dir(wrf_config.get('wrf_home')), 'namelist.input'),
-                                   d)
+    namelist_input = dest if dest is not None else os.path.join(get_em_real_dir(wrf_config), 'namelist.input')
+    utils.replace_file_with_values(f, namelist_input, d)
+    if wrf_config.get('restart_interval'):
+        utils.update_namelist(namelist_input, 'time_control', {'restart_interval': wrf_config.get('restart_interval')})
+    for group, values in (wrf_config.get('namelist_overrides') or {}).items():
+        utils.update_namelist(namelist_input, group, values)
+    settings = mpi if mpi is not None else get_mpi_settings(wrf_config, namelist_input)
+    if 'nproc_x' in settings:
+        logging.info('Using the tuned MPI settings: %s' % mpi_tuner.settings_to_string(settings))
+        utils.update_namelist(namelist_input, 'domains', mpi_tuner.get_namelist_values(settings))
+
+
+def get_mpi_settings(wrf_config, namelist_input=None):
+    """
+    an ensemble member keeps its own procs (or the procs of the run), so that the members share the ensemble_cores as
+    configured. the tuned settings are used for a member only if they are for as many procs
+    :param namelist_input: path of the namelist.input. the namelist.input of the em_real dir if None
+    :return: dict of the procs and omp_threads, and the nproc_x, nproc_y and numtiles tuned for this machine and the
+    domain of the namelist.input. only the procs setting, if not tuned
+    """
+    procs = wrf_config.get('procs')
+    if namelist_input is None:
+        namelist_input = os.path.join(get_em_real_dir(wrf_config), 'namelist.input')
+    if wrf_config.get('mpi_tuning') and os.path.exists(namelist_input):
+        settings = mpi_tuner.TuningStore(utils.get_mpi_tuning_file(wrf_config.get('wrf_home'))).get(
+            mpi_tuner.get_machine_id(), mpi_tuner.get_domain_key(namelist_input))
+        if settings is not None and (not wrf_config.get('ensemble_member') or settings['procs'] == procs):
+            return settings
+    return {'procs': procs, 'omp_threads': None}
+
+
+def get_mpi_env(omp_threads):
+    if omp_threads is None:
+        return None
+    return dict(os.environ, OMP_NUM_THREADS=str(omp_threads))
 
 
-def run_em_real(wrf_home, start_date, procs):
+def get_latest_restart_time(em_real_dir, max_dom):
+    """
+    :return: latest time with wrfrst files of all the domains, or None
+    """
+    times = {}
+    for f in glob.glob(os.path.join(em_real_dir, 'wrfrst_d*')):
+        m = re.match(r'wrfrst_d(\d+)_(\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2})$', os.path.basename(f))
+        if m is not None:
+            times.setdefault(m.group(2), set()).add(int(m.group(1)))
+    complete = [t for t, domains in times.items() if domains.issuperset(range(1, max_dom + 1))]
+    if len(complete) == 0:
+        return None
+    return dt.datetime.strptime(max(complete), '%Y-%m-%d_%H:%M:%S')
+
+
+def set_restart(namelist_input, restart_time, end_date):
+    """
+    sets the namelist.input to restart wrf.exe from the restart_time and run till the end_date
+    """
+    max_dom = int(utils.read_namelist(namelist_input)['domains']['max_dom'][0])
+    remaining = end_date - restart_time
+    values = {'restart': '.true.',
+              'run_days': remaining.days,
+              'run_hours': remaining.seconds // 3600,
+              'run_minutes': remaining.seconds % 3600 // 60,
+              'run_seconds': remaining.seconds % 60}
+    for key, fmt in [('year', '%Y'), ('month', '%m'), ('day', '%d'), ('hour', '%H'), ('minute', '%M'),
+                     ('second', '%S')]:
+        values['start_' + key] = [restart_time.strftime(fmt)] * max_dom
+    utils.update_namelist(namelist_input, 'time_control', values)
+
+
+def join_restart_segments(em_real_dir):
+    """
+    wrf.exe restarted from restart files writes its history to new wrfout files, named by the restart time. they are
+    joined into the wrfout file of each domain which the run started with, as the extraction reads only that file
+    """
+    # netCDF4 is only needed when a run is resumed
+    from curwrf.wrf.execution import postprocess
+    domains = {}
+    for f in sorted(glob.glob(os.path.join(em_real_dir, 'wrfout_d*'))):
+        m = re.match(r'wrfout_d(\d+)_\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}$', os.path.basename(f))
+        if m is not None:
+            domains.setdefault(m.group(1), []).append(f)
+    for files in domains.values():
+        if len(files) > 1:
+            postprocess.join_segments(files)
+
+
+def run_em_real(wrf_home, start_date, procs, em_real_dir=None, wps_dir=None, logs_dir=None):
     logging.info('Running em_real...')
-    em_real_dir = utils.get_em_real_dir(wrf_home)
+    run_real(wrf_home, start_date, procs, em_real_dir, wps_dir, logs_dir)
+    run_wrf_exe(wrf_home, start_date, procs, em_real_dir, logs_dir)
+
+
+def run_real(wrf_home, start_date, procs, em_real_dir=None, wps_dir=None, logs_dir=None, omp_threads=None):
+    em_real_dir = em_real_dir if em_real_dir is not None else utils.get_em_real_dir(wrf_home)
+    wps_dir = wps_dir if wps_dir is not None else utils.get_wps_dir(wrf_home)
+    logs_dir = logs_dir if logs_dir is not None else utils.get_logs_dir(wrf_home)
 
     logging.info('Cleaning up files')
     utils.delete_files_with_prefix(em_real_dir, 'met_em*')
@@ -200,53 +666,535 @@ def run_em_real(wrf_home, start_date, procs):
 
     # Linking met_em.*
     logging.info('Creating met_em.d* symlinks')
-    utils.create_symlink_with_prefix(utils.get_wps_dir(wrf_home), 'met_em.d*', em_real_dir)
+    utils.create_symlink_with_prefix(wps_dir, 'met_em.d*', em_real_dir)
 
     # Starting real.exe
-    utils.run_subprocess('mpirun -np %d ./real.exe' % procs, cwd=em_real_dir)
-    utils.move_files_with_prefix(em_real_dir, 'rsl*', os.path.join(utils.get_logs_dir(wrf_home),
+    utils.run_subprocess('mpirun -np %d ./real.exe' % procs, cwd=em_real_dir,
+                         log_file=os.path.join(logs_dir, 'real-%s.log' % start_date.strftime('%Y%m%d')),
+                         monitor=rsl_monitor.RslMonitor(em_real_dir), env=get_mpi_env(omp_threads))
+    utils.move_files_with_prefix(em_real_dir, 'rsl*', os.path.join(logs_dir,
                                                                    'rsl-real-%s' % start_date.strftime('%Y%m%d')))
 
+
+def run_wrf_exe(wrf_home, start_date, procs, em_real_dir=None, logs_dir=None, monitor=None, omp_threads=None):
+    """
+    :param monitor: rsl_monitor.RslMonitor tracking the progress of the run. callers may read its progress from
+    another thread. one without the simulated period is used if None
+    :param omp_threads: OpenMP threads per MPI rank. OMP_NUM_THREADS of the environment is used if None
+    """
+    em_real_dir = em_real_dir if em_real_dir is not None else utils.get_em_real_dir(wrf_home)
+    logs_dir = logs_dir if logs_dir is not None else utils.get_logs_dir(wrf_home)
+    monitor = monitor if monitor is not None else rsl_monitor.RslMonitor(em_real_dir)
+
     # Starting wrf.exe'
-    utils.run_subprocess('mpirun -np %d ./wrf.exe' % procs, cwd=em_real_dir)
-    utils.move_files_with_prefix(em_real_dir, 'rsl*', os.path.join(utils.get_logs_dir(wrf_home),
+    try:
+        utils.run_subprocess('mpirun -np %d ./wrf.exe' % procs, cwd=em_real_dir,
+                             log_file=os.path.join(logs_dir, 'wrf-%s.log' % start_date.strftime('%Y%m%d')),
+                             monitor=monitor, env=get_mpi_env(omp_threads))
+    finally:
+        logging.info('wrf.exe %s' % monitor.to_string())
+    utils.move_files_with_prefix(em_real_dir, 'rsl*', os.path.join(logs_dir,
                                                                    'rsl-wrf-%s' % start_date.strftime('%Y%m%d')))
 
 
+def get_wrf_monitor(date, wrf_config):
+    return rsl_monitor.RslMonitor(get_em_real_dir(wrf_config), date, date + dt.timedelta(days=wrf_config.get('period')),
+                                  wrf_config.get('wrf_max_cfl_warnings'))
+
+
+def run_wps_for_date(date, wrf_config):
+    """
+    runs WPS for the date, up to the met_em files
+    """
+    end = date + dt.timedelta(days=wrf_config.get('period'))
+    if wrf_config.get('pipelined_ungrib'):
+        run_wps_pipelined(date, end, wrf_config)
+    else:
+        check_gfs_data_availability(date, wrf_config)
+        if wrf_config.get('gfs_validate'):
+            validate_gfs_data(date, wrf_config)
+
+        replace_namelist_wps(wrf_config, date, end)
+        run_wps(wrf_config, date, get_wps_dir(wrf_config), get_geogrid_cache(wrf_config))
+
+
+def run_wrf_model(date, wrf_config):
+    """
+    runs real.exe and wrf.exe for the date, using the met_em files of run_wps_for_date
+    """
+    end = date + dt.timedelta(days=wrf_config.get('period'))
+    replace_namelist_input(wrf_config, date, end)
+    mpi = get_mpi_settings(wrf_config)
+    run_real(wrf_config.get('wrf_home'), date, mpi['procs'], get_em_real_dir(wrf_config), get_wps_dir(wrf_config),
+             get_logs_dir(wrf_config), mpi['omp_threads'])
+    run_wrf_exe(wrf_config.get('wrf_home'), date, mpi['procs'], get_em_real_dir(wrf_config), get_logs_dir(wrf_config),
+                get_wrf_monitor(date, wrf_config), mpi['omp_threads'])
+    collect_outputs(wrf_config)
+    cleanup_run(wrf_config)
+
+
+def collect_outputs(wrf_config, slim=None):
+    """
+    :param slim: if True, the outputs are slimmed with slim_outputs. wrfout_slim setting is used if None
+    """
+    logging.info('Moving the WRF files to output directory')
+    output_dir = get_output_dir(wrf_config)
+    files = [os.path.join(output_dir, os.path.basename(f))
+             for f in glob.glob(os.path.join(get_em_real_dir(wrf_config), 'wrfout_d*'))]
+    utils.move_files_with_prefix(get_em_real_dir(wrf_config), 'wrfout_d*', output_dir)
+    if slim is None:
+        slim = wrf_config.get('wrfout_slim')
+    if slim:
+        slim_outputs(wrf_config, files)
+
+    shared_output_dir = utils.get_output_dir(wrf_config.get('wrf_home'))
+    if wrf_config.get('ensemble_member'):
+        # outputs of the members are tagged by the member name
+        shared_output_dir = utils.create_dir_if_not_exists(
+            os.path.join(shared_output_dir, 'ensemble', wrf_config.get('ensemble_member')))
+    if os.path.realpath(output_dir) != os.path.realpath(shared_output_dir):
+        # the latest run of each date is linked to the shared output dir, for the extraction. the links point into the
+        # run dir, which keeps the wrfout files
+        for f in glob.glob(os.path.join(output_dir, 'wrfout_d*')):
+            link = os.path.join(shared_output_dir, os.path.basename(f))
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(f, link)
+
+
+def get_output_files(wrf_config, date):
+    """
+    :return: wrfout files of the date in the output dir
+    """
+    return [f for f in glob.glob(os.path.join(get_output_dir(wrf_config), 'wrfout_d*_%s_*' % date.strftime('%Y-%m-%d')))
+            if re.match(r'wrfout_d\d+_\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}$', os.path.basename(f))]
+
+
+def slim_outputs(wrf_config, files):
+    """
+    replaces the wrfout files with compressed copies holding only the wrfout_vars and the de-accumulated
+    precipitation. the full files are archived, deleted or kept as per the wrfout_full_policy
+    """
+    # netCDF4 is only needed when the outputs are slimmed
+    from curwrf.wrf.execution import postprocess
+    for f in files:
+        postprocess.slim_in_place(f, wrf_config.get('wrfout_vars'), wrf_config.get('wrfout_complevel'),
+                                  wrf_config.get('wrfout_full_policy'),
+                                  utils.get_archive_dir(wrf_config.get('wrf_home')))
+
+
 def run_wrf(date, wrf_config):
     end = date + dt.timedelta(days=wrf_config.get('period'))
 
     logging.info('Running WRF from %s to %s...' % (date.strftime('%Y%m%d'), end.strftime('%Y%m%d')))
 
+    if wrf_config.get('isolated_runs'):
+        wrf_config = create_run_config(wrf_config, date)
+    if wrf_config.get('ensemble'):
+        run_wps_for_date(date, wrf_config)
+        run_ensemble(date, wrf_config)
+    elif wrf_config.get('resume_runs'):
+        run_wrf_resumable(date, wrf_config)
+    else:
+        run_wps_for_date(date, wrf_config)
+        run_wrf_model(date, wrf_config)
+
+
+def run_ensemble(date, wrf_config):
+    """
+    runs real.exe and wrf.exe of each member of the ensemble, using the met_em files of run_wps_for_date. members run
+    concurrently, each holding the cores of its procs and OpenMP threads from a CoreScheduler of ensemble_cores cores.
+    a member needing more than the ensemble_cores fails
+    """
+    members = wrf_config.get('ensemble')
+    cores = scheduler.CoreScheduler(wrf_config.get('ensemble_cores'))
+    member_confs = [create_member_config(wrf_config, date, m) for m in members]
+    errors = {}
+    start_time = time.time()
+    logging.info('Running %d ensemble members on %d cores' % (len(members), cores.total_cores))
+
+    def run_member(member_conf):
+        name = member_conf.get('ensemble_member')
+        end = date + dt.timedelta(days=wrf_config.get('period'))
+        try:
+            replace_namelist_input(member_conf, date, end)
+            mpi = get_mpi_settings(member_conf)
+            with cores.cores(mpi['procs'] * (mpi['omp_threads'] or 1), name):
+                member_start = time.time()
+                run_real(member_conf.get('wrf_home'), date, mpi['procs'], get_em_real_dir(member_conf),
+                         get_wps_dir(member_conf), get_logs_dir(member_conf), mpi['omp_threads'])
+                run_wrf_exe(member_conf.get('wrf_home'), date, mpi['procs'], get_em_real_dir(member_conf),
+                            get_logs_dir(member_conf), get_wrf_monitor(date, member_conf), mpi['omp_threads'])
+                logging.info('Ensemble member %s done in %f s' % (name, time.time() - member_start))
+            collect_outputs(member_conf)
+            cleanup_run(member_conf, wps=False)
+        except Exception as e:
+            logging.error('Ensemble member %s failed: %s' % (name, str(e)))
+            errors[name] = e
+
+    threads = [threading.Thread(target=run_member, args=(c,), name='member-%s' % c.get('ensemble_member'))
+               for c in member_confs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    logging.info('Ensemble of %d members finished in %f s' % (len(members), time.time() - start_time))
+    if len(errors) > 0:
+        raise EnsembleMembersFailed(sorted(errors.keys()), errors)
+    cleanup_run(wrf_config)
+
+
+def run_wrf_resumable(date, wrf_config):
+    """
+    runs the stages of run_wrf with checkpoints. stages completed by a previous attempt with the same inputs are
+    skipped, and wrf.exe resumes from the latest restart files of the previous attempt, if any. the wrfout files of the
+    resumed wrf.exe are joined into those of the previous attempt
+    """
+    end = date + dt.timedelta(days=wrf_config.get('period'))
     wrf_home = wrf_config.get('wrf_home')
-    check_gfs_data_availability(date, wrf_config)
+    wps_dir = get_wps_dir(wrf_config)
+    em_real_dir = get_em_real_dir(wrf_config)
+    logs_dir = get_logs_dir(wrf_config)
+    namelist_wps = os.path.join(wps_dir, 'namelist.wps')
+    namelist_input = os.path.join(em_real_dir, 'namelist.input')
+    checkpoints = checkpoint.StageCheckpoints(os.path.join(logs_dir, 'checkpoints-%s.json' % date.strftime('%Y%m%d')))
+    gfs_files = utils.get_gfs_inventory_dest_list(date, wrf_config.get('period'), wrf_config.get('gfs_inv'),
+                                                  wrf_config.get('gfs_step'), wrf_config.get('gfs_cycle'),
+                                                  wrf_config.get('gfs_res'), wrf_config.get('gfs_dir'))
+    intermediate_files = [os.path.join(wps_dir, 'FILE:*')]
+    met_em_files = [os.path.join(wps_dir, 'met_em.d*')]
+    real_outputs = [os.path.join(em_real_dir, 'wrfinput_d*'), os.path.join(em_real_dir, 'wrfbdy_d01')]
+
+    def check_gfs():
+        check_gfs_data_availability(date, wrf_config)
+        if wrf_config.get('gfs_validate'):
+            validate_gfs_data(date, wrf_config)
+
+    def metgrid():
+        utils.delete_files_with_prefix(wps_dir, 'met_em*')
+        run_geogrid_metgrid(wps_dir, get_geogrid_cache(wrf_config))
+
+    def real():
+        utils.delete_files_with_prefix(em_real_dir, 'wrfrst*')
+        mpi = get_mpi_settings(wrf_config)
+        run_real(wrf_home, date, mpi['procs'], em_real_dir, wps_dir, logs_dir, mpi['omp_threads'])
+
+    def wrf():
+        max_dom = int(utils.read_namelist(namelist_input)['domains']['max_dom'][0])
+        restart_time = get_latest_restart_time(em_real_dir, max_dom)
+        if restart_time is not None:
+            logging.info('Resuming wrf.exe from the restart files at %s' % restart_time.strftime('%Y-%m-%d_%H:%M:%S'))
+            set_restart(namelist_input, restart_time, end)
+        else:
+            # left over by failed runs of other dates, not to be joined with the outputs of this run
+            utils.delete_files_with_prefix(em_real_dir, 'wrfout_d*')
+        mpi = get_mpi_settings(wrf_config)
+        run_wrf_exe(wrf_home, date, mpi['procs'], em_real_dir, logs_dir, get_wrf_monitor(date, wrf_config),
+                    mpi['omp_threads'])
+        if restart_time is not None:
+            join_restart_segments(em_real_dir)
+        collect_outputs(wrf_config)
 
     replace_namelist_wps(wrf_config, date, end)
-    run_wps(wrf_home, date)
+    if wrf_config.get('pipelined_ungrib'):
+        checkpoints.run('ungrib', lambda: run_wps_pipelined(date, end, wrf_config, metgrid=False), [namelist_wps],
+                        intermediate_files, values=gfs_files)
+    else:
+        checkpoints.run('gfs', check_gfs, gfs_files)
+        checkpoints.run('ungrib', lambda: run_ungrib(wrf_config, date, wps_dir), gfs_files + [namelist_wps],
+                        intermediate_files)
+    checkpoints.run('metgrid', metgrid, [namelist_wps] + intermediate_files, met_em_files)
 
     replace_namelist_input(wrf_config, date, end)
-    run_em_real(wrf_home, date, wrf_config.get('procs'))
+    checkpoints.run('real', real, [namelist_input] + met_em_files, real_outputs)
+    checkpoints.run('wrf', wrf, [namelist_input] + real_outputs,
+                    [os.path.join(get_output_dir(wrf_config), 'wrfout_d*_%s_*' % date.strftime('%Y-%m-%d'))])
+    cleanup_run(wrf_config)
 
-    logging.info('Moving the WRF files to output directory')
-    utils.move_files_with_prefix(utils.get_em_real_dir(wrf_home), 'wrfout_d*', utils.get_output_dir(wrf_home))
+
+def check_resume_runs(wrf_conf):
+    """
+    only run_wrf_resumable runs with checkpoints. the pipelined and scheduled runs and the ensembles do not
+    :raise ValueError: if resume_runs is set along with any of them, rather than ignoring it
+    """
+    if not wrf_conf.get('resume_runs'):
+        return
+    unsupported = [k for k in ['run_lookahead', 'stage_scheduler', 'ensemble'] if wrf_conf.get(k)]
+    if len(unsupported) > 0:
+        raise ValueError('resume_runs is not supported with %s' % ', '.join(unsupported))
 
 
 def run_all(wrf_conf, start_date, end_date):
+    check_resume_runs(wrf_conf)
+    if wrf_conf.get('stage_scheduler'):
+        return run_all_scheduled(wrf_conf, start_date, end_date)
+    if wrf_conf.get('run_lookahead') > 0 and not wrf_conf.get('ensemble'):
+        return run_all_pipelined(wrf_conf, start_date, end_date)
+
     logging.info('Running WRF model from %s to %s' % (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
 
     logging.info('WRF conf\n %s' % wrf_conf.to_string())
 
-    dates = np.arange(start_date, end_date, dt.timedelta(days=1)).astype(dt.datetime)
+    dates = utils.get_dates(start_date, end_date)
 
     for date in dates:
-        logging.info('Creating GFS context')
-        logging.info('Downloading GFS Data for %s period %d' % (date.strftime('%Y-%m-%d'), wrf_conf.get('period')))
-        download_gfs_data(date, wrf_conf)
+        if not wrf_conf.get('pipelined_ungrib'):
+            logging.info('Creating GFS context')
+            logging.info('Downloading GFS Data for %s period %d' % (date.strftime('%Y-%m-%d'), wrf_conf.get('period')))
+            download_gfs_data(date, wrf_conf)
 
         logging.info('Running WRF %s period %d' % (date.strftime('%Y-%m-%d'), wrf_conf.get('period')))
         run_wrf(date, wrf_conf)
 
 
+def run_all_pipelined(wrf_conf, start_date, end_date):
+    """
+    overlaps the stages of consecutive dates. GFS data is prefetched up to run_lookahead dates ahead of WPS, and WPS of
+    date N+1 runs while wrf.exe runs date N. real.exe of a date reads the met_em files in the WPS dir, hence WPS of the
+    next date starts only after real.exe. a date holds a prefetch slot (and its cache entries are pinned) until its WPS
+    is done, which caps the disk used by the prefetched data
+    """
+    logging.info('Running WRF model from %s to %s with lookahead %d' % (
+        start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'), wrf_conf.get('run_lookahead')))
+
+    logging.info('WRF conf\n %s' % wrf_conf.to_string())
+
+    dates = utils.get_dates(start_date, end_date)
+    if len(dates) == 0:
+        return
+    slots = threading.Semaphore(wrf_conf.get('run_lookahead') + 1)
+    downloaded = dict((d, threading.Event()) for d in dates)
+    download_errors = {}
+    stop_event = threading.Event()
+    start_time = time.time()
+
+    def prefetch():
+        for date in dates:
+            slots.acquire()
+            if stop_event.is_set():
+                return
+            gfs_cache.pin(get_gfs_inventory_keys(date, wrf_conf))
+            try:
+                logging.info('Prefetching GFS Data for %s' % date.strftime('%Y-%m-%d'))
+                download_gfs_data(date, wrf_conf)
+            except Exception as e:
+                download_errors[date] = e
+            finally:
+                downloaded[date].set()
+
+    run_confs = dict((d, create_run_config(wrf_conf, d) if wrf_conf.get('isolated_runs') else wrf_conf) for d in dates)
+
+    def wps(date, state):
+        try:
+            downloaded[date].wait()
+            if date in download_errors:
+                raise download_errors[date]
+            wps_start = time.time()
+            run_wps_for_date(date, run_confs[date])
+            logging.info('WPS %s done in %f s' % (date.strftime('%Y-%m-%d'), time.time() - wps_start))
+        except Exception as e:
+            state['error'] = e
+        finally:
+            gfs_cache.unpin(get_gfs_inventory_keys(date, wrf_conf))
+            slots.release()
+
+    def start_wps(date):
+        state = {'error': None}
+        t = threading.Thread(target=wps, args=(date, state), name='wps-%s' % date.strftime('%Y%m%d'))
+        t.start()
+        return t, state
+
+    prefetch_thread = threading.Thread(target=prefetch, name='gfs-prefetch')
+    prefetch_thread.daemon = True
+    prefetch_thread.start()
+
+    wps_thread, wps_state = start_wps(dates[0])
+    try:
+        for i, date in enumerate(dates):
+            run_conf = run_confs[date]
+            end = date + dt.timedelta(days=wrf_conf.get('period'))
+            wps_thread.join()
+            if wps_state['error'] is not None:
+                raise wps_state['error']
+
+            logging.info('Running WRF %s period %d' % (date.strftime('%Y-%m-%d'), wrf_conf.get('period')))
+            replace_namelist_input(run_conf, date, end)
+            mpi = get_mpi_settings(run_conf)
+            run_real(run_conf.get('wrf_home'), date, mpi['procs'], get_em_real_dir(run_conf), get_wps_dir(run_conf),
+                     get_logs_dir(run_conf), mpi['omp_threads'])
+
+            if i + 1 < len(dates):
+                wps_thread, wps_state = start_wps(dates[i + 1])
+
+            run_wrf_exe(run_conf.get('wrf_home'), date, mpi['procs'], get_em_real_dir(run_conf),
+                        get_logs_dir(run_conf), get_wrf_monitor(date, run_conf), mpi['omp_threads'])
+            collect_outputs(run_conf)
+            cleanup_run(run_conf)
+    finally:
+        stop_event.set()
+        slots.release()
+        wps_thread.join()
+
+    logging.info('Pipelined run of %d dates finished in %f s' % (len(dates), time.time() - start_time))
+
+
+def run_all_scheduled(wrf_conf, start_date, end_date, extract_fn=None):
+    """
+    runs the stages of all the dates (and ensemble members) as a DAG on a scheduler.StageScheduler, so that stages of
+    different dates overlap as far as their dependencies and the cores, network and disk slots of the node allow. dates
+    sharing the WPS and em_real dirs are chained as in run_all_pipelined; with isolated_runs they run independently
+    :param extract_fn: optional function of the date, run after wrf.exe of the date. not used with ensembles
+    """
+    check_resume_runs(wrf_conf)
+    logging.info('Running WRF model from %s to %s with the stage scheduler' % (
+        start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
+
+    logging.info('WRF conf\n %s' % wrf_conf.to_string())
+
+    sched = scheduler.StageScheduler({'cores': wrf_conf.get('scheduler_cores') or multiprocessing.cpu_count(),
+                                      'net': wrf_conf.get('scheduler_net_slots'),
+                                      'disk': wrf_conf.get('scheduler_disk_slots')})
+    shared = not wrf_conf.get('isolated_runs')
+    members = wrf_conf.get('ensemble') or [None]
+    dates = utils.get_dates(start_date, end_date)
+    prev_real = []
+    prev_wrf = []
+
+    for date in dates:
+        tag = date.strftime('%Y%m%d')
+        end = date + dt.timedelta(days=wrf_conf.get('period'))
+        run_conf = create_run_config(wrf_conf, date) if not shared else wrf_conf
+        keys = get_gfs_inventory_keys(date, wrf_conf)
+
+        wps_deps = []
+        wps_resources = {'cores': 1, 'disk': 1}
+        if wrf_conf.get('pipelined_ungrib'):
+            wps_resources['net'] = 1
+        else:
+            sched.add('download-' + tag, functools.partial(download_pinned, date, wrf_conf, keys),
+                      resources={'net': 1})
+            wps_deps.append('download-' + tag)
+        # real.exe of the previous date reads the met_em files of the shared WPS dir
+        sched.add('wps-' + tag, functools.partial(run_wps_unpin, date, run_conf, keys),
+                  wps_deps + (prev_real if shared else []), wps_resources)
+
+        prev_real, wrf_stages, output_stages = [], [], []
+        for member in members:
+            conf = run_conf
+            name = tag
+            if member is not None:
+                conf = create_member_config(run_conf, date, member)
+                name = '%s-%s' % (tag, member['name'])
+            # the stages run with the MPI settings the cores are reserved for, even if the tuning store changes
+            mpi = get_stage_mpi_settings(conf, date, end, shared=conf is wrf_conf)
+            resources = {'cores': mpi['procs'] * (mpi['omp_threads'] or 1)}
+            # wrf.exe of the previous date runs in the shared em_real dir
+            sched.add('real-' + name, functools.partial(run_real_stage, date, conf, mpi),
+                      ['wps-' + tag] + (prev_wrf if conf is wrf_conf else []), resources)
+            sched.add('wrf-' + name, functools.partial(run_wrf_stage, date, conf, mpi), ['real-' + name], resources)
+            prev_real.append('real-' + name)
+            wrf_stages.append('wrf-' + name)
+            output_stages.append('wrf-' + name)
+            if wrf_conf.get('wrfout_slim'):
+                sched.add('post-' + name, functools.partial(run_post_stage, date, conf), ['wrf-' + name],
+                          {'cores': 1, 'disk': 1})
+                output_stages[-1] = 'post-' + name
+        prev_wrf = wrf_stages
+        if not shared and members != [None]:
+            # the members read the met_em files of the run till their real.exe is done
+            sched.add('cleanup-' + tag, functools.partial(cleanup_run, run_conf), wrf_stages)
+
+        if extract_fn is not None and members == [None]:
+            sched.add('extract-' + tag, functools.partial(extract_fn, date), output_stages, {'cores': 1, 'disk': 1})
+
+    sched.run()
+
+
+def download_pinned(date, wrf_conf, keys):
+    """
+    downloads the GFS data of the date, pinning it in the cache till run_wps_unpin
+    """
+    gfs_cache.pin(keys)
+    try:
+        download_gfs_data(date, wrf_conf)
+    except Exception:
+        gfs_cache.unpin(keys)
+        raise
+
+
+def run_wps_unpin(date, wrf_conf, keys):
+    try:
+        run_wps_for_date(date, wrf_conf)
+    finally:
+        gfs_cache.unpin(keys)
+
+
+def get_stage_mpi_settings(wrf_conf, date, end, shared):
+    """
+    :param shared: True if the em_real dir is shared with the runs of the earlier dates. the namelist.input there may be
+    theirs or missing, hence the settings are looked up for a namelist rendered into a temp dir
+    :return: MPI settings of the real and wrf stages of the date
+    """
+    if not shared:
+        # fresh dirs of the run, rendered up front for the MPI settings of the namelist
+        replace_namelist_input(wrf_conf, date, end)
+        return get_mpi_settings(wrf_conf)
+    tmp_dir = tempfile.mkdtemp(prefix='namelist-')
+    try:
+        namelist_input = os.path.join(tmp_dir, 'namelist.input')
+        replace_namelist_input(wrf_conf, date, end, dest=namelist_input)
+        return get_mpi_settings(wrf_conf, namelist_input)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def run_real_stage(date, wrf_conf, mpi):
+    replace_namelist_input(wrf_conf, date, date + dt.timedelta(days=wrf_conf.get('period')), mpi)
+    run_real(wrf_conf.get('wrf_home'), date, mpi['procs'], get_em_real_dir(wrf_conf), get_wps_dir(wrf_conf),
+             get_logs_dir(wrf_conf), mpi['omp_threads'])
+
+
+def run_wrf_stage(date, wrf_conf, mpi):
+    run_wrf_exe(wrf_conf.get('wrf_home'), date, mpi['procs'], get_em_real_dir(wrf_conf), get_logs_dir(wrf_conf),
+                get_wrf_monitor(date, wrf_conf), mpi['omp_threads'])
+    # slimmed in the post stage, which does not hold the cores of wrf.exe
+    collect_outputs(wrf_conf, slim=False)
+    cleanup_run(wrf_conf, wps=not wrf_conf.get('ensemble_member'))
+
+
+def run_post_stage(date, wrf_conf):
+    slim_outputs(wrf_conf, get_output_files(wrf_conf, date))
+
+
+def tune_mpi(wrf_conf, date):
+    """
+    prepares the inputs of the date up to real.exe, and benchmarks short wrf.exe runs over a grid of MPI rank counts,
+    decompositions, numtiles and OpenMP threads. the fastest settings are saved for this machine and the domain, and
+    picked up by the following runs
+    :return: best settings dict, or None if all the candidates failed
+    """
+    logging.info('Tuning the MPI settings with the inputs of %s' % date.strftime('%Y-%m-%d'))
+    if not wrf_conf.get('pipelined_ungrib'):
+        download_gfs_data(date, wrf_conf)
+    run_wps_for_date(date, wrf_conf)
+
+    end = date + dt.timedelta(days=wrf_conf.get('period'))
+    em_real_dir = get_em_real_dir(wrf_conf)
+    logs_dir = get_logs_dir(wrf_conf)
+    replace_namelist_input(wrf_conf, date, end)
+    mpi = get_mpi_settings(wrf_conf)
+    run_real(wrf_conf.get('wrf_home'), date, mpi['procs'], em_real_dir, get_wps_dir(wrf_conf), logs_dir,
+             mpi['omp_threads'])
+
+    namelist_input = os.path.join(em_real_dir, 'namelist.input')
+    candidates = mpi_tuner.get_candidates(namelist_input, wrf_conf.get('tune_procs'), wrf_conf.get('tune_tiles'),
+                                          wrf_conf.get('tune_omp_threads'))
+    return mpi_tuner.tune(em_real_dir, mpi_tuner.TuningStore(utils.get_mpi_tuning_file(wrf_conf.get('wrf_home'))),
+                          candidates, wrf_conf.get('tune_minutes'),
+                          os.path.join(logs_dir, 'tune-%s.log' % date.strftime('%Y%m%d')))
+
+
 class UnableToDownloadGfsData(Exception):
     def __init__(self, msg):
         self.msg = msg
@@ -260,6 +1208,13 @@ class GfsDataUnavailable(Exception):
         Exception.__init__(self, 'Unable to download %s' % msg)
 
 
+class EnsembleMembersFailed(Exception):
+    def __init__(self, members, errors):
+        self.members = members
+        self.errors = errors
+        Exception.__init__(self, 'Ensemble members failed: %s' % ', '.join(members))
+
+
 class WrfConfig:
     def __init__(self, configs=None):
         if configs is None:
@@ -298,19 +1253,65 @@ def get_wrf_config(wrf_home, config_file=None, **kwargs):
                 'namelist_wps': constants.DEFAULT_NAMELIST_WPS_TEMPLATE,
                 'procs': constants.DEFAULT_PROCS,
                 'gfs_dir': utils.get_gfs_dir(wrf_home),
-                'gfs_clean': True,
+                'gfs_clean': False,
+                'gfs_cache_size': constants.DEFAULT_GFS_CACHE_SIZE_GB,
                 'gfs_cycle': constants.DEFAULT_CYCLE,
                 'gfs_delay': constants.DEFAULT_DELAY_S,
                 'gfs_inv': constants.DEFAULT_GFS_DATA_INV,
                 'gfs_res': constants.DEFAULT_RES,
                 'gfs_retries': constants.DEFAULT_RETRIES,
                 'gfs_step': constants.DEFAULT_STEP,
+                'gfs_subset': False,
+                'gfs_fields': constants.DEFAULT_GFS_FIELDS,
                 'gfs_url': constants.DEFAULT_GFS_DATA_URL,
-                'gfs_threads': constants.DEFAULT_THREAD_COUNT}
+                'gfs_hedge_delay': constants.DEFAULT_HEDGE_DELAY_S,
+                'gfs_timeout': constants.DEFAULT_GFS_TIMEOUT_S,
+                'gfs_min_speed': constants.DEFAULT_GFS_MIN_SPEED_KBPS,
+                'gfs_stall_window': constants.DEFAULT_STALL_WINDOW_S,
+                'gfs_threads': constants.DEFAULT_THREAD_COUNT,
+                'gfs_validate': True,
+                'gfs_required_vars': constants.DEFAULT_GFS_REQUIRED_VARS,
+                'gfs_watch': False,
+                'gfs_poll_interval': constants.DEFAULT_POLL_INTERVAL_S,
+                'gfs_max_poll_interval': constants.DEFAULT_MAX_POLL_INTERVAL_S,
+                'gfs_watch_timeout': constants.DEFAULT_WATCH_TIMEOUT_S,
+                'pipelined_ungrib': False,
+                'run_lookahead': 0,
+                'geogrid_cache_size': constants.DEFAULT_GEOGRID_CACHE_SIZE,
+                'wrf_max_cfl_warnings': rsl_monitor.MAX_CFL_WARNINGS,
+                'mpi_tuning': True,
+                'tune_procs': None,
+                'tune_tiles': mpi_tuner.DEFAULT_TILES,
+                'tune_omp_threads': mpi_tuner.DEFAULT_OMP_THREADS,
+                'tune_minutes': mpi_tuner.DEFAULT_TUNE_MINUTES,
+                'ensemble': None,
+                'ensemble_cores': None,
+                'ensemble_member': None,
+                'namelist_overrides': None,
+                'stage_scheduler': False,
+                'scheduler_cores': None,
+                'scheduler_net_slots': 1,
+                'scheduler_disk_slots': 2,
+                'wrfout_slim': False,
+                'wrfout_vars': constants.DEFAULT_WRFOUT_VARS,
+                'wrfout_complevel': constants.DEFAULT_WRFOUT_COMPLEVEL,
+                'wrfout_full_policy': 'archive',
+                'extract_chunk_size': constants.DEFAULT_EXTRACT_CHUNK_SIZE,
+                'resume_runs': False,
+                'restart_interval': None,
+                'isolated_runs': False,
+                'run_cleanup': True,
+                'run_id': None,
+                'run_dir': None,
+                'wps_dir': None,
+                'em_real_dir': None,
+                'output_dir': None,
+                'logs_dir': None}
 
     conf = WrfConfig(defaults)
 
     if config_file is not None and os.path.exists(config_file):
+        import yaml
         with open(config_file, 'r') as f:
             conf_yaml = yaml.safe_load(f)
             conf.set_all(conf_yaml['wrfconfig'])
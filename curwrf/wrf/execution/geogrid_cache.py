@@ -0,0 +1,239 @@
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+
+from curwrf.wrf import utils
+
+MANIFEST_FILE = 'geogrid_cache.json'
+LOCK_FILE = '.geogrid_cache.lock'
+GEO_EM_PREFIX = 'geo_em.d*'
+# &share settings which change the geogrid output. dates and intervals do not
+SHARE_KEYS = ['wrf_core', 'max_dom', 'io_form_geogrid']
+# &geogrid paths. the contents they point to are part of the key instead
+PATH_KEYS = ['geog_data_path', 'opt_geogrid_tbl_path']
+GEOGRID_TBL = 'GEOGRID.TBL'
+DEFAULT_GEOGRID_TBL_PATH = './geogrid/'
+
+
+def get_geog_version(geog_dir):
+    """
+    :return: version of the GEOG static dataset, from the names and modification times of its top level entries
+    """
+    if not os.path.exists(geog_dir):
+        return None
+    entries = sorted('%s:%d' % (name, os.path.getmtime(os.path.join(geog_dir, name))) for name in os.listdir(geog_dir))
+    return hashlib.md5(','.join(entries)).hexdigest()
+
+
+def get_geogrid_tbl_md5(namelist_wps, namelist):
+    """
+    :param namelist: the namelist.wps, read with utils.read_namelist
+    :return: md5 of the GEOGRID.TBL used by geogrid.exe run in the dir of the namelist.wps. None if it is missing
+    """
+    tbl_dir = namelist.get('geogrid', {}).get('opt_geogrid_tbl_path', [DEFAULT_GEOGRID_TBL_PATH])[0].strip('\'"')
+    path = os.path.join(os.path.dirname(os.path.abspath(namelist_wps)), tbl_dir, GEOGRID_TBL)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def get_user_id():
+    """
+    :return: id of this process, recorded against the cache entries it uses
+    """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def is_user_alive(user):
+    """
+    :return: False if the user is a process of this host which is no longer running. users on other hosts are taken to
+    be alive
+    """
+    host, pid = user.rsplit(':', 1)
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def get_key(namelist_wps, geog_version=None):
+    """
+    :param namelist_wps: namelist.wps path
+    :param geog_version: version of the GEOG dataset. if None, the version of the dataset at the geog_data_path of the
+    namelist is used. the geog_data_path itself is not part of the key
+    :return: cache key of the geogrid output of the domain settings in the namelist and the contents of the
+    GEOGRID.TBL
+    """
+    namelist = utils.read_namelist(namelist_wps)
+    if geog_version is None and 'geog_data_path' in namelist.get('geogrid', {}):
+        geog_version = get_geog_version(namelist['geogrid']['geog_data_path'][0].strip('\'"'))
+    settings = dict(('share.' + k, v) for k, v in namelist.get('share', {}).items() if k in SHARE_KEYS)
+    settings.update(('geogrid.' + k, v) for k, v in namelist.get('geogrid', {}).items() if k not in PATH_KEYS)
+    settings['geog_version'] = geog_version
+    settings['geogrid_tbl'] = get_geogrid_tbl_md5(namelist_wps, namelist)
+    return hashlib.md5(json.dumps(settings, sort_keys=True)).hexdigest()
+
+
+class GeogridCache:
+    """
+    Keeps the geogrid outputs of several domain configurations, keyed by the domain settings of the namelist.wps, the
+    GEOG dataset version and the GEOGRID.TBL. The least recently used configurations are evicted beyond max_entries.
+    The manifest is shared between threads and processes using the same cache_dir. Runs linking an entry into their
+    WPS dir pin it till their metgrid.exe is done, and pinned entries are neither evicted nor replaced.
+    """
+
+    def __init__(self, cache_dir, max_entries=0):
+        """
+        :param cache_dir: dir of the cached outputs (one sub dir per key) and the manifest
+        :param max_entries: max num. of configurations. <= 0 for an unbounded cache
+        """
+        self.cache_dir = utils.create_dir_if_not_exists(cache_dir)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    def _load(self):
+        path = os.path.join(self.cache_dir, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                logging.warning('Unable to read the geogrid cache manifest %s. Starting with an empty cache' % path)
+                return {}
+
+    def _save(self, manifest):
+        path = os.path.join(self.cache_dir, MANIFEST_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def _update(self, update_fn):
+        with self.lock:
+            with open(os.path.join(self.cache_dir, LOCK_FILE), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    manifest = self._load()
+                    result = update_fn(manifest)
+                    self._save(manifest)
+                    return result
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _get_files(self, key, entry):
+        """
+        :return: paths of the cached files of the entry, or None if any of them are missing
+        """
+        files = [os.path.join(self.cache_dir, key, f) for f in entry['files']]
+        if not all(os.path.exists(f) for f in files):
+            return None
+        return files
+
+    def _link(self, entry, files, wps_dir, pin):
+        utils.delete_files_with_prefix(wps_dir, GEO_EM_PREFIX)
+        for f in files:
+            os.symlink(f, os.path.join(wps_dir, os.path.basename(f)))
+        entry['last_access'] = time.time()
+        if pin:
+            entry.setdefault('users', []).append(get_user_id())
+
+    def restore(self, key, wps_dir, pin=False):
+        """
+        links the cached geogrid output of the key into the wps_dir, replacing any geo_em files there
+        :param pin: if True, the entry is pinned till unpin
+        :return: True if the key was found in the cache
+        """
+
+        def update(manifest):
+            entry = manifest.get(key)
+            if entry is None:
+                return False
+            files = self._get_files(key, entry)
+            if files is None:
+                logging.warning('Geogrid cache entry %s is incomplete. Removing it' % key)
+                shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+                del manifest[key]
+                return False
+
+            self._link(entry, files, wps_dir, pin)
+            return True
+
+        return self._update(update)
+
+    def put(self, key, wps_dir, pin=False):
+        """
+        moves the geo_em files of the wps_dir into the cache and links them back. if another run has cached the key in
+        the meantime, its entry is linked instead and the geo_em files of the wps_dir are discarded, as other WPS dirs
+        may be reading the files of the entry
+        :param pin: if True, the entry is pinned till unpin
+        """
+        key_dir = os.path.join(self.cache_dir, key)
+
+        def update(manifest):
+            entry = manifest.get(key)
+            files = self._get_files(key, entry) if entry is not None else None
+            if files is not None:
+                logging.info('Geogrid output %s was cached by another run. Using it' % key)
+                self._link(entry, files, wps_dir, pin)
+                return
+
+            # left over by an incomplete entry or an interrupted put, and not linked by any run
+            shutil.rmtree(key_dir, ignore_errors=True)
+            utils.move_files_with_prefix(wps_dir, GEO_EM_PREFIX, key_dir)
+            entry = {'files': sorted(os.listdir(key_dir))}
+            manifest[key] = entry
+            self._link(entry, [os.path.join(key_dir, f) for f in entry['files']], wps_dir, pin)
+            logging.info('Geogrid output cached as %s' % key)
+
+        self._update(update)
+
+    def unpin(self, key):
+        """
+        releases a pin of this process on the key
+        """
+
+        def update(manifest):
+            users = manifest.get(key, {}).get('users', [])
+            if get_user_id() in users:
+                users.remove(get_user_id())
+
+        self._update(update)
+
+    def evict(self, pinned=()):
+        """
+        removes the least recently used configurations beyond the max_entries. entries pinned by running processes are
+        kept, and the pins of processes which are no longer running are dropped
+        :param pinned: keys which should not be evicted, in addition to the pinned entries
+        :return: list of evicted keys
+        """
+        if self.max_entries <= 0:
+            return []
+
+        def update(manifest):
+            evicted = []
+            for key, entry in sorted(manifest.items(), key=lambda x: x[1]['last_access']):
+                entry['users'] = [u for u in entry.get('users', []) if is_user_alive(u)]
+                if len(manifest) <= self.max_entries:
+                    continue
+                if key in pinned or len(entry['users']) > 0:
+                    continue
+                shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+                del manifest[key]
+                evicted.append(key)
+            return evicted
+
+        evicted = self._update(update)
+        if len(evicted) > 0:
+            logging.info('Evicted %d geogrid outputs from the cache\n%s' % (len(evicted), '\n'.join(evicted)))
+        return evicted
@@ -0,0 +1,187 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from curwrf.wrf import utils
+from curwrf.wrf.execution import downloader, grib_subset
+
+MANIFEST_FILE = 'gfs_cache.json'
+LOCK_FILE = '.gfs_cache.lock'
+
+_pinned = set()
+_pinned_lock = threading.Lock()
+
+
+def pin(keys):
+    """
+    protects the keys from eviction by any cache of this process, ex: inventories prefetched for a later date
+    """
+    with _pinned_lock:
+        _pinned.update(keys)
+
+
+def unpin(keys):
+    with _pinned_lock:
+        _pinned.difference_update(keys)
+
+
+def get_key(date_str, cycle, res, fcst_id, fields=None):
+    """
+    :param fields: GRIB2 fields of a subset download. a subset file is cached separately from the full inventory
+    :return: cache key of a GFS inventory
+    """
+    key = '%s.%s.%s.%s' % (date_str, cycle, res, fcst_id)
+    if fields:
+        key += '.subset-' + hashlib.md5(','.join(sorted(fields))).hexdigest()[0:8]
+    return key
+
+
+class GfsCache:
+    """
+    Keeps the downloaded GFS inventories in the gfs_dir across runs. The manifest tracks the size, md5 and the last
+    access time of each inventory, and the least recently used inventories are evicted once the total size exceeds
+    max_size. The manifest is shared between threads and processes using the same gfs_dir.
+    """
+
+    def __init__(self, cache_dir, max_size=0):
+        """
+        :param cache_dir: dir of the cached files and the manifest
+        :param max_size: disk budget in bytes. <= 0 for an unbounded cache
+        """
+        self.cache_dir = utils.create_dir_if_not_exists(cache_dir)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def _load(self):
+        path = os.path.join(self.cache_dir, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                logging.warning('Unable to read the GFS cache manifest %s. Starting with an empty cache' % path)
+                return {}
+
+    def _save(self, manifest):
+        path = os.path.join(self.cache_dir, MANIFEST_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def _update(self, update_fn):
+        """
+        loads the manifest, applies the update_fn(manifest) and saves it, while holding both the thread and the file
+        lock
+        :return: return value of the update_fn
+        """
+        with self.lock:
+            with open(os.path.join(self.cache_dir, LOCK_FILE), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    manifest = self._load()
+                    result = update_fn(manifest)
+                    self._save(manifest)
+                    return result
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _get_path(self, entry):
+        return os.path.join(self.cache_dir, entry['file'])
+
+    def _new_entry(self, path):
+        return {'file': os.path.relpath(path, self.cache_dir),
+                'size': os.path.getsize(path),
+                'md5': downloader.get_md5(path),
+                'last_access': time.time()}
+
+    def put(self, key, path):
+        """
+        adds the file to the cache. the file should be inside the cache_dir. other entries of the same file (ex: a
+        subset download replacing a full inventory) are dropped
+        """
+        entry = self._new_entry(path)
+
+        def update(manifest):
+            for k in [k for k, e in manifest.items() if e['file'] == entry['file']]:
+                del manifest[k]
+            manifest[key] = entry
+
+        self._update(update)
+        logging.debug('GFS cache put %s -> %s' % (key, path))
+
+    def get(self, key, path=None):
+        """
+        looks up the key and marks it as accessed. the cached file should match the size and md5 of the entry, else the
+        entry and the file are removed, to be downloaded again. a complete GRIB2 file at the path which is not in the
+        manifest yet (ex: downloaded by an older version) is adopted into the cache
+        :return: path of the cached file or None if it is not available
+        """
+
+        def update(manifest):
+            entry = manifest.get(key)
+            if entry is not None:
+                cached = self._get_path(entry)
+                if os.path.exists(cached) and os.path.getsize(cached) == entry['size'] and downloader.get_md5(
+                        cached) == entry['md5']:
+                    entry['last_access'] = time.time()
+                    return cached
+                logging.warning('GFS cache entry %s is missing, truncated or corrupted. Removing it' % key)
+                # not to be adopted again below
+                for f in [cached, grib_subset.get_idx_file(cached)]:
+                    if os.path.exists(f):
+                        os.remove(f)
+                del manifest[key]
+
+            if path is not None and os.path.exists(path) and utils.is_grib2_file_complete(path) and not any(
+                    e['file'] == os.path.relpath(path, self.cache_dir) for e in manifest.values()):
+                manifest[key] = self._new_entry(path)
+                return path
+            return None
+
+        return self._update(update)
+
+    def evict(self, pinned=()):
+        """
+        removes the least recently used files until the cache fits in the max_size
+        :param pinned: keys which should not be evicted, in addition to the keys pinned with pin(), ex: inventories of
+        the current run
+        :return: list of evicted keys
+        """
+        if self.max_size <= 0:
+            return []
+        with _pinned_lock:
+            pinned = set(pinned) | _pinned
+
+        def update(manifest):
+            total = sum(e['size'] for e in manifest.values())
+            evicted = []
+            for key, entry in sorted(manifest.items(), key=lambda x: x[1]['last_access']):
+                if total <= self.max_size:
+                    break
+                if key in pinned:
+                    continue
+                cached = self._get_path(entry)
+                for f in [cached, grib_subset.get_idx_file(cached)]:
+                    if os.path.exists(f):
+                        os.remove(f)
+                total -= entry['size']
+                del manifest[key]
+                evicted.append(key)
+
+            if total > self.max_size:
+                logging.warning('GFS cache size %d exceeds the limit %d with pinned entries' % (total, self.max_size))
+            return evicted
+
+        evicted = self._update(update)
+        if len(evicted) > 0:
+            logging.info('Evicted %d GFS inventories from the cache\n%s' % (len(evicted), '\n'.join(evicted)))
+        return evicted
+
+    def get_size(self):
+        with self.lock:
+            return sum(e['size'] for e in self._load().values())
@@ -0,0 +1,81 @@
+import ftplib
+import logging
+import threading
+import time
+
+from curwrf.wrf.execution import downloader, grib_subset
+
+POLL_LOOKAHEAD = 4
+
+
+class GfsCyclePoller(threading.Thread):
+    """
+    Watches a GFS cycle which is still being published. NCEP writes the .idx of each forecast hour after its GRIB2
+    file, hence an .idx is taken as the signal that the inventory is complete. Only the next few unpublished hours are
+    polled. The poll interval is reset to min_interval whenever a new hour appears and doubles up to max_interval
+    otherwise.
+    """
+
+    def __init__(self, urls, min_interval, max_interval, timeout, pool=None):
+        """
+        :param urls: inventory urls in the order of publication
+        :param min_interval: seconds between polls while new hours keep appearing
+        :param max_interval: max seconds between polls
+        :param timeout: seconds after which the hours still unpublished are given up
+        :param pool: downloader.ConnectionPool to use. default pool is used if None
+        """
+        threading.Thread.__init__(self, name='gfs-poller')
+        self.daemon = True
+        self.urls = urls
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.pool = pool if pool is not None else downloader.get_default_pool()
+        self.published = set()
+        self.done = False
+        self.cond = threading.Condition()
+
+    def is_published(self, url):
+        try:
+            self.pool.open(url + grib_subset.IDX_SUFFIX).close()
+            return True
+        except (downloader.HttpError, ftplib.error_perm):
+            return False
+        except Exception as e:
+            logging.warning('Unable to poll %s : %s' % (url, str(e)))
+            return False
+
+    def run(self):
+        start_time = time.time()
+        interval = self.min_interval
+        pending = list(self.urls)
+        try:
+            while len(pending) > 0 and time.time() - start_time < self.timeout:
+                new = [u for u in pending[0:POLL_LOOKAHEAD] if self.is_published(u)]
+                if len(new) > 0:
+                    logging.info('GFS inventories published: %s' % ', '.join(new))
+                    with self.cond:
+                        self.published.update(new)
+                        self.cond.notify_all()
+                    pending = [u for u in pending if u not in new]
+                    interval = self.min_interval
+                    continue
+                logging.info('Waiting %s s for %s to be published' % (interval, pending[0]))
+                time.sleep(interval)
+                interval = min(interval * 2, self.max_interval)
+            if len(pending) > 0:
+                logging.error('%d GFS inventories were not published within %d s' % (len(pending), self.timeout))
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def wait_for(self, url):
+        """
+        blocks until the url is published or the poller gives up
+        :return: True if the url is published
+        """
+        with self.cond:
+            while url not in self.published and not self.done:
+                self.cond.wait(1)
+            return url in self.published
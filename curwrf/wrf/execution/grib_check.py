@@ -0,0 +1,131 @@
+import datetime as dt
+import mmap
+import os
+import struct
+
+# (discipline, parameter category, parameter number) -> short name of the GRIB2 parameters read by ungrib
+PARAMETERS = {
+    (0, 0, 0): 'TMP',
+    (0, 1, 0): 'SPFH',
+    (0, 1, 1): 'RH',
+    (0, 1, 11): 'SNOD',
+    (0, 1, 13): 'WEASD',
+    (0, 2, 2): 'UGRD',
+    (0, 2, 3): 'VGRD',
+    (0, 3, 0): 'PRES',
+    (0, 3, 1): 'PRMSL',
+    (0, 3, 5): 'HGT',
+    (0, 3, 192): 'MSLET',
+    (2, 0, 0): 'LAND',
+    (2, 0, 2): 'TSOIL',
+    (2, 0, 192): 'SOILW',
+    (2, 3, 18): 'TSOIL',
+    (10, 2, 0): 'ICEC',
+}
+
+# product definition templates with the forecast time at octets 19-22, and no time interval
+INSTANT_TEMPLATES = (0, 1)
+TIME_UNIT_HOURS = {0: 1.0 / 60, 1: 1, 2: 24, 10: 3, 11: 6, 12: 12}
+
+
+class GribRecord:
+    def __init__(self, offset, var, ref_time, fcst_hours):
+        """
+        :param fcst_hours: forecast hour of an instantaneous field, None for the fields over a time interval
+        """
+        self.offset = offset
+        self.var = var
+        self.ref_time = ref_time
+        self.fcst_hours = fcst_hours
+
+    def get_valid_time(self):
+        if self.fcst_hours is None:
+            return None
+        return self.ref_time + dt.timedelta(hours=self.fcst_hours)
+
+
+def scan_grib2(path):
+    """
+    reads the section headers of each field in the GRIB2 file through a memory map, without decoding any data
+    :return: list of GribRecords
+    :raise InvalidGribFile: if the file is truncated or not a GRIB2 file
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        raise InvalidGribFile(path, 'empty file')
+
+    records = []
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset < size:
+                if size - offset < 16 or m[offset:offset + 4] != 'GRIB' or ord(m[offset + 7]) != 2:
+                    raise InvalidGribFile(path, 'no GRIB2 indicator section at byte %d' % offset)
+                discipline = ord(m[offset + 6])
+                msg_len = struct.unpack_from('>Q', m, offset + 8)[0]
+                end = offset + msg_len
+                if msg_len < 20 or end > size or m[end - 4:end] != '7777':
+                    raise InvalidGribFile(path, 'truncated message at byte %d' % offset)
+
+                ref_time = None
+                pos = offset + 16
+                while pos < end - 4:
+                    sec_len, sec_num = struct.unpack_from('>IB', m, pos)
+                    if sec_len < 5 or pos + sec_len > end - 4:
+                        raise InvalidGribFile(path, 'invalid section %d at byte %d' % (sec_num, pos))
+                    if sec_num == 1:
+                        ref_time = dt.datetime(*struct.unpack_from('>H5B', m, pos + 12))
+                    elif sec_num == 4:
+                        records.append(_read_product_definition(m, pos, offset, discipline, ref_time))
+                    pos += sec_len
+                offset = end
+        finally:
+            m.close()
+    return records
+
+
+def _read_product_definition(m, pos, msg_offset, discipline, ref_time):
+    template, category, number = struct.unpack_from('>H2B', m, pos + 7)
+    fcst_hours = None
+    if template in INSTANT_TEMPLATES:
+        unit, fcst = struct.unpack_from('>Bi', m, pos + 17)
+        if unit in TIME_UNIT_HOURS:
+            fcst_hours = fcst * TIME_UNIT_HOURS[unit]
+    var = PARAMETERS.get((discipline, category, number), '%d.%d.%d' % (discipline, category, number))
+    return GribRecord(msg_offset, var, ref_time, fcst_hours)
+
+
+def validate_grib2(path, valid_time, required_vars=(), expected_records=None):
+    """
+    checks that the file is a complete GRIB2 file with the expected num. of records and the required variables, valid
+    at the valid_time
+    :param valid_time: expected valid time (reference time + forecast hour) of the instantaneous fields
+    :param required_vars: short names of the variables which should be present, ex: ['HGT', 'TMP']
+    :param expected_records: num. of records of the file, ex: from its .idx inventory. a file cut off at a message
+    boundary, or a subset missing records, is complete otherwise. not checked if None
+    :return: list of GribRecords
+    :raise InvalidGribFile: if any of the checks fail
+    """
+    records = scan_grib2(path)
+    if len(records) == 0:
+        raise InvalidGribFile(path, 'no records')
+    if expected_records is not None and len(records) != expected_records:
+        raise InvalidGribFile(path, '%d records, expected %d' % (len(records), expected_records))
+
+    missing = set(required_vars) - set(r.var for r in records)
+    if len(missing) > 0:
+        raise InvalidGribFile(path, 'missing variables %s' % ', '.join(sorted(missing)))
+
+    valid_times = set(r.get_valid_time() for r in records if r.fcst_hours is not None)
+    if len(valid_times - {valid_time}) > 0:
+        raise InvalidGribFile(path, 'valid time %s, expected %s' % (
+            ', '.join(str(t) for t in sorted(valid_times)), str(valid_time)))
+    return records
+
+
+class InvalidGribFile(Exception):
+    def __init__(self, path, msg):
+        self.path = path
+        self.msg = msg
+        Exception.__init__(self, 'Invalid GRIB2 file %s : %s' % (path, msg))
@@ -0,0 +1,381 @@
+import datetime as dt
+import logging
+import os
+import re
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+
+from curwrf.wrf import utils
+from curwrf.wrf.execution import downloader, grib_check
+
+IDX_SUFFIX = '.idx'
+MAX_RANGES_PER_REQUEST = 32
+
+
+class IdxRecord:
+    def __init__(self, num, start, var, level, fcst, ref_date=None):
+        self.num = num
+        self.start = start
+        self.end = None  # inclusive end byte. None for the last record (till EOF)
+        self.var = var
+        self.level = level
+        self.fcst = fcst
+        self.ref_date = ref_date
+
+    def to_line(self, start):
+        """
+        :param start: byte offset of the record
+        :return: .idx line of the record
+        """
+        return '%s:%d:%s:%s:%s:%s:' % (self.num, start, self.ref_date, self.var, self.level, self.fcst)
+
+    def matches(self, field):
+        """
+        :param field: 'VAR:level' where the level is a regex, ex: 'TMP:\d+ mb', 'UGRD:10 m above ground'
+        """
+        var, level = field.split(':', 1)
+        return self.var == var and re.match('(?:%s)$' % level, self.level) is not None
+
+
+def parse_idx(idx_text):
+    """
+    parses a wgrib2 inventory (.idx) file. each line is of the form
+    1:0:d=2017061000:PRMSL:mean sea level:anl:
+    sub-messages (ex: 23.1, 23.2) share the byte range of their message
+    :return: list of IdxRecords with the byte range of each record
+    """
+    records = []
+    for line in idx_text.splitlines():
+        if not line.strip():
+            continue
+        cols = line.split(':')
+        records.append(IdxRecord(cols[0], int(cols[1]), cols[3], cols[4], cols[5], cols[2]))
+
+    starts = sorted(set(r.start for r in records))
+    next_start = dict(zip(starts[:-1], starts[1:]))
+    for r in records:
+        if r.start in next_start:
+            r.end = next_start[r.start] - 1
+    return records
+
+
+def select_records(records, fields):
+    return [r for r in records if any(r.matches(f) for f in fields)]
+
+
+def get_byte_ranges(records):
+    """
+    merges the byte ranges of consecutive records. records sharing a byte range are fetched once
+    :return: list of [start, end] ranges. end is None if the range runs till the EOF
+    """
+    ranges = []
+    for start, end in sorted(set((r.start, r.end) for r in records)):
+        if len(ranges) > 0 and ranges[-1][1] is not None and ranges[-1][1] + 1 == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def get_subset_idx(records, byte_ranges):
+    """
+    :param records: IdxRecords within the byte_ranges
+    :return: .idx text of the records in a file of the byte_ranges written one after the other
+    """
+    lines = []
+    for r in records:
+        pos = 0
+        for start, end in byte_ranges:
+            if start <= r.start and (end is None or r.start <= end):
+                lines.append(r.to_line(pos + r.start - start))
+                break
+            pos += end - start + 1
+    return ''.join(line + '\n' for line in lines)
+
+
+def get_idx_file(path):
+    return path + IDX_SUFFIX
+
+
+def count_idx_records(path):
+    """
+    :param path: GRIB2 file path
+    :return: num. of records in the .idx inventory next to the file, or None if there is no inventory
+    """
+    idx = get_idx_file(path)
+    if not os.path.exists(idx):
+        return None
+    with open(idx, 'r') as f:
+        return len([line for line in f if line.strip()])
+
+
+def write_idx(path, idx_text):
+    """
+    writes the .idx inventory next to the GRIB2 file
+    """
+    idx = get_idx_file(path)
+    with open(idx + '.tmp', 'w') as f:
+        f.write(idx_text)
+    os.rename(idx + '.tmp', idx)
+
+
+def download_idx(urls, dest, pool=None):
+    """
+    downloads the .idx inventory of the GRIB2 file to the dest + IDX_SUFFIX, trying the urls in order
+    :param urls: GRIB2 file url, or its urls at each mirror
+    :return: True if the inventory was downloaded
+    """
+    pool = pool if pool is not None else downloader.get_default_pool()
+    for url in urls if isinstance(urls, (list, tuple)) else [urls]:
+        try:
+            response = pool.open(url + IDX_SUFFIX)
+            try:
+                idx_text = response.read()
+            finally:
+                response.close()
+            write_idx(dest, idx_text)
+            return True
+        except Exception as e:
+            logging.warning('Unable to download the inventory of %s : %s' % (url, str(e)))
+    return False
+
+
+def _range_spec(byte_range):
+    return '%d-%s' % (byte_range[0], '' if byte_range[1] is None else str(byte_range[1]))
+
+
+def _parse_multipart_byteranges(url, body, boundary):
+    """
+    :return: dict of start offset -> bytes of each part in a multipart/byteranges response
+    """
+    parts = {}
+    delimiter = '--' + boundary
+    pos = body.find(delimiter)
+    while pos >= 0:
+        pos += len(delimiter)
+        if body.startswith('--', pos):
+            break
+        headers_end = body.find('\r\n\r\n', pos)
+        headers = body[pos:headers_end]
+        m = re.search(r'Content-Range:\s*bytes\s+(\d+)-(\d+)/', headers, re.IGNORECASE)
+        if m is None:
+            raise downloader.CorruptedDownload(url, 'multipart response part without a Content-Range')
+        start, end = int(m.group(1)), int(m.group(2))
+        data_start = headers_end + 4
+        parts[start] = body[data_start:data_start + end - start + 1]
+        pos = body.find(delimiter, data_start + end - start + 1)
+    return parts
+
+
+def download_ranges(url, byte_ranges, pool, monitor=None, fresh=False):
+    """
+    downloads the byte ranges of the url with a single (multi-)range request
+    :param monitor: optional downloader.TransferMonitor to abort a stalled request
+    :param fresh: if True, a new connection is used
+    :return: list of bytes, one for each range
+    """
+    response = pool.open(url, {'Range': 'bytes=' + ','.join(_range_spec(r) for r in byte_ranges)}, fresh)
+    try:
+        content_type = response.getheader('Content-Type') or ''
+        chunks = []
+        downloader.read_monitored(response, monitor, chunks.append)
+        body = b''.join(chunks)
+        code = response.getcode()
+        content_range = response.getheader('Content-Range')
+    finally:
+        response.close()
+
+    if code == 206 and content_type.startswith('multipart/byteranges'):
+        boundary = re.search(r'boundary=("?)([^";]+)\1', content_type).group(2)
+        parts = _parse_multipart_byteranges(url, body, boundary)
+        data = []
+        for r in byte_ranges:
+            if r[0] not in parts:
+                raise downloader.CorruptedDownload(url, 'range %s missing in the response' % _range_spec(r))
+            data.append(parts[r[0]])
+        return data
+
+    if code == 206:
+        # server coalesced the ranges into a single range
+        offset = downloader.parse_content_range(content_range)[0] or 0
+    else:
+        logging.warning('Server does not support ranges for %s. Slicing the full response' % url)
+        offset = 0
+    return [body[r[0] - offset:None if r[1] is None else r[1] - offset + 1] for r in byte_ranges]
+
+
+def download_subset(url, dest, fields, validate_fn=None, max_ranges=MAX_RANGES_PER_REQUEST, pool=None, part=None,
+                    cancel_event=None, deadline=None, min_speed=None, stall_window=downloader.DEFAULT_STALL_WINDOW_S):
+    """
+    downloads only the GRIB2 records matching the fields, using the byte offsets in the .idx inventory published next
+    to the GRIB2 file. the selected records are written, in order, to a single GRIB2 file, with an .idx inventory of
+    them next to it
+    :param url: GRIB2 file url. url + '.idx' should be available
+    :param dest: destination file path
+    :param fields: list of 'VAR:level' fields where the level is a regex
+    :param validate_fn: optional callable(path) -> bool to validate the downloaded file before renaming
+    :param max_ranges: max num. of byte ranges per request
+    :param pool: downloader.ConnectionPool to use. default pool is used if None
+    :param part: path of the part file. <dest>.part if None
+    :param cancel_event: optional threading.Event. the download is cancelled between requests once it is set
+    :param deadline: max seconds for the download. None for no deadline
+    :param min_speed: min bytes/s over the stall_window. a stalled request is retried on a fresh connection, up to
+    downloader.STALL_RETRIES times. None for no floor
+    :param stall_window: seconds over which the throughput is averaged
+    :return: size of the downloaded file in bytes
+    """
+    pool = pool if pool is not None else downloader.get_default_pool()
+    start_time = time.time()
+    idx = pool.open(url + IDX_SUFFIX)
+    try:
+        records = parse_idx(idx.read())
+    finally:
+        idx.close()
+
+    selected = select_records(records, fields)
+    if len(selected) == 0:
+        raise downloader.CorruptedDownload(url, 'no records matching %s' % str(fields))
+    byte_ranges = get_byte_ranges(selected)
+    logging.info('Downloading %d of %d records of %s in %d ranges' % (len(selected), len(records), url,
+                                                                       len(byte_ranges)))
+
+    part = part if part is not None else downloader.get_part_file(dest)
+    with open(part, 'wb') as f:
+        for i in range(0, len(byte_ranges), max_ranges):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            batch = byte_ranges[i:i + max_ranges]
+            for attempt in range(downloader.STALL_RETRIES + 1):
+                monitor = downloader.TransferMonitor(url, deadline, min_speed, stall_window, start_time)
+                try:
+                    batch_data = download_ranges(url, batch, pool, monitor, fresh=attempt > 0)
+                    break
+                except downloader.DownloadStalled as e:
+                    if e.deadline_exceeded or attempt == downloader.STALL_RETRIES:
+                        raise
+                    logging.info('Retrying %s on a fresh connection' % url)
+            for r, data in zip(batch, batch_data):
+                if r[1] is not None and len(data) != r[1] - r[0] + 1:
+                    raise downloader.IncompleteDownload(url, len(data), r[1] - r[0] + 1)
+                f.write(data)
+
+    if cancel_event is not None and cancel_event.is_set():
+        os.remove(part)
+        raise downloader.DownloadCancelled(url)
+
+    if validate_fn is not None and not validate_fn(part):
+        os.remove(part)
+        raise downloader.CorruptedDownload(url, 'validation failed')
+
+    write_idx(dest, get_subset_idx(selected, byte_ranges))
+    size = os.path.getsize(part)
+    os.rename(part, dest)
+    return size
+
+
+def _make_grib2_message(var, ref_time, fcst_hours, data_len=64):
+    """
+    :return: a minimal GRIB2 message of the variable, with the identification, product definition and data sections
+    """
+    discipline, category, number = [k for k, v in grib_check.PARAMETERS.items() if v == var][0]
+    sec1 = struct.pack('>IB2H3BH5B2B', 21, 1, 7, 0, 2, 1, 1, ref_time.year, ref_time.month, ref_time.day,
+                       ref_time.hour, 0, 0, 0, 1)
+    sec4 = struct.pack('>IBHHBBBBBHBBi', 34, 4, 0, 0, category, number, 2, 0, 96, 0, 0, 1, fcst_hours) + '\0' * 12
+    sec7 = struct.pack('>IB', 5 + data_len, 7) + os.urandom(data_len)
+    msg_len = 16 + len(sec1) + len(sec4) + len(sec7) + 4
+    return 'GRIB\0\0' + chr(discipline) + chr(2) + struct.pack('>Q', msg_len) + sec1 + sec4 + sec7 + '7777'
+
+
+class TestGribSubset(unittest.TestCase):
+    RECORDS = [('PRMSL', 'mean sea level'), ('HGT', '500 mb'), ('TMP', '500 mb'), ('RH', '500 mb'), ('TMP', '850 mb'),
+               ('UGRD', '10 m above ground'), ('VGRD', '10 m above ground'), ('TMP', '2 m above ground')]
+    FIELDS = ['PRMSL:mean sea level', r'TMP:\d+ mb', 'UGRD:10 m above ground']
+
+    def setUp(self):
+        ref_time = dt.datetime(2017, 6, 10)
+        self.messages = [_make_grib2_message(var, ref_time, 3, 64 + 8 * i) for i, (var, _) in enumerate(self.RECORDS)]
+        idx = []
+        offset = 0
+        for i, ((var, level), msg) in enumerate(zip(self.RECORDS, self.messages)):
+            idx.append('%d:%d:d=2017061000:%s:%s:3 hour fcst:' % (i + 1, offset, var, level))
+            offset += len(msg)
+        path = '/gfs.t00z.pgrb2.0p50.f003'
+        self.server = downloader.LocalHttpServer({path: ''.join(self.messages),
+                                                  path + IDX_SUFFIX: '\n'.join(idx) + '\n'}).start()
+        self.url = self.server.get_url(path)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp_dir, '20170610.gfs.t00z.pgrb2.0p50.f003')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def get_expected(self):
+        return ''.join(m for (var, level), m in zip(self.RECORDS, self.messages) if
+                       any(IdxRecord(0, 0, var, level, '').matches(f) for f in self.FIELDS))
+
+    def test_download_subset(self):
+        size = download_subset(self.url, self.dest, self.FIELDS, validate_fn=utils.is_grib2_file_complete,
+                               pool=downloader.ConnectionPool())
+
+        with open(self.dest, 'rb') as f:
+            data = f.read()
+        self.assertEqual(data, self.get_expected())
+        self.assertEqual(size, len(data))
+        self.assertTrue(utils.is_grib2_file_complete(self.dest))
+        self.assertEqual([r.var for r in grib_check.scan_grib2(self.dest)], ['PRMSL', 'TMP', 'TMP', 'UGRD'])
+        self.assertFalse(os.path.exists(downloader.get_part_file(self.dest)))
+
+        # the .idx inventory of the subset points at the records in the subset file
+        with open(get_idx_file(self.dest), 'r') as f:
+            idx = parse_idx(f.read())
+        self.assertEqual([(r.var, r.level) for r in idx], [('PRMSL', 'mean sea level'), ('TMP', '500 mb'),
+                                                            ('TMP', '850 mb'), ('UGRD', '10 m above ground')])
+        self.assertEqual([r.start for r in idx], [r.offset for r in grib_check.scan_grib2(self.dest)])
+        self.assertEqual(len(grib_check.validate_grib2(self.dest, dt.datetime(2017, 6, 10, 3), ['PRMSL', 'TMP'],
+                                                       count_idx_records(self.dest))), 4)
+
+        # the .idx and a single multi-range request, with the adjacent TMP:850 mb and UGRD records merged
+        ranges = [r for p, r in self.server.requests if not p.endswith(IDX_SUFFIX)]
+        self.assertEqual(len(ranges), 1)
+        self.assertEqual(len(ranges[0].split(',')), 3)
+
+    def test_download_subset_batches(self):
+        download_subset(self.url, self.dest, self.FIELDS, validate_fn=utils.is_grib2_file_complete, max_ranges=1,
+                        pool=downloader.ConnectionPool())
+
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), self.get_expected())
+        self.assertTrue(utils.is_grib2_file_complete(self.dest))
+        self.assertEqual(len([p for p, r in self.server.requests if not p.endswith(IDX_SUFFIX)]), 3)
+
+    def test_download_subset_cut_at_message_boundary(self):
+        download_subset(self.url, self.dest, self.FIELDS, pool=downloader.ConnectionPool())
+        with open(self.dest, 'rb') as f:
+            data = f.read()
+        with open(self.dest, 'wb') as f:
+            f.write(data[0:len(data) - len(self.messages[5])])
+
+        # a complete GRIB2 file with the required variables, short of the last record
+        self.assertTrue(utils.is_grib2_file_complete(self.dest))
+        with self.assertRaises(grib_check.InvalidGribFile):
+            grib_check.validate_grib2(self.dest, dt.datetime(2017, 6, 10, 3), ['PRMSL', 'TMP'],
+                                      count_idx_records(self.dest))
+
+    def test_download_idx(self):
+        self.assertTrue(download_idx(['http://127.0.0.1:1/missing', self.url], self.dest, downloader.ConnectionPool()))
+        self.assertEqual(count_idx_records(self.dest), len(self.RECORDS))
+
+    def test_download_subset_no_match(self):
+        with self.assertRaises(downloader.CorruptedDownload):
+            download_subset(self.url, self.dest, ['SOILW:0-0.1 m below ground'], pool=downloader.ConnectionPool())
+        self.assertFalse(os.path.exists(self.dest))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(module)s %(levelname)s %(message)s')
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestGribSubset)
+    unittest.TextTestRunner(verbosity=2).run(suite)
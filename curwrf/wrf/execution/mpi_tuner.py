@@ -0,0 +1,250 @@
+import fcntl
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+from curwrf.wrf import utils
+from curwrf.wrf.execution import rsl_monitor
+
+# &domains settings written by the tuning, which are not part of the domain key
+DECOMPOSITION_KEYS = ['nproc_x', 'nproc_y', 'numtiles']
+STEP_PATTERN = re.compile(r'Timing for main: time \S+ on domain\s+1:\s+([\d.]+) elapsed seconds')
+# WRF needs patches of at least this many grid points in each direction
+MIN_PATCH_SIZE = 10
+# the first steps include the initialization and the first history output
+WARMUP_STEPS = 2
+DEFAULT_TILES = [1, 2, 4]
+DEFAULT_OMP_THREADS = [1]
+DEFAULT_TUNE_MINUTES = 60
+# candidates taking longer than this many times the best candidate so far are aborted
+ABORT_FACTOR = 3
+
+
+def get_machine_id():
+    """
+    :return: id of this machine, from the host name, the num. of cpus and the cpu model
+    """
+    model = ''
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    model = line.split(':', 1)[1].strip()
+                    break
+    return '%s:%d:%s' % (socket.gethostname(), multiprocessing.cpu_count(), model)
+
+
+def get_domain_key(namelist_input):
+    """
+    :return: key of the &domains settings of the namelist.input, except the decomposition
+    """
+    domains = utils.read_namelist(namelist_input).get('domains', {})
+    settings = dict((k, v) for k, v in domains.items() if k not in DECOMPOSITION_KEYS)
+    return hashlib.md5(json.dumps(settings, sort_keys=True)).hexdigest()
+
+
+def get_min_domain_size(namelist_input):
+    """
+    :return: (min e_we, min e_sn) over the domains of the namelist.input
+    """
+    domains = utils.read_namelist(namelist_input)['domains']
+    max_dom = int(domains['max_dom'][0])
+    return min(int(v) for v in domains['e_we'][0:max_dom]), min(int(v) for v in domains['e_sn'][0:max_dom])
+
+
+def get_default_procs(max_procs):
+    """
+    :return: powers of 2 up to max_procs, and max_procs itself
+    """
+    procs = []
+    p = 1
+    while p < max_procs:
+        procs.append(p)
+        p *= 2
+    return procs + [max_procs]
+
+
+def get_candidates(namelist_input, procs_list=None, tiles=DEFAULT_TILES, omp_threads=DEFAULT_OMP_THREADS,
+                   max_cores=None):
+    """
+    :param procs_list: num. of MPI ranks to try. powers of 2 up to the num. of cores if None
+    :param tiles: numtiles values to try
+    :param omp_threads: num. of OpenMP threads per rank to try
+    :param max_cores: max ranks * threads. num. of cpus if None
+    :return: list of settings dicts of procs, nproc_x, nproc_y, numtiles and omp_threads. decompositions leaving
+    patches smaller than MIN_PATCH_SIZE are skipped. nproc_x = nproc_y = -1 lets WRF pick the decomposition
+    """
+    max_cores = max_cores if max_cores is not None else multiprocessing.cpu_count()
+    procs_list = procs_list if procs_list else get_default_procs(max_cores)
+    e_we, e_sn = get_min_domain_size(namelist_input)
+
+    candidates = []
+    for procs in procs_list:
+        decompositions = [(-1, -1)] + [(x, procs // x) for x in range(1, procs + 1) if procs % x == 0 and
+                                       e_we // x >= MIN_PATCH_SIZE and e_sn // (procs // x) >= MIN_PATCH_SIZE]
+        for threads in omp_threads:
+            if procs * threads > max_cores:
+                continue
+            for nproc_x, nproc_y in decompositions:
+                for numtiles in tiles:
+                    candidates.append({'procs': procs, 'nproc_x': nproc_x, 'nproc_y': nproc_y, 'numtiles': numtiles,
+                                       'omp_threads': threads})
+    return candidates
+
+
+def get_namelist_values(settings):
+    return dict((k, settings[k]) for k in DECOMPOSITION_KEYS)
+
+
+def settings_to_string(settings):
+    return 'procs %d (%d x %d), numtiles %d, omp_threads %d' % (
+        settings['procs'], settings['nproc_x'], settings['nproc_y'], settings['numtiles'], settings['omp_threads'])
+
+
+def get_seconds_per_step(rsl_file):
+    """
+    :return: median elapsed seconds of the outer domain time steps in the rsl file, after the warm up steps. None if
+    there are not enough steps
+    """
+    steps = []
+    with open(rsl_file, 'r') as f:
+        for line in f:
+            m = STEP_PATTERN.search(line)
+            if m is not None:
+                steps.append(float(m.group(1)))
+    steps = sorted(steps[WARMUP_STEPS:])
+    if len(steps) == 0:
+        return None
+    return steps[len(steps) // 2]
+
+
+class DeadlineMonitor:
+    """
+    RslMonitor of a benchmark run, which also aborts the run after a deadline
+    """
+
+    def __init__(self, rsl_dir, deadline=None):
+        self.monitor = rsl_monitor.RslMonitor(rsl_dir)
+        self.deadline = deadline
+
+    def check(self):
+        reason = self.monitor.check()
+        if reason is None and self.deadline is not None and time.time() > self.deadline:
+            reason = 'slower than the best configuration'
+        return reason
+
+
+def benchmark(em_real_dir, settings, minutes=DEFAULT_TUNE_MINUTES, log_file=None, timeout=None):
+    """
+    runs wrf.exe in the em_real_dir for a short forecast window with the settings. real.exe should have been run
+    :param settings: dict of procs, nproc_x, nproc_y, numtiles and omp_threads
+    :param minutes: forecast window in minutes
+    :param timeout: seconds after which the run is aborted. no limit if None
+    :return: median seconds per outer domain time step, or None if the run failed
+    """
+    namelist_input = os.path.join(em_real_dir, 'namelist.input')
+    backup = namelist_input + '.tuning'
+    shutil.copy(namelist_input, backup)
+    try:
+        max_dom = int(utils.read_namelist(namelist_input)['domains']['max_dom'][0])
+        # no history or restart output within the window
+        utils.update_namelist(namelist_input, 'time_control', {
+            'run_days': 0, 'run_hours': 0, 'run_minutes': minutes, 'run_seconds': 0, 'restart': '.false.',
+            'history_interval': [str(minutes * 10)] * max_dom, 'restart_interval': minutes * 10})
+        utils.update_namelist(namelist_input, 'domains', get_namelist_values(settings))
+        utils.delete_files_with_prefix(em_real_dir, 'rsl*')
+
+        env = dict(os.environ, OMP_NUM_THREADS=str(settings['omp_threads']))
+        monitor = DeadlineMonitor(em_real_dir, time.time() + timeout if timeout is not None else None)
+        start_t = time.time()
+        try:
+            utils.run_subprocess('mpirun -np %d ./wrf.exe' % settings['procs'], cwd=em_real_dir, log_file=log_file,
+                                 monitor=monitor, env=env)
+        except (utils.SubprocessAborted, subprocess.CalledProcessError) as e:
+            logging.warning('Benchmark of %s failed: %s' % (settings_to_string(settings), str(e)))
+            return None
+
+        rsl_file = os.path.join(em_real_dir, rsl_monitor.RSL_FILES[1])
+        seconds = get_seconds_per_step(rsl_file) if os.path.exists(rsl_file) else None
+        logging.info('Benchmark of %s: %s s per step, %f s in total' % (settings_to_string(settings), seconds,
+                                                                        time.time() - start_t))
+        return seconds
+    finally:
+        os.rename(backup, namelist_input)
+        utils.delete_files_with_prefix(em_real_dir, 'rsl*')
+        utils.delete_files_with_prefix(em_real_dir, 'wrfout*')
+
+
+def tune(em_real_dir, store, candidates, minutes=DEFAULT_TUNE_MINUTES, log_file=None):
+    """
+    benchmarks the candidates and saves the fastest in the store, for this machine and the domain of the
+    namelist.input in the em_real_dir
+    :param store: TuningStore
+    :param candidates: list of settings dicts, ex: from get_candidates
+    :return: best settings dict, with the seconds per step, or None if all the candidates failed
+    """
+    best = None
+    best_elapsed = None
+    for i, settings in enumerate(candidates):
+        logging.info('Tuning candidate %d of %d: %s' % (i + 1, len(candidates), settings_to_string(settings)))
+        start_t = time.time()
+        seconds = benchmark(em_real_dir, settings, minutes, log_file,
+                            best_elapsed * ABORT_FACTOR if best_elapsed is not None else None)
+        if seconds is not None and (best is None or seconds < best['seconds_per_step']):
+            best = dict(settings, seconds_per_step=seconds)
+            best_elapsed = time.time() - start_t
+
+    if best is None:
+        logging.error('All the %d tuning candidates failed' % len(candidates))
+        return None
+    logging.info('Best configuration: %s, %f s per step' % (settings_to_string(best), best['seconds_per_step']))
+    store.put(get_machine_id(), get_domain_key(os.path.join(em_real_dir, 'namelist.input')), best)
+    return best
+
+
+class TuningStore:
+    """
+    Best MPI/OpenMP settings per machine and domain, in a json file shared between processes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                logging.warning('Unable to read the MPI tuning file %s' % self.path)
+                return {}
+
+    def get(self, machine_id, domain_key):
+        """
+        :return: settings dict, or None if the machine and domain are not tuned
+        """
+        with self.lock:
+            return self._load().get(machine_id, {}).get(domain_key)
+
+    def put(self, machine_id, domain_key, settings):
+        with self.lock:
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    tunings = self._load()
+                    tunings.setdefault(machine_id, {})[domain_key] = dict(settings, time=time.time())
+                    with open(self.path + '.tmp', 'w') as f:
+                        json.dump(tunings, f, indent=1, sort_keys=True)
+                    os.rename(self.path + '.tmp', self.path)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,197 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+from netCDF4 import Dataset
+
+from curwrf.wrf import constants
+
+# accumulated precipitation variables, summed and de-accumulated into PRECIP_VAR
+ACCUMULATED_PRECIP_VARS = ['RAINC', 'RAINNC', 'SNOWNC', 'GRAUPELNC']
+PRECIP_VAR = 'PRCP'
+SLIM_ATTR = 'SLIM_VARIABLES'
+FULL_POLICIES = ['archive', 'delete', 'keep']
+
+
+def is_slim(nc_f):
+    with Dataset(nc_f, 'r') as nc:
+        return SLIM_ATTR in nc.ncattrs()
+
+
+def slim_wrfout(src, dest, variables=constants.DEFAULT_WRFOUT_VARS, complevel=constants.DEFAULT_WRFOUT_COMPLEVEL):
+    """
+    writes a NetCDF4 copy of the wrfout file with only the variables, compressed and chunked by time step. floating
+    point variables are stored as float32. if all the ACCUMULATED_PRECIP_VARS are present, their sum is also written
+    de-accumulated as PRECIP_VAR, the precipitation (mm) since the previous time step (0 at the first one). the
+    accumulated variables are kept, so that readers of the full file work on the copy as well
+    :param variables: names of the variables to keep. missing ones are skipped
+    :return: dest
+    """
+    start_t = time.time()
+    with Dataset(src, 'r') as nc_in, Dataset(dest, 'w', format='NETCDF4') as nc_out:
+        nc_out.setncatts(dict((a, nc_in.getncattr(a)) for a in nc_in.ncattrs()))
+        nc_out.setncattr(SLIM_ATTR, ' '.join(variables))
+
+        keep = [v for v in variables if v in nc_in.variables]
+        missing = set(variables) - set(keep)
+        if len(missing) > 0:
+            logging.warning('Variables %s not in %s' % (', '.join(sorted(missing)), src))
+        for dim in set(d for v in keep for d in nc_in.variables[v].dimensions):
+            nc_out.createDimension(dim, None if nc_in.dimensions[dim].isunlimited() else len(nc_in.dimensions[dim]))
+
+        times_len = len(nc_in.dimensions['Time'])
+        for name in keep:
+            var_in = nc_in.variables[name]
+            dtype = np.float32 if var_in.dtype.kind == 'f' else var_in.dtype
+            # one time step of the full grid per chunk, as the extraction reads the fields
+            chunks = [1 if d == 'Time' else s for d, s in zip(var_in.dimensions, var_in.shape)]
+            var_out = nc_out.createVariable(name, dtype, var_in.dimensions, zlib=True, complevel=complevel,
+                                            shuffle=True, chunksizes=chunks if len(chunks) > 0 else None)
+            var_out.setncatts(dict((a, var_in.getncattr(a)) for a in var_in.ncattrs() if a != '_FillValue'))
+            if len(var_in.dimensions) > 0 and var_in.dimensions[0] == 'Time':
+                # a time step at a time, to bound the memory used
+                for t in range(times_len):
+                    var_out[t] = var_in[t]
+            else:
+                var_out[:] = var_in[:]
+
+        if all(v in nc_in.variables for v in ACCUMULATED_PRECIP_VARS):
+            dims = nc_in.variables[ACCUMULATED_PRECIP_VARS[0]].dimensions
+            shape = nc_in.variables[ACCUMULATED_PRECIP_VARS[0]].shape
+            for dim in dims:
+                if dim not in nc_out.dimensions:
+                    nc_out.createDimension(dim, None if nc_in.dimensions[dim].isunlimited() else
+                                           len(nc_in.dimensions[dim]))
+            prcp = nc_out.createVariable(PRECIP_VAR, np.float32, dims, zlib=True, complevel=complevel, shuffle=True,
+                                         chunksizes=[1] + list(shape[1:]))
+            prcp.setncatts({'description': 'PRECIPITATION SINCE THE PREVIOUS TIME STEP', 'units': 'mm',
+                            'stagger': ''})
+            prev = None
+            for t in range(times_len):
+                acc = sum(nc_in.variables[v][t] for v in ACCUMULATED_PRECIP_VARS)
+                prcp[t] = acc - prev if prev is not None else np.zeros(shape[1:], dtype=np.float32)
+                prev = acc
+
+    logging.info('Slimmed %s (%d MB) to %s (%d MB) in %f s' % (src, os.path.getsize(src) / 1024 / 1024, dest,
+                                                               os.path.getsize(dest) / 1024 / 1024,
+                                                               time.time() - start_t))
+    return dest
+
+
+def slim_in_place(nc_f, variables=constants.DEFAULT_WRFOUT_VARS, complevel=constants.DEFAULT_WRFOUT_COMPLEVEL,
+                  policy='archive', archive_dir=None):
+    """
+    replaces the wrfout file with its slim copy. files which are already slim are skipped
+    :param policy: what to do with the full file. 'archive' moves it to the archive_dir, 'delete' removes it and
+    'keep' leaves it next to the slim copy as <name>.full
+    """
+    if policy not in FULL_POLICIES:
+        raise ValueError('Unknown wrfout policy %s. Expected one of %s' % (policy, ', '.join(FULL_POLICIES)))
+    if is_slim(nc_f):
+        logging.info('%s is already slim' % nc_f)
+        return
+
+    tmp = nc_f + '.slim.tmp'
+    slim_wrfout(nc_f, tmp, variables, complevel)
+    if policy == 'archive':
+        if not os.path.exists(archive_dir):
+            os.makedirs(archive_dir)
+        shutil.move(nc_f, os.path.join(archive_dir, os.path.basename(nc_f)))
+    elif policy == 'keep':
+        os.rename(nc_f, nc_f + '.full')
+    else:
+        os.remove(nc_f)
+    os.rename(tmp, nc_f)
+
+
+def get_times(nc):
+    """
+    :return: the Times of the open wrfout file, ex: 2017-05-25_00:00:00
+    """
+    return [''.join(x) for x in nc.variables['Times'][0:len(nc.dimensions['Time'])]]
+
+
+def join_segments(files):
+    """
+    joins the wrfout files of consecutive segments of a run into the first one, ex: the files written by wrf.exe
+    restarted from restart files, each starting at its restart time. records of a file at or after the first time of
+    the next file are replaced by the records of the next file. the other files are removed once joined
+    :param files: wrfout files of a domain, in time order
+    :return: the first file
+    """
+    start_t = time.time()
+    tmp = files[0] + '.join.tmp'
+    shutil.copy(files[0], tmp)
+    with Dataset(tmp, 'a') as nc_out:
+        times = get_times(nc_out)
+        for f in files[1:]:
+            with Dataset(f, 'r') as nc_in:
+                segment_times = get_times(nc_in)
+                if len(segment_times) == 0:
+                    continue
+                start = len([t for t in times if t < segment_times[0]])
+                for name, var_in in nc_in.variables.items():
+                    if len(var_in.dimensions) == 0 or var_in.dimensions[0] != 'Time':
+                        continue
+                    if name not in nc_out.variables:
+                        logging.warning('Variable %s of %s not in %s' % (name, f, files[0]))
+                        continue
+                    var_out = nc_out.variables[name]
+                    # a time step at a time, to bound the memory used
+                    for t in range(len(segment_times)):
+                        var_out[start + t] = var_in[t]
+                times = times[0:start] + segment_times
+        if len(nc_out.dimensions['Time']) > len(times):
+            # records of an earlier segment after the end of the last one can not be dropped from the file
+            os.remove(tmp)
+            raise ValueError('%s has records after the end of %s' % (files[0], files[-1]))
+
+    os.rename(tmp, files[0])
+    for f in files[1:]:
+        os.remove(f)
+    logging.info('Joined %d segments into %s (%s to %s) in %f s' % (len(files), files[0], times[0], times[-1],
+                                                                      time.time() - start_t))
+    return files[0]
+
+
+class TestPostprocess(unittest.TestCase):
+    def create_wrfout(self, path, hours, rainnc):
+        with Dataset(path, 'w', format='NETCDF3_64BIT_OFFSET') as nc:
+            nc.createDimension('Time', None)
+            nc.createDimension('DateStrLen', 19)
+            nc.createDimension('south_north', 2)
+            nc.createDimension('west_east', 2)
+            times = nc.createVariable('Times', 'S1', ('Time', 'DateStrLen'))
+            rain = nc.createVariable('RAINNC', np.float32, ('Time', 'south_north', 'west_east'))
+            nc.createVariable('XLAT', np.float32, ('south_north',))[:] = [7.0, 8.0]
+            for t, (h, r) in enumerate(zip(hours, rainnc)):
+                times[t] = list('2017-05-25_%02d:00:00' % h)
+                rain[t] = np.full((2, 2), r, dtype=np.float32)
+
+    def test_join_restart_segments(self):
+        wrf_output = tempfile.mkdtemp()
+        try:
+            # wrf.exe failed after 06:00 and was restarted from the restart files at 04:00
+            first = os.path.join(wrf_output, 'wrfout_d03_2017-05-25_00:00:00')
+            segment = os.path.join(wrf_output, 'wrfout_d03_2017-05-25_05:00:00')
+            self.create_wrfout(first, range(0, 7), [0, 1, 2, 3, 4, 5, 6])
+            self.create_wrfout(segment, range(5, 9), [15, 16, 17, 18])
+
+            self.assertEqual(join_segments([first, segment]), first)
+            self.assertFalse(os.path.exists(segment))
+            with Dataset(first, 'r') as nc:
+                self.assertEqual(get_times(nc), ['2017-05-25_%02d:00:00' % h for h in range(0, 9)])
+                self.assertEqual(list(nc.variables['RAINNC'][:, 0, 0]), [0, 1, 2, 3, 4, 15, 16, 17, 18])
+                self.assertEqual(list(nc.variables['XLAT'][:]), [7.0, 8.0])
+        finally:
+            shutil.rmtree(wrf_output)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(module)s %(levelname)s %(message)s')
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPostprocess)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,139 @@
+import datetime as dt
+import logging
+import os
+import re
+import threading
+import time
+
+RSL_FILES = ['rsl.out.0000', 'rsl.error.0000']
+TIMING_PATTERN = re.compile(r'Timing for main: time (\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}) on domain\s+1:')
+CFL_PATTERN = re.compile(r'points exceeded cfl')
+FATAL_PATTERNS = [re.compile(p) for p in [r'FATAL CALLED', r'forrtl: severe', r'Segmentation fault']]
+# diagnostics may print NaN values of a healthy run. a blown up wrf.exe ends with the FATAL or CFL patterns
+NAN_PATTERN = re.compile(r'\bNaN\b')
+MAX_CFL_WARNINGS = 100
+PROGRESS_LOG_INTERVAL_S = 300
+
+
+class RslMonitor:
+    """
+    Tails the rsl files of the master rank while real.exe or wrf.exe runs. The 'Timing for main' lines of the outer
+    domain give the simulated time, from which the progress, throughput and ETA are derived. check() returns an abort
+    reason once a fatal pattern or too many CFL warnings appear, so that the run can be killed early. NaN values are
+    only logged. It is meant to be passed as the monitor of utils.run_subprocess.
+    """
+
+    def __init__(self, rsl_dir, start_time=None, end_time=None, max_cfl_warnings=MAX_CFL_WARNINGS,
+                 log_interval=PROGRESS_LOG_INTERVAL_S):
+        """
+        :param rsl_dir: dir the rsl files are written to
+        :param start_time: start of the simulated period. None if the progress is not tracked
+        :param end_time: end of the simulated period
+        :param max_cfl_warnings: num. of CFL warnings after which the run is considered to have blown up
+        :param log_interval: seconds between progress logs
+        """
+        self.rsl_dir = rsl_dir
+        self.start_time = start_time
+        self.end_time = end_time
+        self.max_cfl_warnings = max_cfl_warnings
+        self.log_interval = log_interval
+        self.offsets = dict((f, 0) for f in RSL_FILES)
+        self.first_sample = None
+        self.sim_time = None
+        self.wall_time = None
+        self.cfl_warnings = 0
+        self.nan_lines = 0
+        self.reason = None
+        self.last_log = time.time()
+        self.lock = threading.Lock()
+
+    def _read_new_lines(self, name):
+        path = os.path.join(self.rsl_dir, name)
+        if not os.path.exists(path):
+            return []
+        if os.path.getsize(path) < self.offsets[name]:
+            # a new run truncated the file
+            self.offsets[name] = 0
+        with open(path, 'r') as f:
+            f.seek(self.offsets[name])
+            data = f.read()
+        # a partially written last line is read again next time
+        end = data.rfind('\n') + 1
+        self.offsets[name] += end
+        return data[0:end].splitlines()
+
+    def on_line(self, line):
+        m = TIMING_PATTERN.search(line)
+        if m is not None:
+            try:
+                self.sim_time = dt.datetime.strptime(m.group(1), '%Y-%m-%d_%H:%M:%S')
+            except ValueError:
+                logging.warning('Unable to parse the timing line %s' % line.strip())
+                return
+            self.wall_time = time.time()
+            if self.first_sample is None:
+                self.first_sample = (self.sim_time, self.wall_time)
+        if CFL_PATTERN.search(line):
+            self.cfl_warnings += 1
+            if self.cfl_warnings > self.max_cfl_warnings and self.reason is None:
+                self.reason = '%d CFL warnings' % self.cfl_warnings
+        if NAN_PATTERN.search(line):
+            self.nan_lines += 1
+            if self.nan_lines == 1:
+                logging.warning('NaN in the rsl output: %s' % line.strip())
+        for p in FATAL_PATTERNS:
+            if p.search(line) and self.reason is None:
+                self.reason = 'fatal error: %s' % line.strip()
+
+    def check(self):
+        """
+        reads the new lines of the rsl files
+        :return: abort reason, or None if the run looks healthy
+        """
+        with self.lock:
+            for name in RSL_FILES:
+                for line in self._read_new_lines(name):
+                    self.on_line(line)
+            if time.time() - self.last_log >= self.log_interval:
+                self.last_log = time.time()
+                logging.info('Progress %s' % self._to_string())
+            return self.reason
+
+    def get_progress(self):
+        """
+        :return: dict of the simulated time, the fraction of the period done, the throughput (simulated seconds per
+        wall clock second) and the ETA. values are None until known
+        """
+        with self.lock:
+            return self._get_progress()
+
+    def _get_progress(self):
+        progress = {'sim_time': self.sim_time, 'fraction': None, 'throughput': None, 'eta': None}
+        if self.sim_time is None:
+            return progress
+        if self.start_time is not None and self.end_time is not None:
+            progress['fraction'] = (self.sim_time - self.start_time).total_seconds() / (
+                self.end_time - self.start_time).total_seconds()
+        sim_elapsed = (self.sim_time - self.first_sample[0]).total_seconds()
+        wall_elapsed = self.wall_time - self.first_sample[1]
+        if sim_elapsed > 0 and wall_elapsed > 0:
+            progress['throughput'] = sim_elapsed / wall_elapsed
+            if self.end_time is not None:
+                progress['eta'] = dt.datetime.now() + dt.timedelta(
+                    seconds=(self.end_time - self.sim_time).total_seconds() / progress['throughput'])
+        return progress
+
+    def _to_string(self):
+        p = self._get_progress()
+        if p['sim_time'] is None:
+            return 'not started'
+        return 'simulated till %s%s%s%s, %d CFL warnings, %d NaN lines' % (
+            p['sim_time'].strftime('%Y-%m-%d_%H:%M:%S'),
+            ' (%.1f%%)' % (p['fraction'] * 100) if p['fraction'] is not None else '',
+            ', %.1f simulated s/s' % p['throughput'] if p['throughput'] is not None else '',
+            ', ETA %s' % p['eta'].strftime('%Y-%m-%d %H:%M:%S') if p['eta'] is not None else '',
+            self.cfl_warnings, self.nan_lines)
+
+    def to_string(self):
+        with self.lock:
+            return self._to_string()
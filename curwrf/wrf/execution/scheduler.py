@@ -0,0 +1,207 @@
+import logging
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+
+
+class CoreScheduler:
+    """
+    Shares the cores of this machine between concurrent jobs, ex: the members of an ensemble. Requests are granted in
+    the order they are made, so that a large job is not starved by smaller ones overtaking it
+    """
+
+    def __init__(self, total_cores=None):
+        """
+        :param total_cores: num. of cores to share. num. of cpus if None
+        """
+        self.total_cores = total_cores if total_cores else multiprocessing.cpu_count()
+        self.free_cores = self.total_cores
+        self.queue = []
+        self.cond = threading.Condition()
+
+    def acquire(self, cores, name=None):
+        """
+        blocks until the cores are free and all the earlier requests are granted
+        :param cores: num. of cores
+        :return: num. of cores granted
+        :raise ValueError: if the cores are more than the total_cores. granting fewer would oversubscribe the cores
+        """
+        if cores > self.total_cores:
+            raise ValueError('%s needs %d cores, more than the %d cores shared' % (name, cores, self.total_cores))
+        ticket = object()
+        with self.cond:
+            self.queue.append(ticket)
+            while self.queue[0] is not ticket or self.free_cores < cores:
+                self.cond.wait()
+            self.queue.pop(0)
+            self.free_cores -= cores
+            # the next request may fit in the remaining cores
+            self.cond.notify_all()
+        logging.info('Granted %d cores to %s. %d free' % (cores, name, self.free_cores))
+        return cores
+
+    def release(self, cores):
+        with self.cond:
+            self.free_cores += cores
+            self.cond.notify_all()
+
+    @contextmanager
+    def cores(self, cores, name=None):
+        granted = self.acquire(cores, name)
+        try:
+            yield granted
+        finally:
+            self.release(granted)
+
+
+class Stage:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, name, fn, deps=(), resources=None):
+        """
+        :param fn: function run by the stage, without arguments
+        :param deps: names of the stages which should be done before this stage starts
+        :param resources: dict of resource -> amount held while the stage runs, ex: {'cores': 4, 'disk': 1}
+        """
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.resources = resources if resources is not None else {}
+        self.state = Stage.PENDING
+        self.error = None
+        self.ready_time = None
+        self.start_time = None
+        self.end_time = None
+
+
+class StageScheduler:
+    """
+    Runs a DAG of stages in threads, starting each stage once its dependencies are done and its resources are free.
+    Resources are counted against the capacities of the node, ex: {'cores': 16, 'net': 2, 'disk': 2}. Ready stages
+    are considered in the order they were added; a ready stage which does not fit reserves its resources, so that later
+    stages only start in what is left, and are not able to starve it. Stages depending on a failed stage are skipped
+    """
+
+    def __init__(self, capacities):
+        """
+        :param capacities: dict of resource -> amount. resources not in it are unlimited
+        """
+        self.capacities = dict(capacities)
+        self.free = dict(capacities)
+        self.stages = []
+        self.stage_map = {}
+        self.cond = threading.Condition()
+
+    def add(self, name, fn, deps=(), resources=None):
+        """
+        adds a stage. dependencies should be added before the stages depending on them
+        :return: Stage
+        :raise ValueError: if the stage needs more of a resource than its capacity, as it would never start. starting it
+        with less would oversubscribe the node
+        """
+        if name in self.stage_map:
+            raise ValueError('Duplicate stage %s' % name)
+        for dep in deps:
+            if dep not in self.stage_map:
+                raise ValueError('Unknown dependency %s of stage %s' % (dep, name))
+        for r, v in (resources or {}).items():
+            if r in self.capacities and v > self.capacities[r]:
+                raise ValueError('Stage %s needs %d %s, more than the capacity %d' % (name, v, r, self.capacities[r]))
+        stage = Stage(name, fn, deps, resources)
+        self.stages.append(stage)
+        self.stage_map[name] = stage
+        return stage
+
+    def _fits(self, resources, available):
+        return all(available.get(r, v) >= v for r, v in resources.items())
+
+    def _run_stage(self, stage):
+        try:
+            stage.fn()
+            state = Stage.DONE
+        except Exception as e:
+            logging.error('Stage %s failed: %s' % (stage.name, str(e)))
+            stage.error = e
+            state = Stage.FAILED
+        with self.cond:
+            stage.state = state
+            stage.end_time = time.time()
+            for r, v in stage.resources.items():
+                if r in self.free:
+                    self.free[r] += v
+            self.cond.notify_all()
+
+    def _dispatch(self):
+        """
+        starts the ready stages which fit. called with the cond held
+        :return: num. of stages started
+        """
+        started = 0
+        available = dict(self.free)
+        for stage in self.stages:
+            if stage.state != Stage.PENDING:
+                continue
+            dep_states = [self.stage_map[d].state for d in stage.deps]
+            if any(s in (Stage.FAILED, Stage.SKIPPED) for s in dep_states):
+                logging.warning('Skipping stage %s as its dependencies failed' % stage.name)
+                stage.state = Stage.SKIPPED
+                continue
+            if any(s != Stage.DONE for s in dep_states):
+                continue
+            if stage.ready_time is None:
+                stage.ready_time = time.time()
+            fits = self._fits(stage.resources, available) and self._fits(stage.resources, self.free)
+            for r, v in stage.resources.items():
+                if r in available:
+                    available[r] = max(available[r] - v, 0)
+            if not fits:
+                continue
+
+            for r, v in stage.resources.items():
+                if r in self.free:
+                    self.free[r] -= v
+            stage.state = Stage.RUNNING
+            stage.start_time = time.time()
+            logging.info('Starting stage %s %s' % (stage.name, stage.resources))
+            t = threading.Thread(target=self._run_stage, args=(stage,), name=stage.name)
+            t.daemon = True
+            t.start()
+            started += 1
+        return started
+
+    def run(self):
+        """
+        runs all the stages and waits for them to finish
+        :raise StagesFailed: if any of the stages failed
+        """
+        start_time = time.time()
+        with self.cond:
+            while True:
+                self._dispatch()
+                if all(s.state in (Stage.DONE, Stage.FAILED, Stage.SKIPPED) for s in self.stages):
+                    break
+                self.cond.wait()
+
+        for stage in self.stages:
+            if stage.start_time is not None:
+                logging.info('Stage %s %s: waited %f s, ran %f s' % (stage.name, stage.state,
+                                                                   stage.start_time - stage.ready_time,
+                                                                   stage.end_time - stage.start_time))
+            else:
+                logging.info('Stage %s %s' % (stage.name, stage.state))
+        logging.info('%d stages finished in %f s' % (len(self.stages), time.time() - start_time))
+
+        failed = [s for s in self.stages if s.state == Stage.FAILED]
+        if len(failed) > 0:
+            raise StagesFailed(failed)
+
+
+class StagesFailed(Exception):
+    def __init__(self, stages):
+        self.stages = stages
+        Exception.__init__(self, 'Stages failed: %s' % ', '.join('%s (%s)' % (s.name, str(s.error)) for s in stages))
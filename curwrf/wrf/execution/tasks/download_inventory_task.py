@@ -8,8 +8,8 @@ from curwrf.wrf.execution import executor
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Downloading single inventory')
-    parser.add_argument('url', dest='url')
-    parser.add_argument('dest', dest='url')
+    parser.add_argument('url')
+    parser.add_argument('dest')
 
     return parser.parse_args()
 
@@ -0,0 +1,286 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from curwrf.wrf import constants
+
+# wrfouts kept in memory. the RAINCELL of a date needs the 2 previous days as well, which should stay cached while
+# the next date is read
+DEFAULT_CACHE_SIZE = 4
+
+
+class Precip:
+    """
+    De-accumulated precipitation of a wrfout file. rf[t] is the precipitation (mm) from times[t] to times[t + 1]. The
+    rf is either loaded in memory, or streamed from the file a chunk of time steps at a time
+    """
+
+    def __init__(self, nc_f, times, xlat, xlong, rf=None):
+        """
+        :param times: all the time steps of the file, ex: 2017-05-25_00:00:00
+        :param xlat: 2D latitudes of the grid
+        :param xlong: 2D longitudes of the grid
+        :param rf: (len(times) - 1, south_north, west_east) array. None if the rf is streamed from the file
+        """
+        self.nc_f = nc_f
+        self.times = times
+        self.times_len = len(times)
+        self.xlat = xlat
+        self.xlong = xlong
+        self.lats = xlat[:, 0]
+        self.lons = xlong[0, :]
+        self.rf = rf
+
+    def get_rf_times(self):
+        return np.array(self.times[0:self.times_len - 1])
+
+    def iter_chunks(self, chunk_size=constants.DEFAULT_EXTRACT_CHUNK_SIZE):
+        """
+        :return: generator of (t, rf of the time steps t to t + len(rf))
+        """
+        if self.rf is None:
+            return read_precip_chunks(self.nc_f, chunk_size)
+        return ((t, self.rf[t:t + chunk_size]) for t in range(0, len(self.rf), chunk_size))
+
+    def get_series(self, select, steps=None, chunk_size=constants.DEFAULT_EXTRACT_CHUNK_SIZE):
+        """
+        :param select: fn(rf) returning the values kept of each time step, ex: the values of an area
+        :param steps: num. of time steps from the start. all if None
+        :return: array of the selected values of the time steps
+        """
+        steps = self.times_len - 1 if steps is None else min(steps, self.times_len - 1)
+        if self.rf is not None:
+            return select(self.rf[0:steps])
+        series = None
+        for t, rf in self.iter_chunks(chunk_size):
+            if t >= steps:
+                break
+            values = select(rf[0:steps - t])
+            if series is None:
+                series = np.empty((steps,) + values.shape[1:], dtype=values.dtype)
+            series[t:t + len(values)] = values
+        return series
+
+    def get_point_indices(self, lat, lon):
+        """
+        :return: lat_idx, lon_idx of the grid point closest to the lat, lon
+        """
+        return np.argmin(abs(self.lats - lat)), np.argmin(abs(self.lons - lon))
+
+    def get_point_series(self, lat, lon):
+        """
+        :return: rf series of the grid point closest to the lat, lon, times
+        """
+        lat_idx, lon_idx = self.get_point_indices(lat, lon)
+        return self.get_series(lambda rf: rf[:, lat_idx, lon_idx]), self.get_rf_times()
+
+    def get_area_indices(self, lat_min, lat_max, lon_min, lon_max):
+        """
+        :return: lat_min_idx, lat_max_idx, lon_min_idx, lon_max_idx of the grid points covering the area
+        """
+        return np.argmax(self.lats >= lat_min) - 1, np.argmax(self.lats >= lat_max), \
+            np.argmax(self.lons >= lon_min) - 1, np.argmax(self.lons >= lon_max)
+
+    def get_area_series(self, lat_min, lat_max, lon_min, lon_max):
+        """
+        :return: rf series of the grid points covering the area, lats, lons, times
+        """
+        lat_min_idx, lat_max_idx, lon_min_idx, lon_max_idx = self.get_area_indices(lat_min, lat_max, lon_min, lon_max)
+        return self.get_series(lambda rf: rf[:, lat_min_idx:lat_max_idx, lon_min_idx:lon_max_idx]), \
+            self.lats[lat_min_idx:lat_max_idx], self.lons[lon_min_idx:lon_max_idx], self.get_rf_times()
+
+
+def read_precip_header(nc_f):
+    """
+    reads the times and the grid of the wrfout file
+    :return: Precip, streaming the rf from the file
+    """
+    if not os.path.exists(nc_f):
+        raise IOError('File %s not found' % nc_f)
+    from netCDF4 import Dataset
+
+    with Dataset(nc_f, 'r') as nc:
+        times_len = len(nc.dimensions['Time'])
+        times = [''.join(x) for x in nc.variables['Times'][0:times_len]]
+        return Precip(nc_f, times, nc.variables['XLAT'][0], nc.variables['XLONG'][0])
+
+
+def read_precip_chunks(nc_f, chunk_size=constants.DEFAULT_EXTRACT_CHUNK_SIZE):
+    """
+    reads the precipitation of the wrfout file chunk_size time steps at a time. the RAINC, RAINNC, SNOWNC and GRAUPELNC
+    accumulations are summed in place in float32 and de-accumulated, carrying the last accumulation of a chunk over to
+    the next. the PRCP of a slim file is used as it is. the memory used depends on the chunk_size and the grid, not on
+    the num. of time steps
+    :return: generator of (t, rf of the time steps t to t + len(rf))
+    """
+    from netCDF4 import Dataset
+    from curwrf.wrf.execution import postprocess
+
+    with Dataset(nc_f, 'r') as nc:
+        times_len = len(nc.dimensions['Time'])
+        slim = postprocess.PRECIP_VAR in nc.variables
+        prev = None
+        for start in range(0, times_len, chunk_size):
+            end = min(start + chunk_size, times_len)
+            if slim:
+                rf = np.asarray(nc.variables[postprocess.PRECIP_VAR][start:end], dtype=np.float32)
+            else:
+                rf = np.asarray(nc.variables[postprocess.ACCUMULATED_PRECIP_VARS[0]][start:end], dtype=np.float32)
+                for v in postprocess.ACCUMULATED_PRECIP_VARS[1:]:
+                    rf += nc.variables[v][start:end]
+                last = rf[-1].copy()
+                # de-accumulated from the last step backwards, so that no other copy of the chunk is needed
+                for i in range(len(rf) - 1, 0, -1):
+                    rf[i] -= rf[i - 1]
+                if prev is not None:
+                    rf[0] -= prev
+                prev = last
+            # the first step has no precipitation since a previous step
+            if start > 0:
+                yield start - 1, rf
+            elif len(rf) > 1:
+                yield 0, rf[1:]
+
+
+def load_precip(nc_f, chunk_size=constants.DEFAULT_EXTRACT_CHUNK_SIZE):
+    """
+    reads the times, the grid and the precipitation of the wrfout file into memory. see read_precip_chunks
+    :return: Precip
+    """
+    start_t = time.time()
+    precip = read_precip_header(nc_f)
+    precip.rf = np.empty((max(precip.times_len - 1, 0),) + precip.xlat.shape, dtype=np.float32)
+    for t, rf in read_precip_chunks(nc_f, chunk_size):
+        precip.rf[t:t + len(rf)] = rf
+    logging.info('Loaded the precipitation of %s in %f s' % (nc_f, time.time() - start_t))
+    return precip
+
+
+def as_precip(precip):
+    """
+    :param precip: Precip, or the path of a wrfout file
+    :return: Precip. the rf of a file is streamed
+    """
+    return precip if isinstance(precip, Precip) else read_precip_header(precip)
+
+
+class ChunkConsumer:
+    """
+    Extractor fed with the rf of a wrfout file a chunk of time steps at a time, so that its memory does not grow with
+    the num. of time steps
+    """
+
+    def start(self, precip, date):
+        """
+        :param precip: Precip of the file, with the times and the grid. the rf may not be loaded
+        """
+        pass
+
+    def on_chunk(self, t, rf):
+        """
+        :param rf: rf of the time steps t to t + len(rf)
+        """
+        pass
+
+    def finish(self, results):
+        """
+        :param results: dict of the names of the extractors finished before this one to their results
+        :return: result of the extractor
+        """
+        return None
+
+
+def run_consumer(nc_f, date, consumer, chunk_size=constants.DEFAULT_EXTRACT_CHUNK_SIZE, results=None):
+    """
+    runs a ChunkConsumer on a wrfout file
+    :param nc_f: Precip, or the path of the wrfout file
+    :return: result of the consumer
+    """
+    precip = as_precip(nc_f)
+    consumer.start(precip, date)
+    for t, rf in precip.iter_chunks(chunk_size):
+        consumer.on_chunk(t, rf)
+    return consumer.finish(results if results is not None else {})
+
+
+class ExtractionEngine:
+    """
+    Reads each wrfout file once and feeds the rf to all the extractors, ex: the ASC grids, the station series, the
+    RAINCELL and the basin means. ChunkConsumers are fed together, a chunk of time steps at a time, and finished in
+    the order they were added. Extractors added as functions need all the rf in memory; if there are any, the file is
+    loaded, and recently loaded files are cached so that extractors looking at the previous days do not read them
+    again
+    """
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, chunk_size=constants.DEFAULT_EXTRACT_CHUNK_SIZE):
+        self.cache_size = cache_size
+        self.chunk_size = chunk_size
+        self.cache = OrderedDict()
+        self.consumers = []
+        self.functions = []
+
+    def add(self, name, fn):
+        """
+        :param fn: fn(precip, date, results) of the extractor, run after the ChunkConsumers. results is the dict of
+        the names of the extractors run before it to their return values
+        """
+        self.functions.append((name, fn))
+
+    def add_consumer(self, name, consumer):
+        """
+        :param consumer: ChunkConsumer
+        """
+        self.consumers.append((name, consumer))
+
+    def get_precip(self, nc_f):
+        if nc_f in self.cache:
+            precip = self.cache.pop(nc_f)
+        else:
+            precip = load_precip(nc_f, self.chunk_size)
+            while len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[nc_f] = precip
+        return precip
+
+    def run(self, nc_f, date):
+        """
+        runs all the extractors on the wrfout file
+        :return: dict of the names of the extractors to their return values, dict of the names to the seconds taken.
+        the timings include 'load', the time to read the file
+        """
+        timings = OrderedDict([('load', 0.0)] + [(name, 0.0) for name, _ in self.consumers + self.functions])
+        start_t = time.time()
+
+        def timed(name, fn, *args):
+            t = time.time()
+            try:
+                return fn(*args)
+            finally:
+                timings[name] += time.time() - t
+
+        precip = timed('load', self.get_precip if len(self.functions) > 0 else read_precip_header, nc_f)
+        for name, consumer in self.consumers:
+            logging.info('Extracting %s from %s' % (name, nc_f))
+            timed(name, consumer.start, precip, date)
+        chunks = precip.iter_chunks(self.chunk_size)
+        while True:
+            try:
+                t, rf = timed('load', next, chunks)
+            except StopIteration:
+                break
+            for name, consumer in self.consumers:
+                timed(name, consumer.on_chunk, t, rf)
+
+        results = {}
+        for name, consumer in self.consumers:
+            results[name] = timed(name, consumer.finish, results)
+        for name, fn in self.functions:
+            logging.info('Extracting %s from %s' % (name, nc_f))
+            results[name] = timed(name, fn, precip, date, results)
+
+        logging.info('Extraction timings of %s: %s, total %f s' % (
+            nc_f, ', '.join('%s %f s' % (k, v) for k, v in timings.items()), time.time() - start_t))
+        return results, timings
@@ -5,237 +5,326 @@ import os
 import unittest
 import zipfile
 import multiprocessing
-from matplotlib.colors import LinearSegmentedColormap
+from collections import OrderedDict
 
 import numpy as np
-import pandas as pd
-import shapefile
 import shutil
-import matplotlib.pyplot as plt
 import math
 
-from joblib import Parallel, delayed
-from mpl_toolkits.basemap import Basemap, cm
-from netCDF4 import Dataset
-
-from curwrf.wrf import utils
+from curwrf.wrf import constants, utils
+from curwrf.wrf.execution import downloader
+from curwrf.wrf.extraction import engine, zonal_stats
 from curwrf.wrf.resources import manager as res_mgr
 
 
+def open_nc(nc_f):
+    # heavy dependencies are imported by the functions using them, to keep the module import fast
+    from netCDF4 import Dataset
+    return Dataset(nc_f, 'r')
+
+
 def extract_time_data(nc_f):
-    nc_fid = Dataset(nc_f, 'r')
+    nc_fid = open_nc(nc_f)
     times_len = len(nc_fid.dimensions['Time'])
     times = [''.join(x) for x in nc_fid.variables['Times'][0:times_len]]
     nc_fid.close()
     return times_len, times
 
 
-def extract_metro_colombo(nc_f, date, wrf_output):
-    times_len, times = extract_time_data(nc_f)
-
-    nc_fid = Dataset(nc_f, 'r')
-
+class MetroColomboExtractor(engine.ChunkConsumer):
+    """
+    Writes the rf of the metro colombo area as an ASC grid per time step, and the means of its sub areas. The result
+    is the mean rf of the area in the time steps 5 to 29, the basin_rf
+    """
     lat_min = 41
     lat_max = 47
     lon_min = 11
     lon_max = 17
     cell_size = 0.02723
     no_data_val = -99
+    sub_divs = [0, 4, 7]
+
+    def __init__(self, wrf_output):
+        self.wrf_output = wrf_output
+
+    def start(self, precip, date):
+        self.date = date
+        self.times = precip.times
+        self.lats = precip.lats[self.lat_min:self.lat_max + 1]
+        self.lons = precip.lons[self.lon_min:self.lon_max + 1]
+        self.basin_rf_steps = []
+
+        self.output_dir = self.wrf_output + '/colombo/created-' + date.strftime('%Y-%m-%d')
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        subsection_file_path = self.wrf_output + '/colombo/sub-means-' + date.strftime('%Y-%m-%d') + '.txt'
+        self.subsection_file = open(subsection_file_path, 'w')
+
+    def on_chunk(self, t, rf):
+        diff = rf[:, self.lat_min:self.lat_max + 1, self.lon_min:self.lon_max + 1]
+        width = len(self.lons)
+        height = len(self.lats)
+
+        # the steps 5 to 29 are summed together at the end, in float32 as before
+        self.basin_rf_steps.append(diff[max(5 - t, 0):max(29 - t, 0)].copy())
+
+        for i in range(len(diff)):
+            tm = t + i
+            output_file_path = self.output_dir + '/rain-' + self.times[tm] + '.txt'
+            output_file = open(output_file_path, 'w')
+
+            output_file.write('NCOLS %d\n' % width)
+            output_file.write('NROWS %d\n' % height)
+            output_file.write('XLLCORNER %f\n' % self.lons[0])
+            output_file.write('YLLCORNER %f\n' % self.lats[0])
+            output_file.write('CELLSIZE %f\n' % self.cell_size)
+            output_file.write('NODATA_VALUE %d\n' % self.no_data_val)
+
+            for y in range(0, height):
+                for x in range(0, width):
+                    output_file.write('%f ' % diff[i, y, x])
+                output_file.write('\n')
+
+            output_file.close()
+
+            # writing subsection file
+            sub_divs = self.sub_divs
+            self.subsection_file.write(self.times[tm])
+            for j in range(len(sub_divs) - 1):
+                for k in range(len(sub_divs) - 1):
+                    self.subsection_file.write(
+                        ' %f' % np.mean(diff[i, sub_divs[j]:sub_divs[j + 1], sub_divs[k]: sub_divs[k + 1]]))
+            self.subsection_file.write('\n')
+
+    def finish(self, results):
+        self.subsection_file.close()
+
+        alpha_file_path = self.wrf_output + '/colombo/alphas.txt'
+        with open(alpha_file_path, 'a') as alpha_file:
+            basin_rf = np.sum(np.concatenate(self.basin_rf_steps)) / float(len(self.lons) * len(self.lats))
+            alpha_file.write('%s %f\n' % (self.date.strftime('%Y-%m-%d'), basin_rf))
+        return basin_rf
 
-    lats = nc_fid.variables['XLAT'][0, lat_min:lat_max + 1, 0]  # extract/copy the data
-    lons = nc_fid.variables['XLONG'][0, 0, lon_min:lon_max + 1]
-
-    prcp = nc_fid.variables['RAINC'][:, lat_min:lat_max + 1, lon_min:lon_max + 1] + \
-           nc_fid.variables['RAINNC'][:, lat_min:lat_max + 1, lon_min:lon_max + 1] + \
-           nc_fid.variables['SNOWNC'][:, lat_min:lat_max + 1, lon_min:lon_max + 1] + \
-           nc_fid.variables['GRAUPELNC'][:, lat_min:lat_max + 1, lon_min:lon_max + 1]
-
-    diff = prcp[1:73, :, :] - prcp[0:72, :, :]
-
-    width = len(lons)
-    height = len(lats)
-
-    output_dir = wrf_output + '/colombo/created-' + date.strftime('%Y-%m-%d')
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    alpha_file_path = wrf_output + '/colombo/alphas.txt'
-    basin_rf = 1.0
-    with open(alpha_file_path, 'a') as alpha_file:
-        basin_rf = np.sum(diff[5:29, :, :]) / float(width * height)
-        alpha_file.write('%s %f\n' % (date.strftime('%Y-%m-%d'), basin_rf))
-
-    subsection_file_path = wrf_output + '/colombo/sub-means-' + date.strftime('%Y-%m-%d') + '.txt'
-    subsection_file = open(subsection_file_path, 'w')
-
-    for tm in range(0, len(times) - 1):
-        output_file_path = output_dir + '/rain-' + times[tm] + '.txt'
-        output_file = open(output_file_path, 'w')
-
-        output_file.write('NCOLS %d\n' % width)
-        output_file.write('NROWS %d\n' % height)
-        output_file.write('XLLCORNER %f\n' % lons[0])
-        output_file.write('YLLCORNER %f\n' % lats[0])
-        output_file.write('CELLSIZE %f\n' % cell_size)
-        output_file.write('NODATA_VALUE %d\n' % no_data_val)
-
-        for y in range(0, height):
-            for x in range(0, width):
-                output_file.write('%f ' % diff[tm, y, x])
-            output_file.write('\n')
-
-        output_file.close()
 
-        # writing subsection file
-        sub_divs = [0, 4, 7]
-        subsection_file.write(times[tm])
-        for j in range(len(sub_divs) - 1):
-            for i in range(len(sub_divs) - 1):
-                subsection_file.write(
-                    ' %f' % np.mean(diff[tm, sub_divs[j]:sub_divs[j + 1], sub_divs[i]: sub_divs[i + 1]]))
-        subsection_file.write('\n')
-
-    subsection_file.close()
+def extract_metro_colombo(nc_f, date, wrf_output):
+    """
+    :param nc_f: engine.Precip, or the path of the wrfout file
+    """
+    return engine.run_consumer(nc_f, date, MetroColomboExtractor(wrf_output))
 
-    nc_fid.close()
-    return basin_rf
 
+class WeatherStationsExtractor(engine.ChunkConsumer):
+    """
+    Writes the rf series of the weather stations, at the grid points of the stations file
+    """
 
-def extract_weather_stations(nc_f, date, times, weather_stations, wrf_output):
-    nc_fid = Dataset(nc_f, 'r')
-
-    with open(weather_stations, 'rb') as csvfile:
-        stations = csv.reader(csvfile, delimiter=' ')
-        stations_dir = wrf_output + '/RF'
-        if not os.path.exists(stations_dir):
-            os.makedirs(stations_dir)
-        for row in stations:
-            print ' '.join(row)
-            lon = row[1]
-            lat = row[2]
-
-            station_prcp = nc_fid.variables['RAINC'][:, lat, lon] + \
-                           nc_fid.variables['RAINNC'][:, lat, lon] + \
-                           nc_fid.variables['SNOWNC'][:, lat, lon] + \
-                           nc_fid.variables['GRAUPELNC'][:, lat, lon]
-
-            station_diff = station_prcp[1:len(times)] - station_prcp[0:len(times) - 1]
-
-            station_file_path = stations_dir + '/' + row[0] + '-' + date.strftime('%Y-%m-%d') + '.txt'
-            station_file = open(station_file_path, 'w')
-
-            for t in range(0, len(times) - 1):
-                station_file.write('%s %f\n' % (times[t], station_diff[t]))
+    def __init__(self, weather_stations, wrf_output, times=None):
+        """
+        :param times: times of the rf. the times of the wrfout if None
+        """
+        self.weather_stations = weather_stations
+        self.wrf_output = wrf_output
+        self.times = times
+
+    def start(self, precip, date):
+        self.rf_times = self.times if self.times is not None else precip.times
+        self.stations = []
+        with open(self.weather_stations, 'rb') as csvfile:
+            stations = csv.reader(csvfile, delimiter=' ')
+            stations_dir = self.wrf_output + '/RF'
+            if not os.path.exists(stations_dir):
+                os.makedirs(stations_dir)
+            for row in stations:
+                logging.debug('Weather station %s' % ' '.join(row))
+                lon = int(row[1])
+                lat = int(row[2])
+
+                station_file_path = stations_dir + '/' + row[0] + '-' + date.strftime('%Y-%m-%d') + '.txt'
+                self.stations.append((lat, lon, open(station_file_path, 'w')))
+
+    def on_chunk(self, t, rf):
+        for lat, lon, station_file in self.stations:
+            for i in range(min(len(rf), len(self.rf_times) - 1 - t)):
+                station_file.write('%s %f\n' % (self.rf_times[t + i], rf[i, lat, lon]))
+
+    def finish(self, results):
+        for _, _, station_file in self.stations:
             station_file.close()
 
-    nc_fid.close()
-
-
-def extract_kelani_basin_rainfall(nc_f, date, kelani_basin_file, wrf_output, basin_rf=1.0):
-    points = np.genfromtxt(kelani_basin_file, delimiter=',')
-
-    kel_lon_min = np.min(points, 0)[1]
-    kel_lat_min = np.min(points, 0)[2]
-    kel_lon_max = np.max(points, 0)[1]
-    kel_lat_max = np.max(points, 0)[2]
-
-    diff, kel_lats, kel_lons, times = extract_area_rf_series(nc_f, kel_lat_min, kel_lat_max, kel_lon_min, kel_lon_max)
-
-    def get_bins(arr):
-        sz = len(arr)
-        return (arr[1:sz - 1] + arr[0:sz - 2]) / 2
-
-    lat_bins = get_bins(kel_lats)
-    lon_bins = get_bins(kel_lons)
-
-    output_dir = wrf_output + '/kelani-basin/created-' + date.strftime('%Y-%m-%d')
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    prev_day_1_file = wrf_output + '/wrfout_d03_' + (date - dt.timedelta(days=1)).strftime('%Y-%m-%d') + '_00:00:00'
-    prev_day_2_file = wrf_output + '/wrfout_d03_' + (date - dt.timedelta(days=2)).strftime('%Y-%m-%d') + '_00:00:00'
-
-    diff1, _, _, times1 = extract_area_rf_series(prev_day_1_file, kel_lat_min, kel_lat_max, kel_lon_min, kel_lon_max)
-    diff2, _, _, times2 = extract_area_rf_series(prev_day_2_file, kel_lat_min, kel_lat_max, kel_lon_min, kel_lon_max)
-
-    def write_forecast_to_raincell_file(output_file_path, alpha):
-        output_file = open(output_file_path, 'w')
-
-        res = 60
-        data_hours = len(times) + 48
-        start_ts = (date - dt.timedelta(days=2)).strftime('%Y-%m-%d %H:%M:%S')
-        end_ts = (date + dt.timedelta(hours=len(times) - 1)).strftime('%Y-%m-%d %H:%M:%S')
-        output_file.write("%d %d %s %s\n" % (res, data_hours, start_ts, end_ts))
-
-        for h in range(0, data_hours):
-            for point in points:
-                rf_x = np.digitize(point[1], lon_bins)
-                rf_y = np.digitize(point[2], lat_bins)
-                if h < 24:
-                    output_file.write('%d %f\n' % (point[0], diff2[h, rf_y, rf_x]))
-                elif h < 48:
-                    output_file.write('%d %f\n' % (point[0], diff1[h - 24, rf_y, rf_x]))
-                elif h < 72:
-                    output_file.write('%d %f\n' % (point[0], diff[h - 48, rf_y, rf_x] * alpha))
-                else:
-                    output_file.write('%d %f\n' % (point[0], diff[h - 48, rf_y, rf_x]))
-        output_file.close()
-
-    raincell_file_path = output_dir + '/RAINCELL.DAT'
-    write_forecast_to_raincell_file(raincell_file_path, 1)
-
-    for target_rf in [100, 150, 200, 250, 300]:
-        write_forecast_to_raincell_file('%s.%d' % (raincell_file_path, target_rf), target_rf / basin_rf)
 
+def extract_weather_stations(nc_f, date, times, weather_stations, wrf_output):
+    """
+    :param nc_f: engine.Precip, or the path of the wrfout file
+    """
+    engine.run_consumer(nc_f, date, WeatherStationsExtractor(weather_stations, wrf_output, times))
 
-def extract_kelani_upper_basin_mean_rainfall(nc_f, date, times, kelani_basin_shp_file, wrf_output):
-    nc_fid = Dataset(nc_f, 'r')
-
-    kel_lon_min = 79.994117
-    kel_lat_min = 6.754167
-    kel_lon_max = 80.773182
-    kel_lat_max = 7.229167
-
-    lats = nc_fid.variables['XLAT'][0, :, 0]
-    lons = nc_fid.variables['XLONG'][0, 0, :]
-
-    lon_min = np.argmax(lons >= kel_lon_min) - 1
-    lat_min = np.argmax(lats >= kel_lat_min) - 1
-    lon_max = np.argmax(lons >= kel_lon_max)
-    lat_max = np.argmax(lats >= kel_lat_max)
-
-    polys = shapefile.Reader(kelani_basin_shp_file)
 
-    kel_lats = nc_fid.variables['XLAT'][0, lat_min:lat_max + 1, lon_min:lon_max + 1]
-    kel_lons = nc_fid.variables['XLONG'][0, lat_min:lat_max + 1, lon_min:lon_max + 1]
+class KelaniBasinExtractor(engine.ChunkConsumer):
+    """
+    Writes the RAINCELL.DAT of the Kelani basin points, with the rf of the 2 previous days and the forecast, and its
+    variants with the first forecast day scaled to the target_rf basin rainfalls. The first day of each wrfout is kept,
+    to be used as a previous day of the next dates
+    """
+    target_rfs = [100, 150, 200, 250, 300]
+
+    def __init__(self, kelani_basin_file, wrf_output, basin_rf=1.0, basin_rf_result=None):
+        """
+        :param basin_rf: basin rainfall of the first forecast day
+        :param basin_rf_result: name of the extractor returning the basin_rf, ex: of the MetroColomboExtractor. the
+        basin_rf is used if None
+        """
+        self.points = np.genfromtxt(kelani_basin_file, delimiter=',')
+        self.wrf_output = wrf_output
+        self.basin_rf = basin_rf
+        self.basin_rf_result = basin_rf_result
+        self.first_days = OrderedDict()
+
+    def get_first_day(self, nc_f):
+        """
+        :return: (24, points) rf of the points in the first day of the wrfout
+        """
+        if nc_f not in self.first_days:
+            self.first_days[nc_f] = engine.as_precip(nc_f).get_series(lambda rf: rf[:, self.rf_y, self.rf_x], 24)
+        return self.first_days[nc_f]
+
+    def start(self, precip, date):
+        points = self.points
+
+        kel_lon_min = np.min(points, 0)[1]
+        kel_lat_min = np.min(points, 0)[2]
+        kel_lon_max = np.max(points, 0)[1]
+        kel_lat_max = np.max(points, 0)[2]
+
+        lat_min_idx, lat_max_idx, lon_min_idx, lon_max_idx = precip.get_area_indices(kel_lat_min, kel_lat_max,
+                                                                                     kel_lon_min, kel_lon_max)
+        kel_lats = precip.lats[lat_min_idx:lat_max_idx]
+        kel_lons = precip.lons[lon_min_idx:lon_max_idx]
+
+        def get_bins(arr):
+            sz = len(arr)
+            return (arr[1:sz - 1] + arr[0:sz - 2]) / 2
+
+        # grid point of each point
+        self.rf_x = lon_min_idx + np.digitize(points[:, 1], get_bins(kel_lons))
+        self.rf_y = lat_min_idx + np.digitize(points[:, 2], get_bins(kel_lats))
+
+        self.date = date
+        self.nc_f = precip.nc_f
+        self.rf_len = precip.times_len - 1
+
+        prev_day_1_file = self.wrf_output + '/wrfout_d03_' + (date - dt.timedelta(days=1)).strftime(
+            '%Y-%m-%d') + '_00:00:00'
+        prev_day_2_file = self.wrf_output + '/wrfout_d03_' + (date - dt.timedelta(days=2)).strftime(
+            '%Y-%m-%d') + '_00:00:00'
+
+        # hourly rf of the points from 2 days before the date till the end of the forecast
+        self.rf = np.empty((48 + self.rf_len, len(points)), dtype=np.float32)
+        self.rf[0:24] = self.get_first_day(prev_day_2_file)
+        self.rf[24:48] = self.get_first_day(prev_day_1_file)
+
+    def on_chunk(self, t, rf):
+        self.rf[48 + t:48 + t + len(rf)] = rf[:, self.rf_y, self.rf_x]
+
+    def finish(self, results):
+        basin_rf = results[self.basin_rf_result] if self.basin_rf_result is not None else self.basin_rf
+
+        self.first_days[self.nc_f] = self.rf[48:72].copy()
+        while len(self.first_days) > 2:
+            self.first_days.popitem(last=False)
+
+        output_dir = self.wrf_output + '/kelani-basin/created-' + self.date.strftime('%Y-%m-%d')
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        start_ts = (self.date - dt.timedelta(days=2)).strftime('%Y-%m-%d %H:%M:%S')
+        end_ts = (self.date + dt.timedelta(hours=self.rf_len - 1)).strftime('%Y-%m-%d %H:%M:%S')
+
+        raincell_file_path = output_dir + '/RAINCELL.DAT'
+        alphas = [(raincell_file_path, 1)] + [('%s.%d' % (raincell_file_path, target_rf), target_rf / basin_rf)
+                                              for target_rf in self.target_rfs]
+        write_raincell_files(alphas, self.points[:, 0].astype(int), self.rf, start_ts, end_ts, 48, 72)
+        self.rf = None
 
-    prcp = nc_fid.variables['RAINC'][:, lat_min:lat_max + 1, lon_min:lon_max + 1] + \
-           nc_fid.variables['RAINNC'][:, lat_min:lat_max + 1, lon_min:lon_max + 1] + \
-           nc_fid.variables['SNOWNC'][:, lat_min:lat_max + 1, lon_min:lon_max + 1] + \
-           nc_fid.variables['GRAUPELNC'][:, lat_min:lat_max + 1, lon_min:lon_max + 1]
 
-    diff = prcp[1:len(times), :, :] - prcp[0: len(times) - 1, :, :]
+def extract_kelani_basin_rainfall(nc_f, date, kelani_basin_file, wrf_output, basin_rf=1.0):
+    """
+    :param nc_f: engine.Precip, or the path of the wrfout file
+    """
+    engine.run_consumer(nc_f, date, KelaniBasinExtractor(kelani_basin_file, wrf_output, basin_rf))
 
-    output_dir = wrf_output + '/kelani-upper-basin/'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
 
-    output_file_path = output_dir + '/mean-rf-' + date.strftime('%Y-%m-%d') + '.txt'
-    output_file = open(output_file_path, 'w')
+def write_raincell_files(alphas, cell_ids, rf, start_ts, end_ts, alpha_start, alpha_end, res=60):
+    """
+    writes RAINCELL.DAT files in one pass, which differ only in the scaling of the hours alpha_start to alpha_end
+    :param alphas: list of (file path, alpha)
+    :param cell_ids: ids of the cells
+    :param rf: (hours, cells) array of rainfall
+    """
+    files = [(open(path, 'w'), alpha) for path, alpha in alphas]
+    try:
+        # one format operation per hour, rather than per cell
+        template = ''.join('%d %%f\n' % i for i in cell_ids)
+        for f, _ in files:
+            f.write('%d %d %s %s\n' % (res, len(rf), start_ts, end_ts))
+        for h in range(len(rf)):
+            if alpha_start <= h < alpha_end:
+                for f, alpha in files:
+                    f.write(template % tuple((rf[h].astype(np.float64) * alpha).tolist()))
+            else:
+                lines = template % tuple(rf[h].tolist())
+                for f, _ in files:
+                    f.write(lines)
+    finally:
+        for f, _ in files:
+            f.close()
 
-    for t in range(0, len(times) - 1):
-        cnt = 0
-        rf_sum = 0.0
-        for y in range(0, len(kel_lats[:, 0])):
-            for x in range(0, len(kel_lons[0, :])):
-                if utils.is_inside_polygon(polys, kel_lats[y, x], kel_lons[y, x]):
-                    cnt = cnt + 1
-                    rf_sum = rf_sum + diff[t, y, x]
-        output_file.write('%s %f\n' % (times[t], rf_sum / cnt))
 
-    output_file.close()
+class KelaniUpperBasinExtractor(engine.ChunkConsumer):
+    """
+    Writes the mean rf over the upper basin, and over each of its sub basins, the polygons of the shapefile
+    """
 
-    nc_fid.close()
+    def __init__(self, kelani_basin_shp_file, wrf_output, cache_dir=None, times=None):
+        """
+        :param cache_dir: dir of the cached zonal weights of the grid. computed for each date if None
+        :param times: times of the rf. the times of the wrfout if None
+        """
+        self.kelani_basin_shp_file = kelani_basin_shp_file
+        self.wrf_output = wrf_output
+        self.cache_dir = cache_dir
+        self.times = times
+
+    def start(self, precip, date):
+        self.rf_times = self.times if self.times is not None else precip.times
+        self.names, self.weights = zonal_stats.get_weights(precip.lats, precip.lons, self.kelani_basin_shp_file,
+                                                           'Raingauge', self.cache_dir)
+
+        output_dir = self.wrf_output + '/kelani-upper-basin/'
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        self.output_file = open(output_dir + '/mean-rf-' + date.strftime('%Y-%m-%d') + '.txt', 'w')
+        self.sub_basins_file = open(output_dir + '/sub-basins-mean-rf-' + date.strftime('%Y-%m-%d') + '.txt', 'w')
+        self.sub_basins_file.write('Timestamp %s\n' % ' '.join(self.names))
+
+    def on_chunk(self, t, rf):
+        means = zonal_stats.get_means(self.weights, rf)
+        basin = self.names.index(zonal_stats.ALL_POLYGONS)
+        for i in range(min(len(rf), len(self.rf_times) - 1 - t)):
+            self.output_file.write('%s %f\n' % (self.rf_times[t + i], means[i, basin]))
+            self.sub_basins_file.write('%s %s\n' % (self.rf_times[t + i], ' '.join('%f' % v for v in means[i])))
+
+    def finish(self, results):
+        self.output_file.close()
+        self.sub_basins_file.close()
+
+
+def extract_kelani_upper_basin_mean_rainfall(nc_f, date, times, kelani_basin_shp_file, wrf_output, cache_dir=None):
+    """
+    :param nc_f: engine.Precip, or the path of the wrfout file
+    """
+    engine.run_consumer(nc_f, date, KelaniUpperBasinExtractor(kelani_basin_shp_file, wrf_output, cache_dir, times))
 
 
 def extract_kelani_upper_basin_mean_rainfall_sat(sat_dir, date, kelani_basin_shp_file, wrf_output):
@@ -255,12 +344,9 @@ def extract_kelani_upper_basin_mean_rainfall_sat(sat_dir, date, kelani_basin_shp
     output_file_path = output_dir + '/mean-rf-sat-' + date.strftime('%Y-%m-%d') + '.csv'
     output_file = open(output_file_path, 'w')
 
-    polys = shapefile.Reader(kelani_basin_shp_file)
+    polys = utils.PolygonIndex.from_shapefile(kelani_basin_shp_file)
 
     for h in range(0, 24):
-        cnt = 0
-        rf_sum = 0.0
-
         sh = str(h).zfill(2)
         sat_zip_file = '%s/%s/%s/%s/gsmap_nrt.%s%s%s.%s00.05_AsiaSS.csv.zip' % (sat_dir, y, m, d, y, m, d, sh)
 
@@ -270,12 +356,10 @@ def extract_kelani_upper_basin_mean_rainfall_sat(sat_dir, date, kelani_basin_shp
         sat_filt = sat[(sat['Lat'] <= kel_lat_max) & (sat['Lat'] >= kel_lat_min) & (sat['Lon'] <= kel_lon_max) & (
             sat['Lon'] >= kel_lon_min)]
 
-        for p in sat_filt:
-            if utils.is_inside_polygon(polys, p[0], p[1]):
-                cnt = cnt + 1
-                rf_sum = rf_sum + p[2]
+        inside = polys.get_polygon_ids(sat_filt['Lat'], sat_filt['Lon']) >= 0
+        rf = sat_filt[sat_filt.dtype.names[2]][inside]
 
-        output_file.write('%s-%s-%s_%s:00:00 %f\n' % (y, m, d, sh, rf_sum / cnt))
+        output_file.write('%s-%s-%s_%s:00:00 %f\n' % (y, m, d, sh, np.sum(rf) / len(rf)))
 
     output_file.close()
 
@@ -347,6 +431,8 @@ def concat_rainfall_files(date, wrf_output, weather_stations):
 
 
 def concat_rainfall_files_1(date, wrf_output, weather_stations):
+    import pandas as pd
+
     with open(weather_stations, 'rb') as stations_file:
         rf_dir = wrf_output + '/RF'
         for station_name in stations_file:
@@ -373,82 +459,71 @@ def concat_rainfall_files_1(date, wrf_output, weather_stations):
 
 
 def extract_point_rf_series(nc_f, lat, lon):
-    nc_fid = Dataset(nc_f, 'r')
-
-    times_len, times = extract_time_data(nc_f)
-    lats = nc_fid.variables['XLAT'][0, :, 0]
-    lons = nc_fid.variables['XLONG'][0, 0, :]
-
-    lat_start_idx = np.argmin(abs(lats - lat))
-    lon_start_idx = np.argmin(abs(lons - lon))
-
-    prcp = nc_fid.variables['RAINC'][:, lat_start_idx, lon_start_idx] + \
-           nc_fid.variables['RAINNC'][:, lat_start_idx, lon_start_idx] + \
-           nc_fid.variables['SNOWNC'][:, lat_start_idx, lon_start_idx] + \
-           nc_fid.variables['GRAUPELNC'][:, lat_start_idx, lon_start_idx]
-
-    diff = prcp[1:times_len] - prcp[0:times_len - 1]
-
-    nc_fid.close()
-
-    return diff, np.array(times[0:times_len - 1])
+    """
+    :param nc_f: engine.Precip, or the path of the wrfout file
+    """
+    return engine.as_precip(nc_f).get_point_series(lat, lon)
 
 
 def extract_area_rf_series(nc_f, lat_min, lat_max, lon_min, lon_max):
-    if not os.path.exists(nc_f):
-        raise IOError('File %s not found' % nc_f)
-
-    nc_fid = Dataset(nc_f, 'r')
-
-    times_len, times = extract_time_data(nc_f)
-    lats = nc_fid.variables['XLAT'][0, :, 0]
-    lons = nc_fid.variables['XLONG'][0, 0, :]
+    """
+    :param nc_f: engine.Precip, or the path of the wrfout file
+    """
+    return engine.as_precip(nc_f).get_area_series(lat_min, lat_max, lon_min, lon_max)
 
-    lon_min_idx = np.argmax(lons >= lon_min) - 1
-    lat_min_idx = np.argmax(lats >= lat_min) - 1
-    lon_max_idx = np.argmax(lons >= lon_max)
-    lat_max_idx = np.argmax(lats >= lat_max)
 
-    prcp = nc_fid.variables['RAINC'][:, lat_min_idx:lat_max_idx, lon_min_idx:lon_max_idx] + \
-           nc_fid.variables['RAINNC'][:, lat_min_idx:lat_max_idx, lon_min_idx:lon_max_idx] + \
-           nc_fid.variables['SNOWNC'][:, lat_min_idx:lat_max_idx, lon_min_idx:lon_max_idx] + \
-           nc_fid.variables['GRAUPELNC'][:, lat_min_idx:lat_max_idx, lon_min_idx:lon_max_idx]
+class JaxaStationsExtractor(engine.ChunkConsumer):
+    """
+    Writes the rf series of the JAXA weather stations, at the grid points closest to the stations
+    """
 
-    diff = prcp[1:times_len] - prcp[0:times_len - 1]
+    def __init__(self, weather_stations_file, output_dir):
+        self.weather_stations_file = weather_stations_file
+        self.output_dir = output_dir
 
-    nc_fid.close()
+    def start(self, precip, date):
+        import pandas as pd
 
-    return diff, lats[lat_min_idx:lat_max_idx], lons[lon_min_idx:lon_max_idx], np.array(times[0:times_len - 1])
+        stations = pd.read_csv(self.weather_stations_file, header=0, sep=',')
 
+        output_file_dir = os.path.join(self.output_dir, 'jaxa-stations-wrf-forecast')
+        utils.create_dir_if_not_exists(output_file_dir)
 
-def extract_jaxa_weather_stations(nc_f, weather_stations_file, output_dir):
-    nc_fid = Dataset(nc_f, 'r')
+        self.times = precip.get_rf_times()
+        self.stations = []
+        for idx, station in stations.iterrows():
+            logging.info('Extracting station ' + str(station))
 
-    stations = pd.read_csv(weather_stations_file, header=0, sep=',')
+            lat_idx, lon_idx = precip.get_point_indices(station[2], station[1])
+            output_file_path = os.path.join(output_file_dir, station[3] + '-' + str(station[0]) + '-' +
+                                            self.times[0].split('_')[0] + '.txt')
+            output_file = open(output_file_path, 'w')
+            output_file.write('jaxa-stations-wrf-forecast\n')
+            output_file.write(', '.join(stations.columns.values) + '\n')
+            output_file.write(', '.join(str(x) for x in station) + '\n')
+            output_file.write('timestamp, rainfall\n')
+            self.stations.append((lat_idx, lon_idx, output_file))
 
-    output_file_dir = os.path.join(output_dir, 'jaxa-stations-wrf-forecast')
-    utils.create_dir_if_not_exists(output_file_dir)
+    def on_chunk(self, t, rf):
+        for lat_idx, lon_idx, output_file in self.stations:
+            for i in range(len(rf)):
+                output_file.write('%s, %f\n' % (self.times[t + i], rf[i, lat_idx, lon_idx]))
 
-    for idx, station in stations.iterrows():
-        logging.info('Extracting station ' + str(station))
+    def finish(self, results):
+        for _, _, output_file in self.stations:
+            output_file.close()
 
-        rf, times = extract_point_rf_series(nc_f, station[2], station[1])
 
-        output_file_path = os.path.join(output_file_dir,
-                                        station[3] + '-' + str(station[0]) + '-' + times[0].split('_')[0] + '.txt')
-        output_file = open(output_file_path, 'w')
-        output_file.write('jaxa-stations-wrf-forecast\n')
-        output_file.write(', '.join(stations.columns.values) + '\n')
-        output_file.write(', '.join(str(x) for x in station) + '\n')
-        output_file.write('timestamp, rainfall\n')
-        for i in range(len(times)):
-            output_file.write('%s, %f\n' % (times[i], rf[i]))
-        output_file.close()
+def extract_jaxa_weather_stations(nc_f, weather_stations_file, output_dir):
+    """
+    :param nc_f: engine.Precip, or the path of the wrfout file
+    """
+    engine.run_consumer(nc_f, None, JaxaStationsExtractor(weather_stations_file, output_dir))
 
-    nc_fid.close()
 
+def extract_jaxa_satellite_data(start_ts_utc, end_ts_utc, output_dir, threads=constants.DEFAULT_THREAD_COUNT):
+    from joblib import Parallel, delayed
 
-def extract_jaxa_satellite_data(start_ts_utc, end_ts_utc, output_dir):
     start = utils.datetime_floor(start_ts_utc, 3600)
     end = utils.datetime_floor(end_ts_utc, 3600)
 
@@ -483,7 +558,9 @@ def extract_jaxa_satellite_data(start_ts_utc, end_ts_utc, output_dir):
         url_dest_list.append((url, os.path.join(tmp_dir, os.path.basename(url)),
                               os.path.join(output_dir, 'jaxa_sat_rf_' + timestamp.strftime('%Y-%m-%d_%H:%M') + '.asc')))
 
-    utils.download_parallel(url_dest_list)
+    stats = downloader.fetch_all([(i[0], i[1]) for i in url_dest_list], threads)
+    if len(stats.get_failures()) > 0:
+        raise IOError('Unable to download JAXA data\n%s' % '\n'.join(r.to_string() for r in stats.get_failures()))
 
     procs = multiprocessing.cpu_count()
     Parallel(n_jobs=procs)(
@@ -494,6 +571,8 @@ def extract_jaxa_satellite_data(start_ts_utc, end_ts_utc, output_dir):
 
 
 def process_zip_file(zip_file_path, out_file_path, lat_min, lon_min, lat_max, lon_max):
+    from mpl_toolkits.basemap import cm
+
     sat_zip = zipfile.ZipFile(zip_file_path)
     sat = np.genfromtxt(sat_zip.open(os.path.basename(zip_file_path).replace('.zip', '')), delimiter=',', names=True)
     sat_filt = sat[
@@ -525,10 +604,10 @@ def process_zip_file(zip_file_path, out_file_path, lat_min, lon_min, lat_max, lo
 
 
 def create_contour_plot(data, out_file_path, lat_min, lon_min, lat_max, lon_max, plot_title, basemap=None, clevs=None,
-                        cmap=plt.get_cmap('Reds')):
+                        cmap=None):
     """
     create a contour plot using basemap
-    :param cmap: color map
+    :param cmap: color map. default = Reds
     :param clevs: color levels
     :param basemap: creating basemap takes time, hence you can create it outside and pass it over
     :param plot_title:
@@ -540,6 +619,11 @@ def create_contour_plot(data, out_file_path, lat_min, lon_min, lat_max, lon_max,
     :param lon_max:
     :return:
     """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.basemap import Basemap
+
+    if cmap is None:
+        cmap = plt.get_cmap('Reds')
     fig = plt.figure(figsize=(8.27, 11.69))
     ax = fig.add_axes([0.1, 0.1, 0.8, 0.8])
     if basemap is None:
@@ -570,7 +654,10 @@ def create_contour_plot(data, out_file_path, lat_min, lon_min, lat_max, lon_max,
     plt.close()
 
 
-def extract_all(wrf_home, start_date, end_date):
+def extract_all(wrf_home, start_date, end_date, chunk_size=None):
+    """
+    :param chunk_size: num. of time steps of the wrfout files read at once. constants.DEFAULT_EXTRACT_CHUNK_SIZE if None
+    """
     logging.info('Extracting data from %s to %s' % (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
     logging.info('WRF home : %s' % wrf_home)
 
@@ -579,33 +666,22 @@ def extract_all(wrf_home, start_date, end_date):
     kelani_basin_shp_file = res_mgr.get_resource_path('extraction/shp/kelani-upper-basin.shp')
     jaxa_weather_st_file = res_mgr.get_resource_path('extraction/local/jaxa_weather_stations.txt')
 
-    dates = np.arange(start_date, end_date, dt.timedelta(days=1)).astype(dt.datetime)
+    wrf_output = utils.get_output_dir(wrf_home)
 
-    for date in dates:
-        wrf_output = utils.get_output_dir(wrf_home)
+    # each wrfout is streamed once, a chunk of time steps at a time, to all the extractors
+    extraction = engine.ExtractionEngine(chunk_size=chunk_size if chunk_size else constants.DEFAULT_EXTRACT_CHUNK_SIZE)
+    extraction.add_consumer('metro-colombo', MetroColomboExtractor(wrf_output))
+    extraction.add_consumer('weather-stations', WeatherStationsExtractor(weather_st_file, wrf_output))
+    extraction.add_consumer('kelani-basin', KelaniBasinExtractor(kelani_basin_file, wrf_output,
+                                                                 basin_rf_result='metro-colombo'))
+    extraction.add_consumer('kelani-upper-basin', KelaniUpperBasinExtractor(
+        kelani_basin_shp_file, wrf_output, utils.get_zonal_stats_cache_dir(wrf_home)))
+    extraction.add_consumer('jaxa-stations', JaxaStationsExtractor(jaxa_weather_st_file, wrf_output))
 
+    for date in utils.get_dates(start_date, end_date):
         nc_f = wrf_output + '/wrfout_d03_' + date.strftime('%Y-%m-%d') + '_00:00:00'
-        if not os.path.exists(nc_f):
-            raise IOError('File %s not found' % nc_f)
-
-        logging.info('Extracting time data')
-        times_len, times = extract_time_data(nc_f)
-
-        logging.info('Extract rainfall data for the metro colombo area')
-        basin_rf = extract_metro_colombo(nc_f, date, wrf_output)
-        logging.info('Basin rainfall' + str(basin_rf))
-
-        logging.info('Extract weather station rainfall')
-        extract_weather_stations(nc_f, date, times, weather_st_file, wrf_output)
-
-        logging.info('Extract Kelani Basin rainfall')
-        extract_kelani_basin_rainfall(nc_f, date, kelani_basin_file, wrf_output, basin_rf)
-
-        logging.info('Extract Kelani upper Basin mean rainfall')
-        extract_kelani_upper_basin_mean_rainfall(nc_f, date, times, kelani_basin_shp_file, wrf_output)
-
-        logging.info('Extract Jaxa stations wrf rainfall')
-        extract_jaxa_weather_stations(nc_f, jaxa_weather_st_file, wrf_output)
+        results, _ = extraction.run(nc_f, date)
+        logging.info('Basin rainfall ' + str(results['metro-colombo']))
 
         logging.info('Exctract Jaxa sattellite rainfall data')
         # extract_jaxa_satellite_data(date, wrf_output)
@@ -0,0 +1,149 @@
+import hashlib
+import logging
+import os
+import time
+
+import numpy as np
+
+# name of the union of all the polygons of a shapefile
+ALL_POLYGONS = 'all'
+# bump when the way the weights are computed changes, to invalidate the cached weights
+WEIGHTS_VERSION = 1
+
+
+def get_cell_edges(centers):
+    """
+    :param centers: increasing 1D coordinates of the grid cell centers
+    :return: len(centers) + 1 edges of the cells, half way between the centers
+    """
+    centers = np.asarray(centers, dtype=np.float64)
+    mid = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate(([centers[0] - (mid[0] - centers[0])], mid, [centers[-1] + (centers[-1] - mid[-1])]))
+
+
+def read_polygons(shp_file, name_field=None):
+    """
+    :param name_field: record field naming the polygons. the index of the polygon if None
+    :return: list of names, list of shapely geometries
+    """
+    import shapefile
+    from shapely.geometry import shape
+
+    reader = shapefile.Reader(shp_file)
+    fields = [f[0] for f in reader.fields[1:]]
+    names = []
+    polygons = []
+    for i, sr in enumerate(reader.shapeRecords()):
+        names.append(str(sr.record[fields.index(name_field)]) if name_field is not None else str(i))
+        polygons.append(shape(sr.shape.__geo_interface__))
+    return names, polygons
+
+
+def get_coverage(lats, lons, polygons):
+    """
+    :param lats: 1D latitudes of the grid cell centers
+    :param lons: 1D longitudes of the grid cell centers
+    :param polygons: shapely geometries
+    :return: sparse (len(polygons), len(lats) * len(lons)) matrix of the area (deg^2) of each cell covered by each
+    polygon. the cells are in the row major order of a (lats, lons) grid
+    """
+    from scipy import sparse
+    from shapely.geometry import box
+    from shapely.prepared import prep
+
+    lat_edges = get_cell_edges(lats)
+    lon_edges = get_cell_edges(lons)
+    width = len(lons)
+
+    rows = []
+    cols = []
+    values = []
+    for p, polygon in enumerate(polygons):
+        prepared = prep(polygon)
+        min_x, min_y, max_x, max_y = polygon.bounds
+        # only the cells within the bounds of the polygon
+        x0 = max(np.searchsorted(lon_edges, min_x) - 1, 0)
+        x1 = min(np.searchsorted(lon_edges, max_x), width)
+        y0 = max(np.searchsorted(lat_edges, min_y) - 1, 0)
+        y1 = min(np.searchsorted(lat_edges, max_y), len(lats))
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                cell = box(lon_edges[x], lat_edges[y], lon_edges[x + 1], lat_edges[y + 1])
+                if prepared.contains(cell):
+                    area = cell.area
+                elif prepared.intersects(cell):
+                    area = polygon.intersection(cell).area
+                else:
+                    continue
+                rows.append(p)
+                cols.append(y * width + x)
+                values.append(area)
+    return sparse.csr_matrix((values, (rows, cols)), shape=(len(polygons), len(lats) * width))
+
+
+def get_weights_key(lats, lons, shp_file):
+    """
+    :return: key of the grid and the shapefile. the .shp and .dbf files are hashed by their content
+    """
+    h = hashlib.md5()
+    h.update('%d:' % WEIGHTS_VERSION)
+    h.update(np.asarray(lats, dtype=np.float64).tostring())
+    h.update(np.asarray(lons, dtype=np.float64).tostring())
+    for path in [shp_file, os.path.splitext(shp_file)[0] + '.dbf']:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                h.update(hashlib.md5(f.read()).hexdigest())
+    return h.hexdigest()
+
+
+def get_weights(lats, lons, shp_file, name_field=None, cache_dir=None):
+    """
+    weights of the grid cells in the means over the polygons of the shapefile, and over their union, from the
+    fraction of each cell covered by each polygon. the weights are computed once per grid and shapefile, and cached in
+    the cache_dir
+    :param cache_dir: dir of the cached weights. not cached if None
+    :return: list of names of the polygons followed by ALL_POLYGONS, sparse (len(names), len(lats) * len(lons))
+    matrix of weights. the weights of each row sum to 1, or to 0 if the polygon does not cover the grid
+    """
+    from scipy import sparse
+
+    names, polygons = read_polygons(shp_file, name_field)
+    names.append(ALL_POLYGONS)
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, get_weights_key(lats, lons, shp_file) + '.npz')
+        if os.path.exists(cache_file):
+            logging.info('Using the cached zonal weights %s of %s' % (cache_file, shp_file))
+            return names, sparse.load_npz(cache_file).tocsr()
+
+    from shapely.ops import unary_union
+
+    start_t = time.time()
+    coverage = get_coverage(lats, lons, polygons + [unary_union(polygons)])
+    totals = np.asarray(coverage.sum(axis=1)).ravel()
+    for name, total in zip(names, totals):
+        if total == 0:
+            logging.warning('Polygon %s of %s does not cover the grid' % (name, shp_file))
+    scale = np.zeros(len(totals))
+    scale[totals > 0] = 1 / totals[totals > 0]
+    weights = (sparse.diags(scale) * coverage).tocsr()
+    logging.info('Computed the zonal weights of %s over %d cells in %f s' % (shp_file, coverage.shape[1],
+                                                                           time.time() - start_t))
+
+    if cache_file is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # save_npz appends .npz to the name
+        sparse.save_npz(cache_file + '.tmp', weights)
+        os.rename(cache_file + '.tmp.npz', cache_file)
+    return names, weights
+
+
+def get_means(weights, rf):
+    """
+    :param weights: sparse matrix from get_weights
+    :param rf: (times, lats, lons) array
+    :return: (times, polygons) array of the means over the polygons at each time
+    """
+    return np.asarray(weights.dot(rf.reshape(len(rf), -1).T).T)
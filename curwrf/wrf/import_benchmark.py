@@ -0,0 +1,60 @@
+#!/bin/python
+import argparse
+import json
+import subprocess
+import sys
+
+# modules which take a while to import, and are only imported by the functions using them
+HEAVY_MODULES = ['numpy', 'yaml', 'pkg_resources', 'shapely', 'shapefile', 'netCDF4', 'pandas', 'matplotlib',
+                 'mpl_toolkits', 'joblib', 'scipy']
+
+# command -> (modules imported by the command, heavy modules it may import)
+COMMANDS = {
+    'download': (['curwrf.wrf.cli', 'curwrf.wrf.execution.executor'], ['yaml']),
+    'wps': (['curwrf.wrf.cli', 'curwrf.wrf.execution.executor'], ['yaml']),
+    'wrf': (['curwrf.wrf.cli', 'curwrf.wrf.execution.executor'], ['yaml']),
+    'extract': (['curwrf.wrf.cli', 'curwrf.wrf.extraction.extractor'], ['numpy']),
+    'download-task': (['curwrf.wrf.execution.tasks.download_inventory_task'], []),
+}
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start_t = time.time()
+for m in %r:
+    __import__(m)
+print(json.dumps({'seconds': time.time() - start_t, 'modules': sorted(sys.modules.keys())}))
+"""
+
+
+def measure(modules, repeats=3):
+    """
+    imports the modules in a fresh interpreter
+    :return: (min seconds over the repeats, names of the loaded heavy modules)
+    """
+    results = []
+    for _ in range(repeats):
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % modules])
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    loaded = set(m.split('.')[0] for m in results[0]['modules'])
+    return min(r['seconds'] for r in results), sorted(loaded.intersection(HEAVY_MODULES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the import time of each command')
+    parser.add_argument('-budget', type=float, default=0.5, help='Max import seconds of a command')
+    parser.add_argument('-repeats', type=int, default=3, help='Num. of fresh interpreters per command')
+    args = parser.parse_args()
+
+    failed = False
+    for command in sorted(COMMANDS):
+        modules, allowed = COMMANDS[command]
+        seconds, heavy = measure(modules, args.repeats)
+        unexpected = [m for m in heavy if m not in allowed]
+        ok = seconds <= args.budget and len(unexpected) == 0
+        failed = failed or not ok
+        print('%-14s %6.3f s  %s  %s' % (command, seconds, 'OK  ' if ok else 'FAIL',
+                                          'unexpected imports: %s' % ', '.join(unexpected) if unexpected else ''))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,8 @@
-import pkg_resources
 import os
 
 
 def get_resource_path(resource):
+    import pkg_resources
     res = pkg_resources.resource_filename(__name__, resource)
     if os.path.exists(res):
         return res
@@ -18,9 +18,14 @@ def main():
 
     wrf_conf = executor.get_wrf_config(wrf_home, config_file=wrf_config_file, **args_dict)
 
-    executor.run_all(wrf_conf, start_date, end_date)
-
-    extractor.extract_all(wrf_home, start_date, end_date)
+    if wrf_conf.get('stage_scheduler'):
+        # the extraction of each date runs as a stage, as soon as its wrf.exe is done
+        executor.run_all_scheduled(wrf_conf, start_date, end_date, extract_fn=lambda date: extractor.extract_all(
+            wrf_home, date, date + dt.timedelta(days=1), wrf_conf.get('extract_chunk_size')))
+    else:
+        executor.run_all(wrf_conf, start_date, end_date)
+
+        extractor.extract_all(wrf_home, start_date, end_date, wrf_conf.get('extract_chunk_size'))
 
 if __name__ == "__main__":
     main()
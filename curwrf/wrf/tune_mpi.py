@@ -0,0 +1,23 @@
+#!/bin/python
+import datetime as dt
+
+from curwrf.wrf.execution import executor
+from curwrf.wrf import utils
+
+
+def main():
+    args_dict = utils.parse_args('Tuning the MPI settings of WRF')
+
+    wrf_home = args_dict.pop('wrf_home')
+    start_date = dt.datetime.strptime(args_dict.pop('start'), '%Y-%m-%d_%H:%M')
+    args_dict.pop('end')
+    wrf_config_file = args_dict.pop('wrf_config')
+
+    utils.set_logging_config(utils.get_logs_dir(wrf_home))
+
+    wrf_conf = executor.get_wrf_config(wrf_home, config_file=wrf_config_file, **args_dict)
+
+    executor.tune_mpi(wrf_conf, start_date)
+
+if __name__ == "__main__":
+    main()
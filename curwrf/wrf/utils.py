@@ -1,5 +1,7 @@
 import argparse
+import collections
 import datetime as dt
+import fnmatch
 import glob
 import logging
 import logging.config
@@ -8,26 +10,41 @@ import os
 import re
 import shlex
 import shutil
+import struct
 import subprocess
+import tempfile
+import threading
 import time
+import unittest
+import weakref
 
 import math
 from urllib2 import urlopen, HTTPError, URLError
 
-import multiprocessing
-import pkg_resources
-import yaml
 import errno
 import signal
 
 from functools import wraps
-from shapely.geometry import Point, shape
-from joblib import Parallel, delayed
 
 from curwrf.wrf import constants
 
+SUBPROCESS_TAIL_LINES = 1000
+SUBPROCESS_MONITOR_INTERVAL_S = 10
+SUBPROCESS_KILL_GRACE_S = 30
 
-def parse_args(parser_description='Running WRF'):
+
+def get_package_file(name):
+    """
+    :return: path of a file in this package. pkg_resources is not used as it takes a while to import
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+def get_arg_parser(parser_description='Running WRF', add_help=True):
+    """
+    :param add_help: False to use the parser as a parent of another parser
+    :return: argparse.ArgumentParser of the dates, the wrfconfig.yaml and the WRF config args
+    """
     def t_or_f(arg):
         ua = str(arg).upper()
         if 'TRUE'.startswith(ua):
@@ -37,12 +54,12 @@ def parse_args(parser_description='Running WRF'):
         else:
             raise argparse.ArgumentTypeError('Boolean value expected.')
 
-    parser = argparse.ArgumentParser(description=parser_description)
+    parser = argparse.ArgumentParser(description=parser_description, add_help=add_help)
     parser.add_argument('-start', default=dt.datetime.today().strftime('%Y-%m-%d_%H:%M'),
                         help='Start timestamp with format %%Y-%%m-%%d_%%H:%%M', dest='start')
     parser.add_argument('-end', default=(dt.datetime.today() + dt.timedelta(days=1)).strftime('%Y-%m-%d_%H:%M'),
                         help='End timestamp with format %%Y-%%m-%%d_%%H:%%M', dest='end')
-    parser.add_argument('-wrfconfig', default=pkg_resources.resource_filename(__name__, 'wrfconfig.yaml'),
+    parser.add_argument('-wrfconfig', default=get_package_file('wrfconfig.yaml'),
                         help='Path to the wrfconfig.yaml', dest='wrf_config')
 
     conf_group = parser.add_argument_group('wrf_config', 'Arguments for WRF config')
@@ -53,18 +70,97 @@ def parse_args(parser_description='Running WRF'):
     conf_group.add_argument('-procs', help='Num. of processors for WRF run', type=int)
     conf_group.add_argument('-gfs_dir', help='GFS data dir path')
     conf_group.add_argument('-gfs_clean', type=t_or_f, help='If true, gfs_dir will be cleaned before downloading data')
+    conf_group.add_argument('-gfs_cache_size', type=float,
+                            help='GFS cache disk budget in GB. Least recently used inventories are evicted beyond this')
     conf_group.add_argument('-gfs_inv', help='GFS inventory format. default = gfs.tCCz.pgrb2.RRRR.fFFF')
     conf_group.add_argument('-gfs_res', help='GFS inventory resolution. default = 0p50')
     conf_group.add_argument('-gfs_step', help='GFS time step (in hours) between data sets', type=int)
     conf_group.add_argument('-gfs_retries', help='GFS num. of retries for each download', type=int)
     conf_group.add_argument('-gfs_delay', help='GFS delay between retries', type=int)
-    conf_group.add_argument('-gfs_url', help='GFS URL')
+    conf_group.add_argument('-gfs_url', help='GFS URL or a comma separated list of mirror URLs')
+    conf_group.add_argument('-gfs_hedge_delay', type=int,
+                            help='Seconds before a slow GFS download is also requested from another mirror')
+    conf_group.add_argument('-gfs_timeout', type=int, help='Max seconds for each GFS download attempt')
+    conf_group.add_argument('-gfs_min_speed', type=float,
+                            help='GFS download throughput floor in KB/s. Slower transfers are retried')
+    conf_group.add_argument('-gfs_stall_window', type=int,
+                            help='Seconds over which the GFS download throughput is checked against gfs_min_speed')
     conf_group.add_argument('-gfs_threads', help='GFS num. of parallel downloading threads', type=int)
+    conf_group.add_argument('-gfs_validate', type=t_or_f,
+                            help='If true, GRIB2 headers of the GFS data are validated before running WPS')
+    conf_group.add_argument('-gfs_watch', type=t_or_f,
+                            help='If true, each GFS inventory is downloaded as soon as it is published')
+    conf_group.add_argument('-gfs_poll_interval', type=int, help='Min seconds between polls of the GFS cycle')
+    conf_group.add_argument('-gfs_max_poll_interval', type=int, help='Max seconds between polls of the GFS cycle')
+    conf_group.add_argument('-gfs_watch_timeout', type=int,
+                            help='Seconds to wait for the GFS cycle to be published when gfs_watch is set')
+    conf_group.add_argument('-pipelined_ungrib', type=t_or_f,
+                            help='If true, each GFS inventory is ungribbed as soon as it is downloaded')
+    conf_group.add_argument('-run_lookahead', type=int,
+                            help='Num. of dates to prefetch GFS data ahead while running WRF. 0 runs the dates in '
+                                 'sequence')
+    conf_group.add_argument('-geogrid_cache_size', type=int,
+                            help='Num. of domain configurations to keep geogrid outputs of')
+    conf_group.add_argument('-wrf_max_cfl_warnings', type=int,
+                            help='Num. of CFL warnings after which wrf.exe is aborted as blown up')
+    conf_group.add_argument('-mpi_tuning', type=t_or_f,
+                            help='If true, the MPI settings tuned for this machine and domain are used, if any')
+    conf_group.add_argument('-tune_procs', type=int, nargs='+',
+                            help='Num. of MPI ranks to try when tuning. default = powers of 2 up to the num. of cpus')
+    conf_group.add_argument('-tune_tiles', type=int, nargs='+', help='numtiles values to try when tuning')
+    conf_group.add_argument('-tune_omp_threads', type=int, nargs='+',
+                            help='Num. of OpenMP threads per rank to try when tuning')
+    conf_group.add_argument('-tune_minutes', type=int, help='Forecast minutes of each tuning run')
+    conf_group.add_argument('-ensemble_cores', type=int,
+                            help='Num. of cores shared by the ensemble members. default = num. of cpus')
+    conf_group.add_argument('-stage_scheduler', type=t_or_f,
+                            help='If true, the stages of all the dates run as a DAG, overlapping as far as the '
+                                 'resources allow')
+    conf_group.add_argument('-scheduler_cores', type=int,
+                            help='Num. of cores of the stage scheduler. default = num. of cpus')
+    conf_group.add_argument('-scheduler_net_slots', type=int,
+                            help='Num. of dates downloading GFS data concurrently with the stage scheduler')
+    conf_group.add_argument('-scheduler_disk_slots', type=int,
+                            help='Num. of disk heavy stages (WPS, extraction) running concurrently with the stage '
+                                 'scheduler')
+    conf_group.add_argument('-wrfout_slim', type=t_or_f,
+                            help='If true, the wrfout files are replaced by compressed copies with only the '
+                                 'wrfout_vars and the de-accumulated precipitation')
+    conf_group.add_argument('-wrfout_vars', nargs='+', help='Variables kept in the slim wrfout files')
+    conf_group.add_argument('-wrfout_complevel', type=int, help='zlib compression level of the slim wrfout files')
+    conf_group.add_argument('-wrfout_full_policy', choices=['archive', 'delete', 'keep'],
+                            help='What to do with the full wrfout files when slimmed. default = archive')
+    conf_group.add_argument('-extract_chunk_size', type=int,
+                            help='Num. of time steps of the wrfout files read at once by the extraction. default = 24')
+    conf_group.add_argument('-resume_runs', type=t_or_f,
+                            help='If true, stages completed by a previous attempt of the run with the same inputs are '
+                                 'skipped. Not supported with -run_lookahead, -stage_scheduler or ensembles')
+    conf_group.add_argument('-restart_interval', type=int,
+                            help='Minutes between WRF restart files, from which a failed wrf.exe can be resumed')
+    conf_group.add_argument('-isolated_runs', type=t_or_f,
+                            help='If true, each run gets its own scratch dir in wrf_home/runs, so that runs can '
+                                 'execute concurrently. The wrfout files stay in the run dirs, and are linked from '
+                                 'the OUTPUT dir')
+    conf_group.add_argument('-run_cleanup', type=t_or_f,
+                            help='If true, the intermediate files of an isolated run (GRIB links, intermediate, '
+                                 'met_em, wrfinput, wrfbdy and restart files) are removed once its outputs are '
+                                 'collected. default = true')
+    conf_group.add_argument('-run_id', help='Prefix of the run dirs. default = process id. Needed with '
+                                             '-isolated_runs and -resume_runs, to resume in the run dirs of the '
+                                             'earlier attempt')
+    conf_group.add_argument('-gfs_subset', type=t_or_f,
+                            help='If true, only the gfs_fields records are downloaded using the GRIB2 .idx files')
+
+    return parser
+
+
+def get_args_dict(args):
+    # remove all the arguments which are None. false and 0 values are kept, to override the wrfconfig.yaml
+    return dict((k, v) for k, v in dict(args._get_kwargs()).items() if v is not None)
 
-    # remove all the arguments which are None
-    args_dict = dict((k, v) for k, v in dict(parser.parse_args()._get_kwargs()).items() if v)
 
-    return args_dict
+def parse_args(parser_description='Running WRF'):
+    return get_args_dict(get_arg_parser(parser_description).parse_args())
 
 
 def set_logging_config(log_home):
@@ -91,12 +187,13 @@ def set_logging_config(log_home):
         },
     )
 
-    path = pkg_resources.resource_filename(__name__, 'logging.yaml')
+    path = get_package_file('logging.yaml')
     value = os.getenv(constants.LOGGING_ENV_VAR, None)
 
     if value:
         path = value
     if os.path.exists(path):
+        import yaml
         with open(path, 'rt') as f:
             config = yaml.safe_load(f.read())
         config['handlers']['fh']['filename'] = os.path.join(log_home, 'wrfrun.log')
@@ -105,6 +202,18 @@ def set_logging_config(log_home):
         logging.config.dictConfig(default_config)
 
 
+def get_dates(start_date, end_date, step=dt.timedelta(days=1)):
+    """
+    :return: list of the datetimes from the start_date (inclusive) to the end_date (exclusive)
+    """
+    dates = []
+    date = start_date
+    while date < end_date:
+        dates.append(date)
+        date += step
+    return dates
+
+
 def create_dir_if_not_exists(path):
     if not os.path.exists(path):
         os.makedirs(path)
@@ -139,6 +248,26 @@ def get_logs_dir(wrf_home=constants.DEFAULT_WRF_HOME):
     return create_dir_if_not_exists(os.path.join(wrf_home, 'logs'))
 
 
+def get_geogrid_cache_dir(wrf_home=constants.DEFAULT_WRF_HOME):
+    return create_dir_if_not_exists(os.path.join(wrf_home, 'DATA', 'geogrid'))
+
+
+def get_runs_dir(wrf_home=constants.DEFAULT_WRF_HOME):
+    return create_dir_if_not_exists(os.path.join(wrf_home, 'runs'))
+
+
+def get_archive_dir(wrf_home=constants.DEFAULT_WRF_HOME):
+    return create_dir_if_not_exists(os.path.join(wrf_home, 'ARCHIVE'))
+
+
+def get_mpi_tuning_file(wrf_home=constants.DEFAULT_WRF_HOME):
+    return os.path.join(create_dir_if_not_exists(os.path.join(wrf_home, 'DATA')), 'mpi_tuning.json')
+
+
+def get_zonal_stats_cache_dir(wrf_home=constants.DEFAULT_WRF_HOME):
+    return os.path.join(wrf_home, 'DATA', 'zonal-stats')
+
+
 def get_gfs_data_url_dest_tuple(url, inv, date_str, cycle, fcst_id, res, gfs_dir):
     url0 = url.replace('YYYYMMDD', date_str).replace('CC', cycle)
     inv0 = inv.replace('CC', cycle).replace('FFF', fcst_id).replace('RRRR', res)
@@ -152,16 +281,19 @@ def get_gfs_data_dest(inv, date_str, cycle, fcst_id, res, gfs_dir):
     return dest
 
 
+def get_gfs_fcst_ids(period, step):
+    return [str(i).zfill(3) for i in range(0, period * 24 + 1, step)]
+
+
 def get_gfs_inventory_url_dest_list(date, period, url, inv, step, cycle, res, gfs_dir):
     date_str = date.strftime('%Y%m%d')
-    return [get_gfs_data_url_dest_tuple(url, inv, date_str, cycle, str(i).zfill(3), res, gfs_dir) for i in
-            range(0, period * 24 + 1, step)]
+    return [get_gfs_data_url_dest_tuple(url, inv, date_str, cycle, i, res, gfs_dir) for i in
+            get_gfs_fcst_ids(period, step)]
 
 
 def get_gfs_inventory_dest_list(date, period, inv, step, cycle, res, gfs_dir):
     date_str = date.strftime('%Y%m%d')
-    return [get_gfs_data_dest(inv, date_str, cycle, str(i).zfill(3), res, gfs_dir) for i in
-            range(0, period * 24 + 1, step)]
+    return [get_gfs_data_dest(inv, date_str, cycle, i, res, gfs_dir) for i in get_gfs_fcst_ids(period, step)]
 
 
 def replace_file_with_values(source, destination, val_dict):
@@ -183,6 +315,61 @@ def replace_file_with_values(source, destination, val_dict):
     logging.debug('replace file final content \n' + out)
 
 
+def read_namelist(path):
+    """
+    reads a Fortran namelist file (namelist.wps/ namelist.input) with one key per line
+    :return: dict of group -> dict of key -> list of value strings, ex: {'share': {'max_dom': ['3'], ...}}
+    """
+    namelist = {}
+    group = None
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('&'):
+                group = line[1:].strip().lower()
+                namelist[group] = {}
+            elif line.startswith('/'):
+                group = None
+            elif group is not None and '=' in line:
+                key, value = line.split('=', 1)
+                namelist[group][key.strip().lower()] = [v.strip() for v in value.split(',') if v.strip()]
+    return namelist
+
+
+def update_namelist(path, group, values, dest=None):
+    """
+    replaces the values of the keys in a namelist group. keys which are not in the group are appended to it
+    :param values: dict of key -> value string or list of value strings, ex: {'max_dom': '3', 'start_date': ["'..'"]}
+    :param dest: output file path. the namelist is updated in place if None
+    """
+
+    def format_value(v):
+        return ', '.join(str(x) for x in v) + ',' if isinstance(v, (list, tuple)) else str(v) + ','
+
+    remaining = dict((k.lower(), v) for k, v in values.items())
+    out = []
+    in_group = False
+    with open(path, 'r') as f:
+        for line in f:
+            stripped = line.strip()
+            if stripped.startswith('&'):
+                in_group = stripped[1:].strip().lower() == group.lower()
+            elif stripped.startswith('/') and in_group:
+                for k in sorted(remaining):
+                    out.append(' %s = %s\n' % (k, format_value(remaining[k])))
+                remaining = {}
+                in_group = False
+            elif in_group and '=' in stripped:
+                key = stripped.split('=', 1)[0].strip().lower()
+                if key in remaining:
+                    indent = line[0:len(line) - len(line.lstrip())]
+                    line = '%s%s = %s\n' % (indent, line.split('=', 1)[0].strip(), format_value(remaining.pop(key)))
+            out.append(line)
+
+    with open(dest if dest is not None else path, 'w') as f:
+        f.write(''.join(out))
+
+
 def cleanup_dir(gfs_dir):
     shutil.rmtree(gfs_dir)
     os.makedirs(gfs_dir)
@@ -204,30 +391,195 @@ def create_symlink_with_prefix(src_dir, prefix, dest_dir):
         os.symlink(filename, os.path.join(dest_dir, ntpath.basename(filename)))
 
 
-def run_subprocess(cmd, cwd=None):
+def create_linked_dir(src_dir, dest_dir, excludes=()):
+    """
+    creates the dest_dir with a symlink to each entry of the src_dir, except the entries matching the excludes
+    :param excludes: list of glob patterns, ex: ['namelist.wps', 'met_em*']
+    :return: dest_dir
+    """
+    create_dir_if_not_exists(dest_dir)
+    for name in os.listdir(src_dir):
+        if any(fnmatch.fnmatch(name, p) for p in excludes):
+            continue
+        link = os.path.join(dest_dir, name)
+        if not os.path.lexists(link):
+            os.symlink(os.path.join(os.path.abspath(src_dir), name), link)
+    return dest_dir
+
+
+def run_subprocess(cmd, cwd=None, log_file=None, monitor=None, monitor_interval=SUBPROCESS_MONITOR_INTERVAL_S,
+                   env=None):
+    """
+    runs the cmd, streaming its stdout and stderr line by line. only the last lines are kept in memory
+    :param log_file: optional path of a file to append the output to, as it is written
+    :param monitor: optional object with a check() method returning an abort reason or None. it is called every
+    monitor_interval seconds while the process runs, and the process group is killed if a reason is returned
+    :param env: optional environment of the process. the current environment is inherited if None
+    :return: last lines of the output
+    """
     logging.info('Running subprocess %s' % cmd)
     start_t = time.time()
-    output = ''
+    tail = collections.deque(maxlen=SUBPROCESS_TAIL_LINES)
+    proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd,
+                            env=env, preexec_fn=os.setsid)
+    done = threading.Event()
+    aborted = []
+
+    def kill(sig):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            pass
+
+    def watch():
+        while not done.wait(monitor_interval):
+            reason = monitor.check()
+            if reason is not None:
+                logging.error('Aborting subprocess %s : %s' % (cmd, reason))
+                aborted.append(reason)
+                kill(signal.SIGTERM)
+                if not done.wait(SUBPROCESS_KILL_GRACE_S):
+                    kill(signal.SIGKILL)
+                return
+
+    watcher = None
+    if monitor is not None:
+        watcher = threading.Thread(target=watch, name='subprocess-monitor')
+        watcher.daemon = True
+        watcher.start()
+
+    out = open(log_file, 'a') if log_file is not None else None
     try:
-        output = subprocess.check_output(shlex.split(cmd), stderr=subprocess.STDOUT, cwd=cwd)
-    except subprocess.CalledProcessError as e:
-        logging.error('Exception in subprocess %s! Error code %d' % (cmd, e.returncode))
-        logging.error(e.output)
-        raise e
+        for line in iter(proc.stdout.readline, ''):
+            tail.append(line)
+            if out is not None:
+                out.write(line)
+                out.flush()
+        proc.wait()
     finally:
+        done.set()
+        if watcher is not None:
+            watcher.join()
+        if out is not None:
+            out.close()
+        if proc.poll() is None:
+            kill(signal.SIGKILL)
         elapsed_t = time.time() - start_t
         logging.info('Subprocess %s finished in %f s' % (cmd, elapsed_t))
+
+    output = ''.join(tail)
+    if log_file is None:
         logging.info('stdout and stderr of %s\n%s' % (cmd, output))
+    if len(aborted) > 0:
+        raise SubprocessAborted(cmd, aborted[0])
+    if proc.returncode != 0:
+        logging.error('Exception in subprocess %s! Error code %d' % (cmd, proc.returncode))
+        logging.error(output)
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output)
     return output
 
 
+def is_grib2_file_complete(path):
+    """
+    walks the GRIB2 messages in the file using the message lengths in their indicator sections (section 0) and checks
+    that each message ends with the '7777' end section and the last message ends at the end of the file
+    :param path: GRIB2 file path
+    :return: True if the file is a complete GRIB2 file
+    """
+    file_size = os.path.getsize(path)
+    if file_size == 0:
+        return False
+
+    offset = 0
+    with open(path, 'rb') as f:
+        while offset < file_size:
+            f.seek(offset)
+            indicator = f.read(16)
+            if len(indicator) < 16 or indicator[0:4] != 'GRIB' or ord(indicator[7]) != 2:
+                return False
+            msg_len = struct.unpack('>Q', indicator[8:16])[0]
+            if msg_len < 20 or offset + msg_len > file_size:
+                return False
+            f.seek(offset + msg_len - 4)
+            if f.read(4) != '7777':
+                return False
+            offset += msg_len
+    return True
+
+
+class PolygonIndex:
+    """
+    Spatial index of polygons, ex: of a shapefile, built once to find the polygons containing many points. The
+    candidates of each point are looked up in an STRtree, and tested against prepared geometries
+    """
+
+    def __init__(self, polygons):
+        """
+        :param polygons: shapefile.Reader, or list of shapely geometries
+        """
+        from shapely.geometry import shape
+        from shapely.prepared import prep
+        from shapely.strtree import STRtree
+
+        if hasattr(polygons, 'shapeRecords'):
+            polygons = [shape(sr.shape.__geo_interface__) for sr in polygons.shapeRecords()]
+        self.polygons = list(polygons)
+        self.prepared = [prep(p) for p in self.polygons]
+        self.ids = dict((id(p), i) for i, p in enumerate(self.polygons))
+        self.tree = STRtree(self.polygons)
+        bounds = [p.bounds for p in self.polygons]
+        self.bounds = (min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds),
+                       max(b[3] for b in bounds))
+
+    @staticmethod
+    def from_shapefile(shp_file):
+        import shapefile
+        return PolygonIndex(shapefile.Reader(shp_file))
+
+    def get_polygon_ids(self, lats, lons):
+        """
+        :param lats: array of latitudes
+        :param lons: array of longitudes
+        :return: int array of the index of the first polygon containing each point, -1 if none
+        """
+        import numpy as np
+        from shapely.geometry import Point
+
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        ids = np.full(lats.shape, -1, dtype=int)
+        # points outside the bounds of all the polygons are not looked up
+        min_x, min_y, max_x, max_y = self.bounds
+        candidates = np.nonzero((lons >= min_x) & (lons <= max_x) & (lats >= min_y) & (lats <= max_y))
+        for idx in zip(*candidates):
+            point = Point(lons[idx], lats[idx])
+            matches = [self.ids[id(p)] for p in self.tree.query(point)]
+            for i in sorted(matches):
+                if self.prepared[i].contains(point):
+                    ids[idx] = i
+                    break
+        return ids
+
+
+# indices of the shapefile readers passed to is_inside_polygon
+_polygon_indices = weakref.WeakKeyDictionary()
+
+
 def is_inside_polygon(polygons, lat, lon):
-    point = Point(lon, lat)
-    for i, poly in enumerate(polygons.shapeRecords()):
-        polygon = shape(poly.shape.__geo_interface__)
-        if point.within(polygon):
-            return 1
-    return 0
+    """
+    :param polygons: shapefile.Reader. indexed once, at the first call
+    :return: 1 if the point is inside any of the polygons, else 0
+    """
+    if polygons not in _polygon_indices:
+        _polygon_indices[polygons] = PolygonIndex(polygons)
+    return 1 if _polygon_indices[polygons].get_polygon_ids([lat], [lon])[0] >= 0 else 0
+
+
+class SubprocessAborted(Exception):
+    def __init__(self, cmd, reason):
+        self.cmd = cmd
+        self.reason = reason
+        Exception.__init__(self, 'Subprocess %s aborted : %s' % (cmd, reason))
 
 
 class TimeoutError(Exception):
@@ -300,8 +652,29 @@ def download_file(url, dest):
         raise e
 
 
-def download_parallel(url_dest_list, procs=multiprocessing.cpu_count()):
-    Parallel(n_jobs=procs)(delayed(download_file)(i[0], i[1]) for i in url_dest_list)
+class TestArgs(unittest.TestCase):
+    def get_wrf_config(self, args):
+        from curwrf.wrf.execution import executor
+        args_dict = get_args_dict(get_arg_parser().parse_args(args))
+        return executor.get_wrf_config(args_dict.pop('wrf_home'), config_file=args_dict.pop('wrf_config'), **args_dict)
+
+    def test_mpi_tuning_off(self):
+        self.assertTrue(self.get_wrf_config([]).get('mpi_tuning'))
+        self.assertFalse(self.get_wrf_config(['-mpi_tuning', 'false']).get('mpi_tuning'))
+
+    def test_run_cleanup_off(self):
+        from curwrf.wrf.execution import executor
+        run_dir = tempfile.mkdtemp()
+        try:
+            em_real_dir = create_dir_if_not_exists(os.path.join(run_dir, 'em_real'))
+            wrfinput = os.path.join(em_real_dir, 'wrfinput_d01')
+            open(wrfinput, 'w').close()
+            wrf_conf = self.get_wrf_config(['-run_cleanup', 'false'])
+            wrf_conf.set_all({'run_dir': run_dir, 'em_real_dir': em_real_dir})
+            executor.cleanup_run(wrf_conf, wps=False)
+            self.assertTrue(os.path.exists(wrfinput))
+        finally:
+            shutil.rmtree(run_dir)
 
 
 # def namedtuple_with_defaults(typename, field_names, default_values=()):